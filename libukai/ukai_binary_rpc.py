@@ -0,0 +1,686 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+'''
+The ukai_binary_rpc.py module provides a length-prefixed binary
+protocol to transfer block data between UKAI nodes.  Unlike the
+XML-RPC interface, block data is carried as raw bytes.
+
+Each request is tagged with a request ID.  A client can send many
+requests over a single connection without waiting for responses, and
+the server may return responses in a different order.
+
+A request consists of a fixed size header, an image name, and a
+payload.
+
+    magic(2) version(1) operation(1) flags(1) reserved(1)
+    image name length(2) request ID(4) block size(8) block index(8)
+    offset(8) length(8) payload length(4)
+
+For the vectored operations (READV and WRITEV), the block index field
+contains the number of pieces, and the payload starts with a table of
+pieces followed by the data to be written (WRITEV only).
+
+    block index(8) offset(8) length(8)
+    ...
+
+A response consists of a fixed size header and a payload.
+
+    magic(2) version(1) operation(1) flags(1) reserved(1)
+    request ID(4) status(4) value(8) payload length(4)
+
+The status field is 0 on success, otherwise an errno value.  In that
+case the payload contains an error message.
+'''
+
+import errno
+import Queue
+import socket
+import SocketServer
+import struct
+import threading
+import zlib
+
+from ukai_local_io import ukai_local_read, ukai_local_write
+from ukai_local_io import ukai_local_readv, ukai_local_writev
+
+UKAI_BINARY_RPC_MAGIC = 0x554b
+UKAI_BINARY_RPC_VERSION = 2
+
+# Operation codes.
+UKAI_BINARY_RPC_OP_READ = 1
+UKAI_BINARY_RPC_OP_WRITE = 2
+UKAI_BINARY_RPC_OP_READV = 3
+UKAI_BINARY_RPC_OP_WRITEV = 4
+
+# The payload is compressed with zlib.
+UKAI_BINARY_RPC_FLAG_ZLIB = 0x01
+
+# The number of requests processed in parallel per connection.
+UKAI_BINARY_RPC_WORKERS = 8
+
+# The timeout (in seconds) to connect to a node and to send a
+# request, used if no timeout is specified.
+UKAI_BINARY_RPC_IO_TIMEOUT = 30.0
+
+UKAI_DATA_PORT_DEFAULT = 22222
+
+# The errno module of Python 2 doesn't define ECANCELED.
+UKAI_BINARY_RPC_ECANCELED = getattr(errno, 'ECANCELED', 125)
+
+UKAI_DATA_TRANSPORT_XMLRPC = 'xmlrpc'
+UKAI_DATA_TRANSPORT_BINARY = 'binary'
+
+_request_header = struct.Struct('!HBBBxHIQQQQI')
+_response_header = struct.Struct('!HBBBxIiQI')
+_piece = struct.Struct('!QQQ')
+
+def ukai_data_transport(node, config):
+    '''
+    Returns the name of the data transport used to access the block
+    data stored at the specified node.  The data_transport
+    configuration value is either a transport name, or a dictionary
+    object of node addresses and transport names with an optional
+    'default' entry.
+
+    node: the address of a storage node.
+    config: an UKAIConfig instance.
+
+    Return values: UKAI_DATA_TRANSPORT_XMLRPC or
+        UKAI_DATA_TRANSPORT_BINARY.
+    '''
+    transport = config.get('data_transport')
+    if transport is None:
+        return (UKAI_DATA_TRANSPORT_XMLRPC)
+    if isinstance(transport, dict):
+        return (transport.get(node,
+                              transport.get('default',
+                                            UKAI_DATA_TRANSPORT_XMLRPC)))
+    return (transport)
+
+def ukai_data_port(config):
+    '''
+    Returns the port number of the binary data transport.
+    '''
+    if config.get('data_port') is None:
+        return (UKAI_DATA_PORT_DEFAULT)
+    return (int(config.get('data_port')))
+
+class UKAIBinaryRPCError(IOError):
+    '''
+    The UKAIBinaryRPCError exception is raised when a remote node
+    returns an error status or the connection is lost.  Since the
+    class is derived from the IOError class, the error is handled in
+    the same way as other communication errors.
+    '''
+    pass
+
+def _recv_exact(sock, size):
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = sock.recv(min(remaining, 1048576))
+        if not chunk:
+            return (None)
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return (''.join(chunks))
+
+class UKAIBinaryRPCRequest(object):
+    '''
+    The UKAIBinaryRPCRequest class represents a request in flight.
+    The result is retrieved by the wait() method.
+    '''
+    def __init__(self, transform=None):
+        '''
+        transform: a function applied to the (flags, value, payload)
+            tupple of the response by the wait() method.
+        '''
+        self._event = threading.Event()
+        self._transform = transform
+        self._result = None
+        self._error = None
+        self._callbacks = []
+        self._callback_lock = threading.Lock()
+        # the connection which sent the request.
+        self.connection = None
+
+    def complete(self, result=None, error=None):
+        '''
+        Sets the result or the error of the request, wakes up waiting
+        threads, and calls the registered callbacks.
+        '''
+        self._result = result
+        self._error = error
+        try:
+            self._callback_lock.acquire()
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._callback_lock.release()
+        for callback in callbacks:
+            callback(error)
+
+    def add_done_callback(self, callback):
+        '''
+        Registers a function called with the error (None on success)
+        when the request completes.  If the request has completed
+        already, the function is called immediately.  The function is
+        usually called by the receiver thread, and must not block.
+        '''
+        try:
+            self._callback_lock.acquire()
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._callback_lock.release()
+        callback(self._error)
+
+    def done(self):
+        '''
+        Returns True if the response has been received.
+        '''
+        return (self._event.is_set())
+
+    def wait(self, timeout=None):
+        '''
+        Waits for the response, and returns its result.  If timeout
+        is specified and the response is not received within timeout
+        seconds, UKAIBinaryRPCError(ETIMEDOUT) is raised.
+        '''
+        if not self._event.wait(timeout):
+            raise UKAIBinaryRPCError(errno.ETIMEDOUT, 'request timed out')
+        if self._error is not None:
+            raise self._error
+        if self._transform is not None:
+            return (self._transform(self._result))
+        return (self._result)
+
+    def cancel(self):
+        '''
+        Tells the connection that the response is no longer needed.
+        '''
+        if self.connection is not None:
+            self.connection.cancel(self)
+
+class UKAIBinaryRPCConnection(object):
+    '''
+    The UKAIBinaryRPCConnection class represents a TCP connection to
+    the binary data transport of a remote node.  Requests from many
+    threads are multiplexed over the connection, and a receiver thread
+    matches responses to requests by their request IDs.
+    '''
+    def __init__(self, server, port, timeout=None):
+        '''
+        timeout: the timeout in seconds to establish the connection
+            and to send a request.  UKAI_BINARY_RPC_IO_TIMEOUT is
+            used if None.
+        '''
+        if timeout is None:
+            timeout = UKAI_BINARY_RPC_IO_TIMEOUT
+        self._sock = socket.create_connection((server, port), timeout)
+        # the receiver thread waits for responses without timeout.
+        # sending is bounded by the kernel, so that a node which
+        # stops reading doesn't block the senders forever.
+        self._sock.settimeout(None)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                              struct.pack('ll', int(timeout),
+                                          int(timeout % 1 * 1000000)))
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._next_id = 0
+        self._closed = False
+        receiver = threading.Thread(target=self._receive)
+        receiver.daemon = True
+        receiver.start()
+
+    @property
+    def closed(self):
+        '''
+        True if the connection is no longer usable.
+        '''
+        return (self._closed)
+
+    def submit(self, op, flags, image_name, block_size, block_index,
+               offset, length, payload='', transform=None):
+        '''
+        Sends a request without waiting for its response.
+
+        Return values: A UKAIBinaryRPCRequest instance.
+        '''
+        request = UKAIBinaryRPCRequest(transform)
+        request.connection = self
+        try:
+            self._lock.acquire()
+            if self._closed:
+                raise UKAIBinaryRPCError(errno.ECONNRESET,
+                                         'connection closed')
+            request_id = self._next_id
+            self._next_id = (self._next_id + 1) & 0xffffffff
+            self._pending[request_id] = request
+        finally:
+            self._lock.release()
+
+        header = _request_header.pack(UKAI_BINARY_RPC_MAGIC,
+                                      UKAI_BINARY_RPC_VERSION,
+                                      op, flags, len(image_name),
+                                      request_id, block_size, block_index,
+                                      offset, length, len(payload))
+        try:
+            self._send_lock.acquire()
+            self._sock.sendall(header + image_name + payload)
+        except socket.error, e:
+            # a request partially sent breaks the stream.
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                e = UKAIBinaryRPCError(errno.ETIMEDOUT, 'send timed out')
+            else:
+                e = UKAIBinaryRPCError(errno.ECONNRESET, str(e))
+            self._fail(e)
+            raise e
+        finally:
+            self._send_lock.release()
+        return (request)
+
+    def cancel(self, request):
+        '''
+        Forgets a request whose response is no longer needed.  The
+        request is completed with an ECANCELED error.
+        '''
+        cancelled = False
+        try:
+            self._lock.acquire()
+            for request_id in self._pending.keys():
+                if self._pending[request_id] is request:
+                    del self._pending[request_id]
+                    cancelled = True
+                    break
+        finally:
+            self._lock.release()
+        if cancelled:
+            request.complete(error=UKAIBinaryRPCError(
+                    UKAI_BINARY_RPC_ECANCELED, 'request cancelled'))
+
+    def close(self):
+        self._fail(UKAIBinaryRPCError(errno.ECONNRESET, 'connection closed'))
+
+    def _receive(self):
+        try:
+            while True:
+                data = _recv_exact(self._sock, _response_header.size)
+                if data is None:
+                    raise UKAIBinaryRPCError(errno.ECONNRESET,
+                                             'connection closed by peer')
+                (magic, version, op, flags, request_id, status, value,
+                 payload_len) = _response_header.unpack(data)
+                if (magic != UKAI_BINARY_RPC_MAGIC
+                    or version != UKAI_BINARY_RPC_VERSION):
+                    raise UKAIBinaryRPCError(errno.EPROTO,
+                                             'malformed response')
+                payload = ''
+                if payload_len > 0:
+                    payload = _recv_exact(self._sock, payload_len)
+                    if payload is None:
+                        raise UKAIBinaryRPCError(errno.ECONNRESET,
+                                                 'connection closed by peer')
+                try:
+                    self._lock.acquire()
+                    request = self._pending.pop(request_id, None)
+                finally:
+                    self._lock.release()
+                if request is None:
+                    # cancelled.
+                    continue
+                if status != 0:
+                    request.complete(error=UKAIBinaryRPCError(status,
+                                                              payload))
+                else:
+                    request.complete(result=(flags, value, payload))
+        except UKAIBinaryRPCError, e:
+            self._fail(e)
+        except socket.error, e:
+            self._fail(UKAIBinaryRPCError(errno.ECONNRESET, str(e)))
+
+    def _fail(self, error):
+        # fails all the requests in flight.
+        try:
+            self._lock.acquire()
+            already_closed = self._closed
+            self._closed = True
+            pending = self._pending
+            self._pending = {}
+        finally:
+            self._lock.release()
+        for request in pending.values():
+            request.complete(error=error)
+        if not already_closed:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._sock.close()
+
+# The connections shared by all the UKAIBinaryRPCCall instances.
+_connections = {}
+# (server, port) -> the lock held while connecting to the node.
+_connect_locks = {}
+_connections_lock = threading.Lock()
+
+def _get_connection(server, port, timeout=None):
+    key = (server, port)
+    try:
+        _connections_lock.acquire()
+        conn = _connections.get(key)
+        if conn is not None and not conn.closed:
+            return (conn)
+        connect_lock = _connect_locks.setdefault(key, threading.Lock())
+    finally:
+        _connections_lock.release()
+
+    # connect without the global lock, so that a node which doesn't
+    # respond doesn't block the connections to the other nodes.
+    try:
+        connect_lock.acquire()
+        # another thread may have connected meanwhile.
+        conn = _connections.get(key)
+        if conn is not None and not conn.closed:
+            return (conn)
+        conn = UKAIBinaryRPCConnection(server, port, timeout)
+        try:
+            _connections_lock.acquire()
+            _connections[key] = conn
+        finally:
+            _connections_lock.release()
+        return (conn)
+    finally:
+        connect_lock.release()
+
+class UKAIBinaryRPCCall(object):
+    '''
+    The UKAIBinaryRPCCall class provides block read/write operations
+    using the binary data transport.  All the calls to the same node
+    share one connection.  The *_async methods return a
+    UKAIBinaryRPCRequest instance immediately so that the caller can
+    keep many requests in flight.  If timeout is specified, the other
+    methods raise UKAIBinaryRPCError(ETIMEDOUT) when a response is
+    not received within timeout seconds.
+    '''
+    def __init__(self, server, port, compress=False, timeout=None):
+        self._server = server
+        self._port = port
+        self._timeout = timeout
+        self._flags = 0
+        if compress is True:
+            self._flags |= UKAI_BINARY_RPC_FLAG_ZLIB
+
+    def read(self, image_name, block_size, block_index, offset, size):
+        '''
+        Reads size bytes from the specified block stored at the
+        remote node.
+        '''
+        return (self._wait(self.read_async(image_name, block_size,
+                                           block_index, offset, size)))
+
+    def read_async(self, image_name, block_size, block_index, offset,
+                   size):
+        '''
+        Sends a read request.  The wait() method of the returned
+        request returns the data.
+        '''
+        def transform(result):
+            (flags, value, payload) = result
+            if flags & UKAI_BINARY_RPC_FLAG_ZLIB:
+                payload = zlib.decompress(payload)
+            return (payload)
+
+        return (self._submit(UKAI_BINARY_RPC_OP_READ, image_name,
+                             block_size, block_index, offset, size, '',
+                             transform))
+
+    def write(self, image_name, block_size, block_index, offset, data):
+        '''
+        Writes the data to the specified block stored at the remote
+        node.  The number of written bytes is returned.
+        '''
+        return (self._wait(self.write_async(image_name, block_size,
+                                            block_index, offset, data)))
+
+    def write_async(self, image_name, block_size, block_index, offset,
+                    data):
+        '''
+        Sends a write request.  The wait() method of the returned
+        request returns the number of written bytes.
+        '''
+        payload = data
+        if self._flags & UKAI_BINARY_RPC_FLAG_ZLIB:
+            payload = zlib.compress(data)
+        return (self._submit(UKAI_BINARY_RPC_OP_WRITE, image_name,
+                             block_size, block_index, offset, len(data),
+                             payload, lambda result: result[1]))
+
+    def readv(self, image_name, block_size, pieces):
+        '''
+        Reads multiple pieces stored at the remote node at once.
+        pieces is a list of (block index, offset, size) tupples.  The
+        concatenated data of all the pieces is returned.
+        '''
+        return (self._wait(self.readv_async(image_name, block_size,
+                                            pieces)))
+
+    def readv_async(self, image_name, block_size, pieces):
+        '''
+        Sends a vectored read request.  The wait() method of the
+        returned request returns the data.
+        '''
+        def transform(result):
+            (flags, value, payload) = result
+            if flags & UKAI_BINARY_RPC_FLAG_ZLIB:
+                payload = zlib.decompress(payload)
+            return (payload)
+
+        table = ''.join([_piece.pack(*piece) for piece in pieces])
+        length = sum([piece[2] for piece in pieces])
+        return (self._submit(UKAI_BINARY_RPC_OP_READV, image_name,
+                             block_size, len(pieces), 0, length, table,
+                             transform))
+
+    def writev(self, image_name, block_size, pieces, data):
+        '''
+        Writes multiple pieces to the remote node at once.  pieces is
+        a list of (block index, offset, size) tupples, and data is the
+        concatenated data of all the pieces.  The number of written
+        bytes is returned.
+        '''
+        return (self._wait(self.writev_async(image_name, block_size,
+                                             pieces, data)))
+
+    def writev_async(self, image_name, block_size, pieces, data):
+        '''
+        Sends a vectored write request.  The wait() method of the
+        returned request returns the number of written bytes.
+        '''
+        payload = ''.join([_piece.pack(*piece) for piece in pieces]) + data
+        if self._flags & UKAI_BINARY_RPC_FLAG_ZLIB:
+            payload = zlib.compress(payload)
+        return (self._submit(UKAI_BINARY_RPC_OP_WRITEV, image_name,
+                             block_size, len(pieces), 0, len(data),
+                             payload, lambda result: result[1]))
+
+    def _wait(self, request):
+        try:
+            return (request.wait(self._timeout))
+        except UKAIBinaryRPCError, e:
+            if e.errno == errno.ETIMEDOUT:
+                request.cancel()
+            raise
+
+    def _submit(self, op, image_name, block_size, block_index, offset,
+                length, payload, transform):
+        if isinstance(image_name, unicode):
+            # the image name taken from the metadata is unicode.
+            image_name = image_name.encode('utf-8')
+        conn = _get_connection(self._server, self._port, self._timeout)
+        return (conn.submit(op, self._flags, image_name, block_size,
+                            block_index, offset, length, payload,
+                            transform))
+
+class UKAIBinaryRPCRequestHandler(SocketServer.BaseRequestHandler):
+    '''
+    The UKAIBinaryRPCRequestHandler class processes requests sent over
+    a connection until the peer closes it.  Requests are processed by
+    UKAI_BINARY_RPC_WORKERS threads in parallel, and responses are
+    sent in the order of completion.
+    '''
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._send_lock = threading.Lock()
+        # the reader blocks when all the workers are busy.
+        self._queue = Queue.Queue(UKAI_BINARY_RPC_WORKERS)
+        self._workers = []
+        for i in range(0, UKAI_BINARY_RPC_WORKERS):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def handle(self):
+        while True:
+            data = _recv_exact(self.request, _request_header.size)
+            if data is None:
+                return
+            (magic, version, op, flags, name_len, request_id, block_size,
+             block_index, offset, length,
+             payload_len) = _request_header.unpack(data)
+            if (magic != UKAI_BINARY_RPC_MAGIC
+                or version != UKAI_BINARY_RPC_VERSION):
+                # cannot resynchronize the stream.
+                return
+            image_name = _recv_exact(self.request, name_len)
+            payload = ''
+            if payload_len > 0:
+                payload = _recv_exact(self.request, payload_len)
+            if image_name is None or payload is None:
+                return
+            self._queue.put((op, flags, image_name, request_id,
+                             block_size, block_index, offset, length,
+                             payload))
+
+    def finish(self):
+        for worker in self._workers:
+            self._queue.put(None)
+
+    def _work(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            response = self._process(*request)
+            try:
+                self._send_lock.acquire()
+                self.request.sendall(response)
+            except socket.error:
+                # the reader will notice the closed connection.
+                pass
+            finally:
+                self._send_lock.release()
+
+    def _process(self, op, flags, image_name, request_id, block_size,
+                 block_index, offset, length, payload):
+        res_flags = 0
+        status = 0
+        value = 0
+        res_payload = ''
+        try:
+            if op == UKAI_BINARY_RPC_OP_READ:
+                res_payload = ukai_local_read(image_name, block_size,
+                                              block_index, offset, length,
+                                              self.server.config)
+                if flags & UKAI_BINARY_RPC_FLAG_ZLIB:
+                    res_payload = zlib.compress(res_payload)
+                    res_flags |= UKAI_BINARY_RPC_FLAG_ZLIB
+                value = length
+            elif op == UKAI_BINARY_RPC_OP_WRITE:
+                if flags & UKAI_BINARY_RPC_FLAG_ZLIB:
+                    payload = zlib.decompress(payload)
+                value = ukai_local_write(image_name, block_size,
+                                         block_index, offset, payload,
+                                         self.server.config)
+            elif op == UKAI_BINARY_RPC_OP_READV:
+                pieces = self._unpack_pieces(payload, block_index)
+                res_payload = ukai_local_readv(image_name, block_size,
+                                               pieces, self.server.config)
+                if flags & UKAI_BINARY_RPC_FLAG_ZLIB:
+                    res_payload = zlib.compress(res_payload)
+                    res_flags |= UKAI_BINARY_RPC_FLAG_ZLIB
+                value = length
+            elif op == UKAI_BINARY_RPC_OP_WRITEV:
+                if flags & UKAI_BINARY_RPC_FLAG_ZLIB:
+                    payload = zlib.decompress(payload)
+                pieces = self._unpack_pieces(payload, block_index)
+                value = ukai_local_writev(image_name, block_size, pieces,
+                                          payload[len(pieces)
+                                                  * _piece.size:],
+                                          self.server.config)
+            else:
+                status = errno.EINVAL
+                res_payload = 'unknown operation %d' % op
+        except (IOError, OSError), e:
+            status = e.errno if e.errno else errno.EIO
+            res_payload = str(e)
+        except Exception, e:
+            status = errno.EIO
+            res_payload = str(e)
+
+        return (_response_header.pack(UKAI_BINARY_RPC_MAGIC,
+                                      UKAI_BINARY_RPC_VERSION,
+                                      op, res_flags, request_id, status,
+                                      value, len(res_payload))
+                + res_payload)
+
+    def _unpack_pieces(self, payload, count):
+        if len(payload) < count * _piece.size:
+            raise IOError(errno.EINVAL, 'truncated piece table')
+        return ([_piece.unpack_from(payload, i * _piece.size)
+                 for i in range(0, count)])
+
+class UKAIBinaryRPCServer(SocketServer.ThreadingMixIn,
+                          SocketServer.TCPServer):
+    '''
+    The UKAIBinaryRPCServer class serves block read/write requests of
+    the binary data transport from local data files.
+    '''
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        self.config = config
+        SocketServer.TCPServer.__init__(self, address,
+                                        UKAIBinaryRPCRequestHandler)
@@ -0,0 +1,706 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+'''
+The ukai_cache.py module provides a bounded in-memory cache of block
+data read from remote nodes, and an optional on-disk cache which
+keeps the data over restarts.
+'''
+
+import errno
+import fcntl
+import os
+import shutil
+import threading
+
+from collections import OrderedDict
+
+from ukai_statistics import UKAIStatistics
+
+# The maximum amount of cached data in bytes.  0 disables the cache.
+UKAI_CACHE_SIZE_DEFAULT = 64 * 1024 * 1024
+# The maximum amount of data cached on disk in bytes.
+UKAI_DISK_CACHE_SIZE_DEFAULT = 1024 * 1024 * 1024
+# The maximum amount of data waiting to be written to the disk cache
+# in bytes.  Data put beyond this is not stored on disk.
+UKAI_DISK_CACHE_PENDING_MAX = 64 * 1024 * 1024
+
+def _covering_range(ranges, off_in_blk, size_in_blk):
+    # returns the (offset, length) pair in ranges which contains the
+    # specified range, or None.
+    for (offset, length) in ranges or ():
+        if (offset <= off_in_blk
+            and off_in_blk + size_in_blk <= offset + length):
+            return ((offset, length))
+    return (None)
+
+def _notify_evictions(evicted):
+    for image_name in evicted:
+        if image_name in UKAIStatistics:
+            UKAIStatistics[image_name].cache_eviction_op()
+
+class UKAIDiskCache(object):
+    '''
+    The UKAIDiskCache class keeps pieces of block data in files under
+    the cache_root directory.  The data of a piece is stored in the
+    <cache_root>/<image>/<block index>/<offset>.<length> file, and
+    the epoch of the image (see UKAIMetadata.epoch) at the time the
+    data was cached is stored in the <cache_root>/<image>/epoch file.
+    The cached data of an image is discarded when the image is opened
+    with a different epoch, that is, when the image may have been
+    written by another node.  When the total size of the cached data
+    exceeds the limit, the least recently used pieces are removed.
+
+    The files are written by a background thread, so that storing
+    data doesn't block the I/O path.
+
+    The directory is used by one process only.  It is locked when
+    the first image is opened, and other processes don't use the
+    disk cache.
+    '''
+    def __init__(self):
+        '''
+        Initializes the cache.  The cache is disabled until the
+        cache_root configuration value is set.
+
+        Return values: This function does not return any values.
+        '''
+        self._root = None
+        self._size = UKAI_DISK_CACHE_SIZE_DEFAULT
+        self._used = 0
+        self._loaded = False
+        self._lock_fh = None
+        # (image, block index, offset, length) -> None, ordered from
+        # the least recently used one.
+        self._entries = OrderedDict()
+        # (image, block index) -> a set of (offset, length) pairs.
+        self._ranges = {}
+        # the images opened in this process -> their epochs.
+        self._epochs = {}
+        # (image, block index, offset, length) -> data waiting to be
+        # written, ordered from the oldest one.
+        self._pending = OrderedDict()
+        self._pending_size = 0
+        self._writer = None
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+
+    def configure(self, config):
+        '''
+        Sets the directory and the size of the cache from the
+        cache_root and disk_cache_size configuration values.
+
+        config: an UKAIConfig instance.
+
+        Return values: This function does not return any values.
+        '''
+        self._root = config.get('cache_root')
+        if config.get('disk_cache_size') is not None:
+            self._size = int(config.get('disk_cache_size'))
+
+    @property
+    def enabled(self):
+        '''
+        True if the cache can keep any data.
+        '''
+        return (self._root is not None and self._size > 0)
+
+    def validate(self, image_name, epoch):
+        '''
+        Starts using the cache for the image.  The cached data of the
+        image is discarded if it was cached in a different epoch.
+
+        epoch: the current epoch of the image.
+        '''
+        if not self.enabled:
+            return
+        try:
+            self._lock.acquire()
+            if not self._load():
+                return
+            if self._read_epoch(image_name) != epoch:
+                self._remove_image(image_name)
+                self._write_epoch(image_name, epoch)
+            self._epochs[image_name] = epoch
+        finally:
+            self._lock.release()
+
+    def renew(self, image_name, epoch):
+        '''
+        Changes the epoch of the image keeping the cached data.  This
+        is used when this node changes the epoch.
+
+        epoch: the new epoch of the image.
+        '''
+        try:
+            self._lock.acquire()
+            if image_name not in self._epochs:
+                return
+            self._write_epoch(image_name, epoch)
+            self._epochs[image_name] = epoch
+        finally:
+            self._lock.release()
+
+    def release(self, image_name):
+        '''
+        Stops using the cache for the image.  The cached data is kept
+        on disk for the next use.
+        '''
+        try:
+            self._lock.acquire()
+            self._epochs.pop(image_name, None)
+        finally:
+            self._lock.release()
+
+    def get(self, image_name, blk_idx, off_in_blk, size_in_blk):
+        '''
+        Returns the cached data of the specified range, or None if
+        the range is not cached.  A cached range which contains the
+        specified range is also used.  The file is read without the
+        lock, so that a slow disk doesn't block the other lookups.
+        '''
+        key = None
+        try:
+            self._lock.acquire()
+            if image_name not in self._epochs:
+                return (None)
+            found = _covering_range(self._ranges.get((image_name, blk_idx)),
+                                    off_in_blk, size_in_blk)
+            if found is not None:
+                key = (image_name, blk_idx) + found
+                del self._entries[key]
+                self._entries[key] = None
+        finally:
+            self._lock.release()
+        if key is None:
+            return (None)
+        path = self._piece_path(key)
+        try:
+            fh = open(path, 'rb')
+            try:
+                fh.seek(off_in_blk - key[2])
+                data = fh.read(size_in_blk)
+            finally:
+                fh.close()
+            # the modification time keeps the order of the pieces
+            # over restarts.
+            os.utime(path, None)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                try:
+                    self._lock.acquire()
+                    self._remove_entry(key)
+                finally:
+                    self._lock.release()
+            # otherwise the piece was evicted or invalidated
+            # meanwhile.
+            return (None)
+        return (data)
+
+    def contains(self, image_name, blk_idx, off_in_blk, size_in_blk):
+        '''
+        Returns True if the specified range is cached.  The file is
+        not read, and the order of the pieces is not changed.
+        '''
+        try:
+            self._lock.acquire()
+            if image_name not in self._epochs:
+                return (False)
+            return (_covering_range(self._ranges.get((image_name, blk_idx)),
+                                    off_in_blk, size_in_blk) is not None)
+        finally:
+            self._lock.release()
+
+    def put(self, image_name, blk_idx, off_in_blk, data):
+        '''
+        Stores the data of the specified range.  The data is written
+        by the background thread later.  Data larger than the cache
+        itself is not stored, nor is data put while too much data is
+        waiting to be written.
+        '''
+        if len(data) > self._size:
+            return
+        key = (image_name, blk_idx, off_in_blk, len(data))
+        try:
+            self._lock.acquire()
+            if image_name not in self._epochs:
+                return
+            if key in self._entries or key in self._pending:
+                return
+            if self._pending_size + len(data) > UKAI_DISK_CACHE_PENDING_MAX:
+                return
+            self._pending[key] = data
+            self._pending_size += len(data)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_pending)
+                self._writer.daemon = True
+                self._writer.start()
+            self._cond.notify()
+        finally:
+            self._lock.release()
+
+    def _write_pending(self):
+        # the body of the background thread.  the file is written
+        # without the lock, and moved to its place with the lock
+        # held unless the data was invalidated meanwhile.
+        while True:
+            try:
+                self._lock.acquire()
+                while not self._pending:
+                    self._cond.wait()
+                (key, data) = next(self._pending.iteritems())
+            finally:
+                self._lock.release()
+            path = self._piece_path(key)
+            written = False
+            try:
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                # the file appears with the complete data, even if
+                # the process stops while writing it.
+                fh = open(path + '.tmp', 'wb')
+                try:
+                    fh.write(data)
+                finally:
+                    fh.close()
+                written = True
+            except (IOError, OSError), e:
+                print e.__class__
+                print 'Failed to write the disk cache at %s' % path
+            evicted = []
+            try:
+                self._lock.acquire()
+                if self._pending.get(key) is data:
+                    del self._pending[key]
+                    self._pending_size -= len(data)
+                    if written and key[0] in self._epochs:
+                        os.rename(path + '.tmp', path)
+                        written = False
+                        self._add_entry(key)
+                        evicted = self._evict()
+            except OSError, e:
+                print e.__class__
+                print 'Failed to write the disk cache at %s' % path
+            finally:
+                self._lock.release()
+            if written:
+                # invalidated while it was written.
+                try:
+                    os.unlink(path + '.tmp')
+                except OSError:
+                    pass
+            _notify_evictions(evicted)
+
+    def invalidate(self, image_name, blk_idx=None):
+        '''
+        Removes the cached data of the specified block, or all the
+        blocks of the image if blk_idx is None.  Nothing is done on
+        disk if the block has no cached data.
+        '''
+        if not self.enabled:
+            return
+        try:
+            self._lock.acquire()
+            if blk_idx is None:
+                # the data cached by the other process is discarded
+                # when the image is opened next time, since the epoch
+                # differs.
+                if self._lock_fh is not None:
+                    self._remove_image(image_name)
+                return
+            self._remove_pending(image_name, blk_idx)
+            ranges = self._ranges.get((image_name, blk_idx))
+            if not ranges:
+                return
+            for (offset, length) in list(ranges):
+                self._remove_entry((image_name, blk_idx, offset, length))
+            shutil.rmtree(os.path.join(self._root, image_name,
+                                       str(blk_idx)), True)
+        finally:
+            self._lock.release()
+
+    def _load(self):
+        # must be called with self._lock held.  locks the directory
+        # and reads the list of the cached pieces at the first call.
+        # returns False if the cache cannot be used.
+        if self._loaded:
+            return (self._lock_fh is not None)
+        self._loaded = True
+        try:
+            if not os.path.exists(self._root):
+                os.makedirs(self._root)
+            fh = open(os.path.join(self._root, 'lock'), 'w')
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                fh.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                print 'The disk cache at %s is used by another process' % self._root
+                return (False)
+            self._lock_fh = fh
+            pieces = []
+            for image_name in os.listdir(self._root):
+                image_path = os.path.join(self._root, image_name)
+                if not os.path.isdir(image_path):
+                    continue
+                for blk_name in os.listdir(image_path):
+                    blk_path = os.path.join(image_path, blk_name)
+                    if not os.path.isdir(blk_path):
+                        continue
+                    for piece_name in os.listdir(blk_path):
+                        piece_path = os.path.join(blk_path, piece_name)
+                        try:
+                            (offset, length) = [int(value) for value
+                                                in piece_name.split('.')]
+                            st = os.stat(piece_path)
+                        except (ValueError, OSError):
+                            # an incomplete file.
+                            os.unlink(piece_path)
+                            continue
+                        if st.st_size != length:
+                            os.unlink(piece_path)
+                            continue
+                        pieces.append((st.st_mtime,
+                                       (image_name, int(blk_name),
+                                        offset, length)))
+        except (IOError, OSError), e:
+            print e.__class__
+            print 'Failed to load the disk cache at %s' % self._root
+            return (False)
+        pieces.sort()
+        for (mtime, key) in pieces:
+            self._add_entry(key)
+        self._evict()
+        return (True)
+
+    def _read_epoch(self, image_name):
+        try:
+            fh = open(os.path.join(self._root, image_name, 'epoch'), 'r')
+            try:
+                return (int(fh.read()))
+            finally:
+                fh.close()
+        except (IOError, ValueError):
+            return (None)
+
+    def _write_epoch(self, image_name, epoch):
+        image_path = os.path.join(self._root, image_name)
+        try:
+            if not os.path.exists(image_path):
+                os.makedirs(image_path)
+            fh = open(os.path.join(image_path, 'epoch.tmp'), 'w')
+            try:
+                fh.write(str(epoch))
+            finally:
+                fh.close()
+            os.rename(os.path.join(image_path, 'epoch.tmp'),
+                      os.path.join(image_path, 'epoch'))
+        except (IOError, OSError), e:
+            print e.__class__
+            print 'Failed to write the disk cache at %s' % image_path
+
+    def _remove_pending(self, image_name, blk_idx=None):
+        # must be called with self._lock held.
+        for key in [key for key in self._pending
+                    if key[0] == image_name
+                    and (blk_idx is None or key[1] == blk_idx)]:
+            self._pending_size -= len(self._pending.pop(key))
+
+    def _remove_image(self, image_name):
+        # must be called with self._lock held.
+        self._remove_pending(image_name)
+        for key in [key for key in self._entries
+                    if key[0] == image_name]:
+            self._remove_entry(key)
+        shutil.rmtree(os.path.join(self._root, image_name), True)
+
+    def _piece_path(self, key):
+        return (os.path.join(self._root, key[0], str(key[1]),
+                             '%d.%d' % key[2:]))
+
+    def _add_entry(self, key):
+        # must be called with self._lock held.
+        self._entries[key] = None
+        self._ranges.setdefault(key[:2], set()).add(key[2:])
+        self._used += key[3]
+
+    def _remove_entry(self, key):
+        # must be called with self._lock held.
+        if key not in self._entries:
+            return
+        del self._entries[key]
+        self._used -= key[3]
+        ranges = self._ranges[key[:2]]
+        ranges.discard(key[2:])
+        if not ranges:
+            del self._ranges[key[:2]]
+
+    def _evict(self):
+        # must be called with self._lock held.
+        evicted = []
+        while self._used > self._size and self._entries:
+            key = next(iter(self._entries))
+            self._remove_entry(key)
+            try:
+                os.unlink(self._piece_path(key))
+            except OSError:
+                pass
+            evicted.append(key[0])
+        return (evicted)
+
+class UKAIBlockCache(object):
+    '''
+    The UKAIBlockCache class keeps pieces of block data keyed by the
+    image name, the block index, and the range in the block.  When
+    the total size of the cached data exceeds the limit, the least
+    recently used pieces are evicted.
+
+    If a disk cache is specified, the pieces are also stored in the
+    disk cache, and pieces not found in memory are looked up there.
+    '''
+    def __init__(self, size=UKAI_CACHE_SIZE_DEFAULT, disk_cache=None):
+        '''
+        Initializes the cache.
+
+        size: The maximum amount of cached data in bytes.
+        disk_cache: an UKAIDiskCache instance used as the second
+            level of the cache, or None.
+
+        Return values: This function does not return any values.
+        '''
+        self._size = size
+        self._used = 0
+        # (image, block index, offset, length) -> data, ordered from
+        # the least recently used one.
+        self._entries = OrderedDict()
+        # (image, block index) -> a set of (offset, length) pairs.
+        self._ranges = {}
+        self._disk_cache = disk_cache
+        self._lock = threading.Lock()
+
+    def configure(self, config):
+        '''
+        Updates the size of the cache from the cache_size
+        configuration value, and configures the disk cache.
+
+        config: an UKAIConfig instance.
+
+        Return values: This function does not return any values.
+        '''
+        if config.get('cache_size') is not None:
+            self._size = int(config.get('cache_size'))
+        try:
+            self._lock.acquire()
+            evicted = self._evict()
+        finally:
+            self._lock.release()
+        _notify_evictions(evicted)
+        if self._disk_cache is not None:
+            self._disk_cache.configure(config)
+
+    @property
+    def enabled(self):
+        '''
+        True if the cache can keep any data.
+        '''
+        return (self._size > 0
+                or (self._disk_cache is not None
+                    and self._disk_cache.enabled))
+
+    def validate(self, image_name, epoch):
+        '''
+        Starts caching the data of the image.  The data cached in
+        memory is discarded, and the data cached on disk is discarded
+        if it was cached in a different epoch.
+
+        epoch: the current epoch of the image.
+        '''
+        self._invalidate_memory(image_name)
+        if self._disk_cache is not None:
+            self._disk_cache.validate(image_name, epoch)
+
+    def renew(self, image_name, epoch):
+        '''
+        Changes the epoch of the image keeping the cached data.  This
+        is used when this node changes the epoch.
+
+        epoch: the new epoch of the image.
+        '''
+        if self._disk_cache is not None:
+            self._disk_cache.renew(image_name, epoch)
+
+    def release(self, image_name):
+        '''
+        Stops caching the data of the image.  The data cached in
+        memory is discarded, and the data cached on disk is kept.
+        '''
+        self._invalidate_memory(image_name)
+        if self._disk_cache is not None:
+            self._disk_cache.release(image_name)
+
+    def get(self, image_name, blk_idx, off_in_blk, size_in_blk):
+        '''
+        Returns the cached data of the specified range, or None if
+        the range is not cached.  A cached range which contains the
+        specified range is also used.
+        '''
+        data = self._get_memory(image_name, blk_idx, off_in_blk,
+                                size_in_blk)
+        if data is not None or self._disk_cache is None:
+            return (data)
+        data = self._disk_cache.get(image_name, blk_idx, off_in_blk,
+                                    size_in_blk)
+        if data is not None:
+            if image_name in UKAIStatistics:
+                UKAIStatistics[image_name].disk_cache_op()
+            self._put_memory(image_name, blk_idx, off_in_blk, data)
+        return (data)
+
+    def contains(self, image_name, blk_idx, off_in_blk, size_in_blk):
+        '''
+        Returns True if the specified range is cached in memory or on
+        disk.  Unlike get(), the data cached on disk is not copied to
+        memory, so this can be called without the block locks.
+        '''
+        try:
+            self._lock.acquire()
+            if _covering_range(self._ranges.get((image_name, blk_idx)),
+                               off_in_blk, size_in_blk) is not None:
+                return (True)
+        finally:
+            self._lock.release()
+        return (self._disk_cache is not None
+                and self._disk_cache.contains(image_name, blk_idx,
+                                              off_in_blk, size_in_blk))
+
+    def _get_memory(self, image_name, blk_idx, off_in_blk, size_in_blk):
+        try:
+            self._lock.acquire()
+            ranges = self._ranges.get((image_name, blk_idx))
+            if not ranges:
+                return (None)
+            if (off_in_blk, size_in_blk) in ranges:
+                key = (image_name, blk_idx, off_in_blk, size_in_blk)
+                data = self._entries.pop(key)
+                self._entries[key] = data
+                return (data)
+            found = _covering_range(ranges, off_in_blk, size_in_blk)
+            if found is None:
+                return (None)
+            key = (image_name, blk_idx) + found
+            data = self._entries.pop(key)
+            self._entries[key] = data
+            start = off_in_blk - found[0]
+            return (data[start:start + size_in_blk])
+        finally:
+            self._lock.release()
+
+    def put(self, image_name, blk_idx, off_in_blk, data):
+        '''
+        Stores the data of the specified range.  Data larger than the
+        cache itself is not stored.
+        '''
+        self._put_memory(image_name, blk_idx, off_in_blk, data)
+        if self._disk_cache is not None and self._disk_cache.enabled:
+            self._disk_cache.put(image_name, blk_idx, off_in_blk, data)
+
+    def _put_memory(self, image_name, blk_idx, off_in_blk, data):
+        if len(data) > self._size:
+            return
+        key = (image_name, blk_idx, off_in_blk, len(data))
+        try:
+            self._lock.acquire()
+            if key in self._entries:
+                self._used -= len(self._entries.pop(key))
+            self._entries[key] = data
+            self._ranges.setdefault((image_name, blk_idx),
+                                    set()).add((off_in_blk, len(data)))
+            self._used += len(data)
+            evicted = self._evict()
+        finally:
+            self._lock.release()
+        _notify_evictions(evicted)
+
+    def invalidate(self, image_name, blk_idx=None):
+        '''
+        Removes the cached data of the specified block, or all the
+        blocks of the image if blk_idx is None.
+        '''
+        self._invalidate_memory(image_name, blk_idx)
+        if self._disk_cache is not None:
+            self._disk_cache.invalidate(image_name, blk_idx)
+
+    def _invalidate_memory(self, image_name, blk_idx=None):
+        try:
+            self._lock.acquire()
+            if blk_idx is None:
+                keys = [key for key in self._ranges
+                        if key[0] == image_name]
+            else:
+                keys = [(image_name, blk_idx)]
+            for key in keys:
+                ranges = self._ranges.pop(key, None)
+                if ranges is None:
+                    continue
+                for (offset, length) in ranges:
+                    data = self._entries.pop(key + (offset, length))
+                    self._used -= len(data)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        '''
+        Removes all the data cached in memory.
+        '''
+        try:
+            self._lock.acquire()
+            self._entries = OrderedDict()
+            self._ranges = {}
+            self._used = 0
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        # must be called with self._lock held.
+        evicted = []
+        while self._used > self._size and self._entries:
+            (key, data) = self._entries.popitem(last=False)
+            self._used -= len(data)
+            ranges = self._ranges[key[:2]]
+            ranges.discard(key[2:])
+            if not ranges:
+                del self._ranges[key[:2]]
+            evicted.append(key[0])
+        return (evicted)
+
+# The disk cache and the block cache shared by all the images in a
+# process.
+ukai_disk_cache = UKAIDiskCache()
+ukai_block_cache = UKAIBlockCache(disk_cache=ukai_disk_cache)
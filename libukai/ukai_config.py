@@ -38,9 +38,12 @@ core_port: the port number of the UKAICore service
 '''
 
 import json
+import os
 import re
 
-UKAI_CONFIG_FILE_DEFAULT = '/etc/ukai/config'
+# the UKAI_CONFIG environment variable overrides the location of the
+# configuration file.
+UKAI_CONFIG_FILE_DEFAULT = os.environ.get('UKAI_CONFIG', '/etc/ukai/config')
 
 comment_re = re.compile('^\s*#.*$', re.MULTILINE)
 
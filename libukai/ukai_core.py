@@ -33,6 +33,7 @@ filesystem core operations.
 import errno
 import json
 import os
+import random
 import stat
 import sys
 import threading
@@ -40,19 +41,28 @@ import zlib
 import subprocess
 import re
 
+from ukai_cache import ukai_block_cache
 from ukai_config import UKAIConfig
 from ukai_data import UKAIData
 from ukai_data import ukai_data_destroy, ukai_data_location_destroy
+from ukai_data import ukai_data_pull
 from ukai_db import ukai_db_client
 from ukai_local_io import ukai_local_read, ukai_local_write
+from ukai_local_io import ukai_local_readv, ukai_local_writev
 from ukai_local_io import ukai_local_allocate_dataspace
+from ukai_local_io import ukai_local_checksums
 from ukai_local_io import ukai_local_destroy_image
 from ukai_metadata import UKAIMetadata, UKAI_OUT_OF_SYNC
 from ukai_metadata import ukai_metadata_create, ukai_metadata_destroy
+from ukai_metadata import ukai_metadata_update_local_peer
 from ukai_node_error_state import UKAINodeErrorStateSet
+from ukai_node_latency import UKAINodeLatencySet
 from ukai_rpc import UKAIXMLRPCTranslation
 from ukai_rpc import UKAIXMLRPCCall
+from ukai_rpc import ukai_rpc_pool
 from ukai_statistics import UKAIStatistics, UKAIImageStatistics
+from ukai_sync import UKAISyncService
+from ukai_throttle import ukai_sync_throttle
 
 # XXX Fix this
 lock = threading.Lock()
@@ -106,12 +116,28 @@ class UKAICore(object):
         self._data_dict = {}
         self._config = config
         self._node_error_state_set = UKAINodeErrorStateSet()
+        self._node_latency_set = UKAINodeLatencySet(config)
         self._rpc_trans = UKAIXMLRPCTranslation()
         self._writers = UKAIWriters()
         self._open_count = UKAIOpenImageCount()
         self._fh = 0
+        self._sync_service = None
+        # the images synchronized but not opened on this node ->
+        # (UKAIMetadata, UKAIData) pairs.
+        self._sync_images = {}
+        ukai_rpc_pool.configure(self._config)
+        ukai_block_cache.configure(self._config)
+        ukai_sync_throttle.configure(self._config)
         ukai_db_client.connect(self._config)
 
+    def start_sync_service(self):
+        ''' Starts synchronizing out-of-sync blocks in the background.
+        The jobs left at the last run are resumed.
+        '''
+        self._sync_service = UKAISyncService(self._config,
+                                             self._get_sync_image)
+        self._sync_service.start()
+
     ''' Filesystem I/O processing.
     '''
     def getattr(self, path):
@@ -122,7 +148,7 @@ class UKAICore(object):
                       st_mtime=0, st_atime=0, st_nlink=2)
         else:
             image_name = path[1:]
-            metadata = self._get_metadata(image_name)
+            metadata = self._get_metadata_header(image_name)
             if metadata is not None:
                 st = dict(st_mode=(stat.S_IFREG | 0644), st_ctime=0,
                           st_mtime=0, st_atime=0, st_nlink=1,
@@ -132,22 +158,42 @@ class UKAICore(object):
         return ret, json.dumps(st)
 
     def open(self, path, flags):
+      epoch = None
       try:
           lock.acquire()
           ret = 0
           image_name = path[1:]
-          metadata = self._get_metadata(image_name)
+          metadata = self._get_metadata_header(image_name)
           if metadata is None:
               return errno.ENOENT, None
           self._fh += 1
+          fh = self._fh
           if (flags & 3) != os.O_RDONLY:
-              if self._writers.add_writer(image_name, self._fh) == errno.EBUSY:
+              if self._writers.add_writer(image_name, fh) == errno.EBUSY:
                   return errno.EBUSY, None
           if self._open_count.increment(image_name) == 1:
               self._add_image(image_name)
-          return 0, self._fh
+          if (flags & 3) != os.O_RDONLY:
+              # the data cached by the other nodes becomes stale
+              # once the image is written here.
+              metadata = self._metadata_dict[image_name]
+              metadata.epoch = random.getrandbits(31)
+              epoch = metadata.epoch
       finally:
           lock.release()
+      if epoch is not None:
+          # the new epoch must be stored before the image is written.
+          # the flush waits for the other metadata writes, so it is
+          # done without the lock.
+          try:
+              metadata.flush()
+          except IOError:
+              # reported by the flusher already.  the image must not
+              # stay open for writing.
+              self.release(path, fh)
+              return errno.EIO, None
+          ukai_block_cache.renew(image_name, epoch)
+      return 0, fh
 
     def release(self, path, fh):
       try:
@@ -205,23 +251,40 @@ class UKAICore(object):
     def _get_metadata(self, image_name):
         return ukai_db_client.get_metadata(image_name)
 
+    def _get_metadata_header(self, image_name):
+        return ukai_db_client.get_metadata_header(image_name)
+
     def _add_image(self, image_name):
         assert image_name not in self._metadata_dict
-        metadata = UKAIMetadata(image_name, self._config)
+        if image_name in self._sync_images:
+            # the synchronization jobs of the image keep using the
+            # same instances.
+            (metadata, data) = self._sync_images.pop(image_name)
+        else:
+            metadata = UKAIMetadata(image_name, self._config)
+            data = UKAIData(metadata=metadata,
+                            node_error_state_set=self._node_error_state_set,
+                            config=self._config,
+                            node_latency_set=self._node_latency_set)
         ukai_db_client.join_reader(image_name, self._config.get('id'))
         self._metadata_dict[image_name] = metadata
-        data = UKAIData(metadata=metadata,
-                        node_error_state_set=self._node_error_state_set,
-                        config=self._config)
         self._data_dict[image_name] = data
         UKAIStatistics[image_name] = UKAIImageStatistics()
+        # the image may have been written by another node since it
+        # was used on this node last time.
+        ukai_block_cache.validate(image_name, metadata.epoch)
 
     def _remove_image(self, image_name):
         assert image_name in self._metadata_dict
         ukai_db_client.leave_reader(image_name, self._config.get('id'))
+        if (self._sync_service is not None
+            and self._sync_service.has_running_jobs(image_name)):
+            self._sync_images[image_name] = (
+                self._metadata_dict[image_name], self._data_dict[image_name])
         del self._metadata_dict[image_name]
         del self._data_dict[image_name]
         del UKAIStatistics[image_name]
+        ukai_block_cache.release(image_name)
 
     def _exists(self, image_name):
         if image_name not in self._metadata_dict:
@@ -308,6 +371,53 @@ class UKAICore(object):
         return ukai_local_write(image_name, block_size, block_index,
                                 offset, data, self._config)
 
+    def proxy_readv(self, image_name, str_block_size, str_pieces):
+        ''' Reads multiple pieces of data at once.  str_pieces is a
+        list of [block index, offset, size] lists whose values are
+        strings.  The concatenated data of all the pieces is returned.
+        '''
+        block_size = int(str_block_size)
+        pieces = [(int(blk), int(off), int(size))
+                  for (blk, off, size) in str_pieces]
+        data = ukai_local_readv(image_name, block_size, pieces,
+                                self._config)
+        return self._rpc_trans.encode(zlib.compress(data))
+
+    def proxy_writev(self, image_name, str_block_size, str_pieces,
+                     encoded_data):
+        ''' Writes multiple pieces of data at once.  str_pieces is the
+        same format as the proxy_readv method, and encoded_data is the
+        concatenated data of all the pieces.
+        '''
+        block_size = int(str_block_size)
+        pieces = [(int(blk), int(off), int(size))
+                  for (blk, off, size) in str_pieces]
+        data = zlib.decompress(self._rpc_trans.decode(encoded_data))
+        return ukai_local_writev(image_name, block_size, pieces, data,
+                                 self._config)
+
+    def proxy_checksums(self, image_name, str_block_size, str_block_index,
+                        str_chunk_size):
+        ''' Returns the list of the checksums of each chunk of a
+        block, or an empty list if the block is not allocated.
+        '''
+        return ukai_local_checksums(image_name, int(str_block_size),
+                                    int(str_block_index),
+                                    int(str_chunk_size), self._config)
+
+    def proxy_pull(self, image_name, str_block_size, str_block_index,
+                   source, str_extents, throttle=True):
+        ''' Copies ranges of a block from the source node to the
+        local store.  str_extents is a list of [start, end] lists
+        whose values are strings.  The transfers are limited by the
+        synchronization throttle of this node unless throttle is
+        False.  The size of the copied data is returned.
+        '''
+        extents = [(int(start), int(end)) for (start, end) in str_extents]
+        return str(ukai_data_pull(image_name, int(str_block_size),
+                                  int(str_block_index), source, extents,
+                                  self._config, throttle))
+
     def proxy_allocate_dataspace(self, image_name, block_size, block_index):
         return ukai_local_allocate_dataspace(image_name, block_size,
                                              block_index, self._config)
@@ -316,21 +426,71 @@ class UKAICore(object):
         return ukai_local_deallocate_dataspace(image_name, block_index,
                                                self._config)
 
-    def proxy_update_metadata(self, image_name, encoded_metadata):
+    def proxy_update_metadata(self, image_name, encoded_metadata,
+                              relay=True):
         metadata_raw = json.loads(zlib.decompress(self._rpc_trans.decode(
                     encoded_metadata)))
+        self._update_metadata(image_name, metadata_raw)
+
+        if relay is True:
+            # the other UKAI process on this node may also use the
+            # image.
+            ukai_metadata_update_local_peer(image_name, encoded_metadata,
+                                            self._config)
+        return 0
+
+    def proxy_update_metadata_delta(self, image_name, encoded_delta,
+                                    relay=True):
+        delta = json.loads(zlib.decompress(self._rpc_trans.decode(
+                    encoded_delta)))
+        changed = None
         if image_name in self._metadata_dict:
-            self._metadata_dict[image_name].metadata = metadata_raw
+            metadata = self._metadata_dict[image_name]
+            epoch = metadata.epoch
+            changed = metadata.apply_delta(delta)
+        if changed is None:
+            # some updates were missed, or the image is not known.
+            # load the whole metadata.
+            metadata_raw = ukai_db_client.get_metadata(image_name)
+            if metadata_raw is not None:
+                self._update_metadata(image_name, metadata_raw)
+        elif metadata.epoch != epoch:
+            # the image is opened for writing somewhere.
+            ukai_block_cache.validate(image_name, metadata.epoch)
+        else:
+            for blk_idx in changed:
+                ukai_block_cache.invalidate(image_name, blk_idx)
+
+        if relay is True:
+            # the other UKAI process on this node may also use the
+            # image.
+            ukai_metadata_update_local_peer(image_name, encoded_delta,
+                                            self._config,
+                                            'proxy_update_metadata_delta')
+        return 0
+
+    def _update_metadata(self, image_name, metadata_raw):
+        if image_name in self._metadata_dict:
+            metadata = self._metadata_dict[image_name]
+            if metadata.epoch != metadata_raw.get('epoch', 0):
+                # the image is opened for writing somewhere.
+                ukai_block_cache.validate(image_name,
+                                          metadata_raw.get('epoch', 0))
+            else:
+                # the locations or the sync status of the blocks
+                # may have been changed.
+                for blk_idx in metadata.get_changed_blocks(metadata_raw):
+                    ukai_block_cache.invalidate(image_name, blk_idx)
+            metadata.metadata = metadata_raw
         else:
             metadata = UKAIMetadata(image_name, self._config, metadata_raw)
             self._metadata_dict[image_name] = metadata
             self._data_dict[image_name] = UKAIData(metadata,
                                                    self._node_error_state_set,
-                                                   self._config)
+                                                   self._config,
+                                                   self._node_latency_set)
             UKAIStatistics[image_name] = UKAIImageStatistics()
 
-        return 0
-
     def proxy_destroy_image(self, image_name):
         return ukai_local_destroy_image(image_name, self._config)
 
@@ -370,6 +530,7 @@ class UKAICore(object):
 
         ukai_data_destroy(image_name, self._config)
         ukai_metadata_destroy(image_name, self._config)
+        ukai_block_cache.invalidate(image_name)
 
     def ctl_get_metadata(self, image_name):
         metadata = self._get_metadata(image_name)
@@ -437,37 +598,126 @@ class UKAICore(object):
         metadata.remove_hypervisor(hypervisor)
         return 0
 
+    def _get_sync_image(self, image_name):
+        ''' Returns the (UKAIMetadata, UKAIData) pair of the image
+        to synchronize.  The pair of an image not opened on this
+        node is kept while its synchronization jobs are running, so
+        that all the jobs of the image share one metadata instance.
+        '''
+        try:
+            lock.acquire()
+            if image_name in self._metadata_dict:
+                # the image is in use on this node.
+                return (self._metadata_dict[image_name],
+                        self._data_dict[image_name])
+            if image_name in self._sync_images:
+                return (self._sync_images[image_name])
+            for cached_image_name in self._sync_images.keys():
+                if (self._sync_service is None
+                    or not self._sync_service.has_running_jobs(
+                        cached_image_name)):
+                    del self._sync_images[cached_image_name]
+        finally:
+            lock.release()
+        # XXX need to check if no one is using this image.
+        metadata_raw = self._get_metadata(image_name)
+        if metadata_raw is None:
+            return None
+        metadata = UKAIMetadata(image_name, self._config, metadata_raw)
+        data = UKAIData(metadata, self._node_error_state_set, self._config,
+                        self._node_latency_set)
+        try:
+            lock.acquire()
+            if image_name in self._metadata_dict:
+                return (self._metadata_dict[image_name],
+                        self._data_dict[image_name])
+            # another thread may have loaded the image meanwhile.
+            return (self._sync_images.setdefault(image_name,
+                                                 (metadata, data)))
+        finally:
+            lock.release()
+
     def ctl_synchronize(self, image_name, start_index=0, end_index=-1,
                         verbose=False):
-        metadata = None
-        if image_name in self._metadata_dict:
-            # the image is in use on this node.
-            metadata = self._metadata_dict[image_name]
-            data = self._data_dict[image_name]
-        else:
-            # XXX need to check if no one is using this image.
-            metadata_raw = self._get_metadata(image_name)
-            if metadata_raw is None:
-                return errno.ENOENT
-            metadata = UKAIMetadata(image_name, self._config, metadata_raw)
-            data = UKAIData(metadata, self._node_error_state_set, self._config)
+        image = self._get_sync_image(image_name)
+        if image is None:
+            return errno.ENOENT
+        (metadata, data) = image
         if end_index == -1:
             end_index = (metadata.size / metadata.block_size) - 1
+        modified = False
         for block_index in range(start_index, end_index + 1):
             if verbose is True:
                 print 'Syncing block %d (from %d to %d)' % (block_index,
                                                             start_index,
                                                             end_index)
             if data.synchronize_block(block_index) is True:
-                metadata.flush()
+                # blocks synchronized in a short period are written
+                # at once.
+                metadata.flush(wait=False)
+                modified = True
+        if modified is True:
+            metadata.flush()
         return 0
 
+    def ctl_submit_synchronize(self, image_name, start_index=0,
+                               end_index=-1):
+        ''' Adds a background synchronization job.  The job id is
+        returned.
+        '''
+        if self._sync_service is None:
+            return errno.ENOSYS, None
+        job_id = self._sync_service.submit(image_name, start_index,
+                                           end_index)
+        if job_id is None:
+            return errno.ENOENT, None
+        return 0, job_id
+
+    def ctl_get_synchronize_status(self, job_id=None):
+        ''' Returns the list of the status of the background
+        synchronization jobs, or the specified job.
+        '''
+        if self._sync_service is None:
+            return errno.ENOSYS, None
+        return 0, self._sync_service.get_status(job_id)
+
+    def ctl_cancel_synchronize(self, job_id):
+        if self._sync_service is None:
+            return errno.ENOSYS
+        if self._sync_service.cancel(job_id) is False:
+            return errno.ENOENT
+        return 0
+
+    def ctl_set_sync_throttle(self, str_rate, str_iops, image_name=None):
+        ''' Changes the limits of synchronization transfers of this
+        node, or the specified image.  The rate is in bytes per
+        second, and 0 means unlimited.
+        '''
+        ukai_sync_throttle.set_limit(int(str_rate), int(str_iops),
+                                     image_name)
+        return 0
+
+    def ctl_get_sync_throttle(self):
+        limits = ukai_sync_throttle.get_limits()
+        # the rates may not fit in XML-RPC integers.
+        limits['rate'] = str(limits['rate'])
+        for image_name in limits['images']:
+            limits['images'][image_name]['rate'] = str(
+                limits['images'][image_name]['rate'])
+        return limits
+
     def ctl_get_node_error_state_set(self):
         return self._node_error_state_set.get_list()
 
+    def ctl_get_node_latency_set(self):
+        return self._node_latency_set.get_list()
+
     def ctl_get_image_names(self):
         return ukai_db_client.get_image_names()
 
+    def ctl_get_rpc_pool_stats(self):
+        return ukai_rpc_pool.get_stats()
+
     def ctl_diag(self):
         print self._open_count._images
         print self._writers._images
@@ -30,22 +30,72 @@
 image data of a UKAI virtual disk image.
 '''
 
+import array
+import errno
 import os
 import sys
 import threading
+import time
 import zlib
 import xmlrpclib
+from multiprocessing.pool import ThreadPool
 
 import netifaces
 
+from ukai_binary_rpc import UKAIBinaryRPCCall, UKAIBinaryRPCRequest
+from ukai_binary_rpc import UKAI_DATA_TRANSPORT_BINARY
+from ukai_binary_rpc import ukai_data_transport, ukai_data_port
+from ukai_cache import ukai_block_cache
 from ukai_config import UKAIConfig
 from ukai_local_io import ukai_local_read, ukai_local_write, ukai_local_allocate_dataspace
-from ukai_metadata import UKAIMetadata
+from ukai_local_io import ukai_local_readv, ukai_local_writev
+from ukai_local_io import ukai_local_checksums
+from ukai_metadata import UKAIMetadata, UKAIStripedLock
 from ukai_metadata import UKAI_IN_SYNC, UKAI_SYNCING, UKAI_OUT_OF_SYNC
 from ukai_rpc import UKAIXMLRPCCall, UKAIXMLRPCTranslation
 from ukai_statistics import UKAIStatistics
+from ukai_throttle import ukai_sync_throttle
 from ukai_utils import UKAIIsLocalNode
 from ukai_node_error_state import UKAINodeErrorStateSet
+from ukai_node_latency import UKAINodeLatencySet
+
+UKAI_IO_WORKERS_DEFAULT = 16
+# A read is hedged when it takes longer than this percentile of the
+# recent latency of the node.
+UKAI_HEDGE_PERCENTILE_DEFAULT = 95
+# Readahead starts after this number of sequential reads.
+UKAI_READAHEAD_TRIGGER = 2
+# The minimum and maximum size of the readahead window in bytes.
+UKAI_READAHEAD_MIN_DEFAULT = 256 * 1024
+UKAI_READAHEAD_MAX_DEFAULT = 4 * 1024 * 1024
+# The readahead window covers the data read by the stream in this
+# number of seconds at the observed throughput.
+UKAI_READAHEAD_TIME_DEFAULT = 1.0
+# The size of the chunks compared by checksums when a block is
+# synchronized in the checksum mode.
+UKAI_SYNC_CHUNK_SIZE_DEFAULT = 256 * 1024
+# The size of each transfer when a node copies a block from another
+# node.
+UKAI_SYNC_TRANSFER_SIZE = 4 * 1024 * 1024
+
+_io_pool = None
+_io_pool_lock = threading.Lock()
+
+def ukai_data_io_pool(config):
+    '''
+    Returns the thread pool used to access multiple nodes
+    concurrently.  The pool is created when the function is called for
+    the first time, with the number of threads specified by the
+    io_workers configuration value.
+    '''
+    global _io_pool
+    with _io_pool_lock:
+        if _io_pool is None:
+            workers = UKAI_IO_WORKERS_DEFAULT
+            if config.get('io_workers') is not None:
+                workers = config.get('io_workers')
+            _io_pool = ThreadPool(workers)
+    return (_io_pool)
 
 def ukai_data_create(meta, config):
     '''The ukai_data_create function creates data files of a virtual
@@ -75,11 +125,9 @@ def ukai_data_destroy(image_name, config):
     param config: an UKAIConfig instance
     '''
     metadata = UKAIMetadata(image_name, config)
-    blocks = metadata.blocks
     location_set = set()
-    for n in blocks:
-        for location in n.keys():
-            location_set.add(location)
+    for blk_idx in range(0, metadata.num_blocks):
+        location_set.update(metadata.get_locations(blk_idx))
     for location in location_set:
         rpc_call = UKAIXMLRPCCall(location, config.get('core_port'))
         # XXX handle rpc error.
@@ -99,25 +147,117 @@ def ukai_data_location_destroy(image_name, location, config):
     rpc_call.call('proxy_destroy_image', image_name)
     return 0
 
+def ukai_data_pull(image_name, block_size, block_index, source, extents,
+                   config, throttle=True):
+    ''' The ukai_data_pull function copies the specified ranges of a
+    block from the source node to the local store.  The data is
+    transferred in UKAI_SYNC_TRANSFER_SIZE pieces, each of which is
+    limited by the synchronization throttle.
+
+    param image_name: the name of a virtual disk image
+    param block_size: the block size of the virtual disk image
+    param block_index: the index of the block
+    param source: the address of the node which has the data
+    param extents: a list of [start, end) offset pairs in the block
+    param config: an UKAIConfig instance
+    param throttle: if False, the transfer is not throttled
+
+    Return values: the size of the copied data.
+    '''
+    copied = 0
+    for (start, end) in extents:
+        for offset in range(start, end, UKAI_SYNC_TRANSFER_SIZE):
+            size = min(UKAI_SYNC_TRANSFER_SIZE, end - offset)
+            if throttle is True:
+                ukai_data_throttle(image_name, [[offset, offset + size]])
+            if (ukai_data_transport(source, config)
+                == UKAI_DATA_TRANSPORT_BINARY):
+                rpc_call = UKAIBinaryRPCCall(
+                    source, ukai_data_port(config),
+                    config.get('data_compress') is True,
+                    config.get('data_timeout'))
+                data = rpc_call.read(image_name, block_size,
+                                     block_index, offset, size)
+            else:
+                rpc_call = UKAIXMLRPCCall(source, config.get('core_port'),
+                                          config.get('data_timeout'))
+                encoded_data = rpc_call.call('proxy_read', image_name,
+                                             str(block_size),
+                                             str(block_index),
+                                             str(offset), str(size))
+                data = zlib.decompress(
+                    UKAIXMLRPCTranslation().decode(encoded_data))
+            copied += ukai_local_write(image_name, block_size,
+                                       block_index, offset, data, config)
+    return copied
+
+def ukai_data_throttle(image_name, extents):
+    ''' The ukai_data_throttle function waits until the transfers
+    of the specified ranges of a block are allowed by the
+    synchronization throttle.  Each UKAI_SYNC_TRANSFER_SIZE piece is
+    counted as one transfer.
+
+    param image_name: the name of a virtual disk image
+    param extents: a list of [start, end) offset pairs in the block
+
+    Return values: This function does not return any values.
+    '''
+    for (start, end) in extents:
+        for offset in range(start, end, UKAI_SYNC_TRANSFER_SIZE):
+            ukai_sync_throttle.consume(image_name,
+                                       min(UKAI_SYNC_TRANSFER_SIZE,
+                                           end - offset))
+
+class UKAIDataRequest(UKAIBinaryRPCRequest):
+    '''
+    The UKAIDataRequest class represents an operation running in the
+    I/O thread pool.  The interface is the same as the request of the
+    binary data transport.  An exception raised by the operation is
+    raised again by the wait() method.
+    '''
+    def __init__(self, io_pool, func, args):
+        UKAIBinaryRPCRequest.__init__(self)
+        io_pool.apply_async(self._run, (func, args))
+
+    def _run(self, func, args):
+        try:
+            result = func(*args)
+        except Exception, e:
+            self.complete(error=e)
+            return
+        self.complete(result=result)
+
 class UKAIData(object):
     '''
     The UKAIData class provides manipulation functions to modify the
     disk image contents.
     '''
 
-    def __init__(self, metadata, node_error_state_set, config):
+    def __init__(self, metadata, node_error_state_set, config,
+                 node_latency_set=None):
         '''
         Initializes the instance with the specified metadata object
-        created with the UKAIMetadata class.
+        created with the UKAIMetadata class.  The node_latency_set
+        argument is a UKAINodeLatencySet instance shared with other
+        images.  If not specified, a new instance is used.
         '''
         self._metadata = metadata
         self._node_error_state_set = node_error_state_set
         self._config = config
+        self._node_latency_set = node_latency_set
+        if self._node_latency_set is None:
+            self._node_latency_set = UKAINodeLatencySet(config)
         self._rpc_trans = UKAIXMLRPCTranslation()
-        # Lock objects per block index.
-        self._lock = []
-        for blk_idx in range(0, len(metadata.blocks)):
-            self._lock.append(threading.Lock())
+        # Lock objects of the blocks.
+        self._lock = UKAIStripedLock(metadata.num_blocks, config)
+        # The generation of each block is incremented before and
+        # after the block is written, so that data prefetched before
+        # or during the write is not stored in the cache.
+        self._generation = array.array('L', [0]) * metadata.num_blocks
+        self._generation_lock = threading.Lock()
+        # The state of the sequential access detector.
+        self._stream = None
+        self._stream_lock = threading.Lock()
 
     def _gather_pieces(self, offset, size):
         '''
@@ -159,6 +299,22 @@ class UKAIData(object):
                                    self._metadata.block_size))
         return (pieces)
 
+    def _acquire_lock(self, pieces):
+        '''
+        Acquires the lock objects of the metadata and the data of the
+        blocks of the pieces.
+        '''
+        self._metadata.acquire_lock(pieces[0][0], pieces[-1][0])
+        self._lock.acquire(pieces[0][0], pieces[-1][0])
+
+    def _release_lock(self, pieces):
+        '''
+        Releases the lock objects acquired by the _acquire_lock
+        method.
+        '''
+        self._lock.release(pieces[0][0], pieces[-1][0])
+        self._metadata.release_lock(pieces[0][0], pieces[-1][0])
+
     def read(self, size, offset):
         '''
         Reads size bytes from the specified location in the disk image
@@ -168,6 +324,7 @@ class UKAIData(object):
         assert size > 0
         assert offset >= 0
 
+        start = time.time()
         if offset >= self._metadata.used_size:
             # end of the file.
             return ('')
@@ -175,39 +332,92 @@ class UKAIData(object):
             # shorten the size not to overread the end of the file.
             size = self._metadata.used_size - offset
 
-        data = ''
+        # the pieces are copied to their positions as they arrive.
+        data = bytearray(size)
+        data_offset = 0
         partial_data = ''
         metadata_flush_required = False
         pieces = self._gather_pieces(offset, size)
         # read operation statistics.
         UKAIStatistics[self._metadata.name].read_op(pieces)
         try:
-            for piece in pieces:
-                self._metadata._lock[piece[0]].acquire() # XXX
-                self._lock[piece[0]].acquire()
+            self._acquire_lock(pieces)
 
-            for piece in pieces:
+            # Group the pieces by the node to read from, so that each
+            # node is accessed with one vectored read.  Requests to
+            # all the remote nodes are sent at once, so that they are
+            # processed in parallel while the local node is read.
+            # Pieces of remote blocks may be found in the block cache.
+            vectors = {}
+            cached = {}
+            for piece_idx in range(0, len(pieces)):
+                (blk_idx, off_in_blk, size_in_blk) = pieces[piece_idx]
+                candidate = self._find_read_candidate(blk_idx)
+                if candidate is None:
+                    continue
+                if (ukai_block_cache.enabled
+                    and not UKAIIsLocalNode(candidate)):
+                    cached_data = ukai_block_cache.get(self._metadata.name,
+                                                       blk_idx,
+                                                       off_in_blk,
+                                                       size_in_blk)
+                    UKAIStatistics[self._metadata.name].cache_op(
+                        cached_data is not None)
+                    if cached_data is not None:
+                        cached[piece_idx] = cached_data
+                        continue
+                if candidate not in vectors:
+                    vectors[candidate] = {'pieces': [],
+                                          'request': None,
+                                          'sent': None,
+                                          'data': None}
+                vectors[candidate]['pieces'].append(piece_idx)
+            for node in vectors:
+                vectors[node]['sent'] = time.time()
+                vectors[node]['request'] = self._get_datav_async(
+                    node, [pieces[i] for i in vectors[node]['pieces']])
+
+            for piece_idx in range(0, len(pieces)):
+                piece = pieces[piece_idx]
                 blk_idx = piece[0]
                 off_in_blk = piece[1]
                 size_in_blk = piece[2]
-                block = self._metadata.blocks[blk_idx]
-                data_read = False
+                data_read = piece_idx in cached
+                if data_read:
+                    partial_data = cached[piece_idx]
                 while not data_read:
                     candidate = self._find_read_candidate(blk_idx)
                     if candidate is None:
                         print 'XXX fatal.  should raise an exception.'
                     try:
-                        partial_data = self._get_data(candidate,
-                                                      blk_idx,
-                                                      off_in_blk,
-                                                      size_in_blk)
+                        if (candidate in vectors
+                            and piece_idx in vectors[candidate]['pieces']):
+                            partial_data = self._read_vector(
+                                candidate, vectors[candidate],
+                                pieces)[piece_idx]
+                        else:
+                            partial_data = self._get_data(candidate,
+                                                          blk_idx,
+                                                          off_in_blk,
+                                                          size_in_blk)
                         data_read = True
+                        if (ukai_block_cache.enabled
+                            and not UKAIIsLocalNode(candidate)):
+                            if isinstance(partial_data, memoryview):
+                                partial_data = partial_data.tobytes()
+                            ukai_block_cache.put(self._metadata.name,
+                                                 blk_idx, off_in_blk,
+                                                 partial_data)
                         break
                     except (IOError, xmlrpclib.Error), e:
                         print e.__class__
-                        self._metadata.set_sync_status(blk_idx, candidate,
-                                                       UKAI_OUT_OF_SYNC)
-                        metadata_flush_required = True
+                        if candidate in vectors:
+                            # read the rest of the pieces one by one.
+                            del vectors[candidate]
+                        # the data stored at the location is unknown.
+                        # synchronize the whole block.
+                        if self._metadata.mark_dirty(blk_idx, candidate):
+                            metadata_flush_required = True
                         self._node_error_state_set.add(candidate, 0)
                         # try to find another candidate node.
                         continue
@@ -215,29 +425,327 @@ class UKAIData(object):
                     # no node is available to get the peice of data.
                     print 'XXX fatal.  should raise an exception.'
 
-                data = data + partial_data
+                data[data_offset:data_offset + size_in_blk] = partial_data
+                data_offset = data_offset + size_in_blk
         finally:
-            for piece in pieces:
-                self._metadata._lock[piece[0]].release() # XXX
-                self._lock[piece[0]].release()
+            self._release_lock(pieces)
 
         if metadata_flush_required is True:
-            self._metadata.flush()
+            # the locations marked out of sync have not missed any
+            # write.  don't wait.
+            self._metadata.flush(wait=False)
 
-        return (data)
+        self._readahead(offset, size)
+
+        # synchronization is slowed down if reads get slow.
+        ukai_sync_throttle.foreground_op(time.time() - start)
+
+        return (str(data))
+
+    def _readahead(self, offset, size):
+        '''
+        Detects a sequential read stream, and prefetches the data
+        following the current read from remote nodes into the block
+        cache in the background.  The size of the readahead window is
+        the amount of data the stream reads in readahead_time seconds
+        at the observed throughput, bounded by readahead_min and
+        readahead_max.  The window grows at most twice at a time.  A
+        read at a different position ends the
+        stream and stops prefetching.  Readahead is disabled if the
+        readahead configuration value is false or the block cache is
+        disabled.
+
+        offset: the offset of the current read.
+        size: the size of the current read.
+        '''
+        if self._config.get('readahead') is False:
+            return
+        if not ukai_block_cache.enabled:
+            return
+        now = time.time()
+        try:
+            self._stream_lock.acquire()
+            stream = self._stream
+            if stream is None or stream['next'] != offset:
+                # a new stream, or a random access.
+                self._stream = {'start': now,
+                                'bytes': size,
+                                'reads': 1,
+                                'next': offset + size,
+                                'prefetched': offset + size,
+                                'window': 0}
+                return
+            stream['bytes'] += size
+            stream['reads'] += 1
+            stream['next'] = offset + size
+            if stream['reads'] < UKAI_READAHEAD_TRIGGER:
+                return
+            window = self._readahead_window(stream, now)
+            stream['window'] = window
+            start = max(stream['prefetched'], offset + size)
+            end = min(offset + size + window, self._metadata.used_size)
+            if end - start < window / 2:
+                # wait until a half of the window is consumed.
+                return
+            stream['prefetched'] = end
+        finally:
+            self._stream_lock.release()
+        self._prefetch(start, end - start)
+
+    def _readahead_window(self, stream, now):
+        min_window = UKAI_READAHEAD_MIN_DEFAULT
+        if self._config.get('readahead_min') is not None:
+            min_window = self._config.get('readahead_min')
+        max_window = UKAI_READAHEAD_MAX_DEFAULT
+        if self._config.get('readahead_max') is not None:
+            max_window = self._config.get('readahead_max')
+        readahead_time = UKAI_READAHEAD_TIME_DEFAULT
+        if self._config.get('readahead_time') is not None:
+            readahead_time = self._config.get('readahead_time')
+        window = max_window
+        elapsed = now - stream['start']
+        if elapsed > 0:
+            window = int(stream['bytes'] / elapsed * readahead_time)
+        window = min(window, stream['window'] * 2, max_window)
+        return (max(min_window, window))
+
+    def _prefetch(self, offset, size):
+        '''
+        Reads the specified range from remote nodes asynchronously,
+        and stores the data in the block cache.  Pieces stored at the
+        local node or cached already are skipped.
+        '''
+        vectors = {}
+        for piece in self._gather_pieces(offset, size):
+            (blk_idx, off_in_blk, size_in_blk) = piece
+            candidate = self._find_read_candidate(blk_idx)
+            if candidate is None or UKAIIsLocalNode(candidate):
+                continue
+            # get() would copy data from the disk cache to memory
+            # without the block locks, possibly after a write
+            # invalidated it.
+            if ukai_block_cache.contains(self._metadata.name, blk_idx,
+                                         off_in_blk, size_in_blk):
+                continue
+            vectors.setdefault(candidate, []).append(piece)
+        for node in vectors:
+            pieces = vectors[node]
+            try:
+                self._generation_lock.acquire()
+                generations = [self._generation[piece[0]]
+                               for piece in pieces]
+            finally:
+                self._generation_lock.release()
+            request = self._get_datav_async(node, pieces)
+            if request is None:
+                continue
+            UKAIStatistics[self._metadata.name].readahead_op(
+                sum([piece[2] for piece in pieces]))
+            request.add_done_callback(
+                self._prefetch_done_callback(request, pieces, generations))
+
+    def _prefetch_done_callback(self, request, pieces, generations):
+        def callback(error):
+            if error is not None:
+                # the data will be read when it is needed.
+                return
+            data = request.wait()
+            pos = 0
+            try:
+                self._generation_lock.acquire()
+                for (piece, generation) in zip(pieces, generations):
+                    (blk_idx, off_in_blk, size_in_blk) = piece
+                    if self._generation[blk_idx] == generation:
+                        ukai_block_cache.put(self._metadata.name, blk_idx,
+                                             off_in_blk,
+                                             data[pos:pos + size_in_blk])
+                    pos += size_in_blk
+            finally:
+                self._generation_lock.release()
+        return (callback)
+
+    def _invalidate_cache(self, blk_idx):
+        '''
+        Discards the cached data of the specified block, including
+        data being prefetched.
+        '''
+        try:
+            self._generation_lock.acquire()
+            self._generation[blk_idx] += 1
+            ukai_block_cache.invalidate(self._metadata.name, blk_idx)
+        finally:
+            self._generation_lock.release()
+
+    def _read_vector(self, node, vector, pieces):
+        '''
+        Returns a dictionary object of piece indexes and data read
+        with a vectored read.  The data of each piece is a memoryview
+        of the result to avoid copying.  The read is done (or the
+        result of the request sent in advance is received) when the
+        method is called for the first time.
+
+        node: the target node from which we read the data.
+        vector: a dictionary object which has the 'pieces' (a list of
+            piece indexes), the 'request' (a request sent in advance
+            or None), the 'sent' (the time the request was sent), and
+            the 'data' (the result) keys.
+        pieces: the list of all the pieces of the read operation.
+        '''
+        if vector['data'] is None:
+            vector_pieces = [pieces[i] for i in vector['pieces']]
+            if vector['request'] is not None:
+                request = vector['request']
+                vector['request'] = None
+                data = self._wait_request(node, request, vector['sent'],
+                                          vector_pieces)
+            else:
+                data = self._get_datav(node, vector_pieces)
+            data = memoryview(data)
+            vector['data'] = {}
+            pos = 0
+            for (piece_idx, piece) in zip(vector['pieces'], vector_pieces):
+                vector['data'][piece_idx] = data[pos:pos + piece[2]]
+                pos += piece[2]
+        return (vector['data'])
+
+    def _wait_request(self, node, request, sent, pieces):
+        '''
+        Waits for a vectored read request sent to a remote node, and
+        returns the data.  If the response is not received within
+        the data_timeout configuration value, IOError(ETIMEDOUT) is
+        raised.
+
+        If the hedge_reads configuration value is true and the node
+        doesn't respond within the hedge_percentile (default 95)
+        percentile of its recent latency, the same pieces are
+        requested from another in-sync node, and the first successful
+        response is used.
+
+        node: the node to which the request was sent.
+        request: the request object.
+        sent: the time the request was sent.
+        pieces: a list of (block index, offset, size) tupples.
+        '''
+        timeout = self._config.get('data_timeout')
+        deadline = None
+        if timeout is not None:
+            deadline = sent + timeout
+        finished = threading.Event()
+        request.add_done_callback(lambda error: finished.set())
+        requests = [request]
+
+        hedge_delay = None
+        if self._config.get('hedge_reads') is True:
+            percent = self._config.get('hedge_percentile')
+            if percent is None:
+                percent = UKAI_HEDGE_PERCENTILE_DEFAULT
+            hedge_delay = self._node_latency_set.percentile(node, percent)
+        if hedge_delay is not None:
+            if not finished.wait(self._remaining(sent + hedge_delay,
+                                                 deadline)):
+                alternative = self._find_hedge_candidate(node, pieces)
+                if alternative is not None:
+                    if UKAIIsLocalNode(alternative):
+                        request.cancel()
+                        return (self._get_datav(alternative, pieces))
+                    hedge = self._get_datav_async(alternative, pieces)
+                    if hedge is not None:
+                        UKAIStatistics[self._metadata.name].hedge_op()
+                        hedge.add_done_callback(
+                            lambda error: finished.set())
+                        requests.append(hedge)
+
+        error = None
+        while True:
+            finished.clear()
+            for pending in list(requests):
+                if not pending.done():
+                    continue
+                requests.remove(pending)
+                try:
+                    data = pending.wait()
+                except (IOError, xmlrpclib.Error), e:
+                    if error is None or pending is request:
+                        error = e
+                    continue
+                for other in requests:
+                    other.cancel()
+                return (data)
+            if len(requests) == 0:
+                raise error
+            if (not finished.wait(self._remaining(None, deadline))
+                and deadline is not None and time.time() >= deadline):
+                for pending in requests:
+                    pending.cancel()
+                raise IOError(errno.ETIMEDOUT, 'read request timed out')
+
+    def _remaining(self, until, deadline):
+        # returns the seconds to wait until the earlier one of until
+        # and deadline.  None means forever.
+        if deadline is not None and (until is None or deadline < until):
+            until = deadline
+        if until is None:
+            return (None)
+        return (max(0, until - time.time()))
+
+    def _find_hedge_candidate(self, node, pieces):
+        '''
+        Returns a node other than the specified node, which has all
+        the blocks of the pieces in sync.  None is returned if no
+        such node is available.
+        '''
+        candidates = None
+        for (blk_idx, off_in_blk, size_in_blk) in pieces:
+            nodes = set()
+            for other in self._metadata.get_locations(blk_idx):
+                if other == node:
+                    continue
+                if self._node_error_state_set.is_in_failure(other) is True:
+                    continue
+                if (self._metadata.get_sync_status(blk_idx, other)
+                    != UKAI_IN_SYNC):
+                    continue
+                nodes.add(other)
+            if candidates is None:
+                candidates = nodes
+            else:
+                candidates &= nodes
+        if not candidates:
+            return (None)
+        return (self._node_latency_set.select(list(candidates)))
 
     def _find_read_candidate(self, blk_idx):
-        candidate = None
-        for node in self._metadata.blocks[blk_idx].keys():
+        '''
+        Returns the node to read the specified block from.  The local
+        node is used if it has the block in sync.  Otherwise, the
+        remote node expected to respond first is selected based on
+        the observed latency and the outstanding requests.  None is
+        returned if no node is available.
+        '''
+        candidates = []
+        for node in self._metadata.get_locations(blk_idx):
             if self._node_error_state_set.is_in_failure(node) is True:
                 continue
             if self._metadata.get_sync_status(blk_idx, node) != UKAI_IN_SYNC:
                 continue
             if UKAIIsLocalNode(node):
-                candidate = node
-                break
-            candidate = node
-        return (candidate)
+                return (node)
+            candidates.append(node)
+        return (self._node_latency_set.select(candidates))
+
+    def _measure(self, node, func, *args):
+        '''
+        Calls func with args, and records the latency of the call in
+        the node latency set.
+        '''
+        start = self._node_latency_set.begin(node)
+        try:
+            ret = func(*args)
+        except:
+            self._node_latency_set.end(node, start, True)
+            raise
+        self._node_latency_set.end(node, start)
+        return (ret)
 
     def _get_data(self, node, blk_idx, off_in_blk, size_in_blk):
         '''
@@ -260,10 +768,95 @@ class UKAIData(object):
                                          off_in_blk,
                                          size_in_blk))
         else:
-            return (self._get_data_remote(node,
-                                          blk_idx,
-                                          off_in_blk,
-                                          size_in_blk))
+            return (self._measure(node, self._get_data_remote,
+                                  node,
+                                  blk_idx,
+                                  off_in_blk,
+                                  size_in_blk))
+
+    def _get_datav(self, node, pieces):
+        '''
+        Returns the concatenated data of multiple pieces read from a
+        local store or a remote store depending on the node location.
+
+        node: the target node from which we read the data.
+        pieces: a list of (block index, offset, size) tupples.
+        '''
+        if UKAIIsLocalNode(node):
+            return (ukai_local_readv(self._metadata.name,
+                                     self._metadata.block_size,
+                                     pieces, self._config))
+        return (self._measure(node, self._get_datav_remote, node, pieces))
+
+    def _get_datav_remote(self, node, pieces):
+        '''
+        Returns the concatenated data of multiple pieces read from a
+        remote store.
+
+        node: the target node from which we read the data.
+        pieces: a list of (block index, offset, size) tupples.
+        '''
+        if (ukai_data_transport(node, self._config)
+            == UKAI_DATA_TRANSPORT_BINARY):
+            rpc_call = self._binary_call(node)
+            return rpc_call.readv(self._metadata.name,
+                                  self._metadata.block_size, pieces)
+
+        rpc_call = self._xmlrpc_call(node)
+        encoded_data = rpc_call.call('proxy_readv',
+                                     self._metadata.name,
+                                     str(self._metadata.block_size),
+                                     self._str_pieces(pieces))
+        return zlib.decompress(self._rpc_trans.decode(encoded_data))
+
+    def _get_datav_async(self, node, pieces):
+        '''
+        Sends a vectored read request to a remote store without
+        waiting for the result.  The data is returned by the wait()
+        method of the returned request object.  The binary data
+        transport sends the request by itself, and the XML-RPC
+        interface is called by a thread of the I/O thread pool.  For
+        the local node, or if the request cannot be sent, None is
+        returned.
+
+        node: the target node from which we read the data.
+        pieces: a list of (block index, offset, size) tupples.
+        '''
+        if UKAIIsLocalNode(node):
+            return (None)
+        if (ukai_data_transport(node, self._config)
+            != UKAI_DATA_TRANSPORT_BINARY):
+            return (UKAIDataRequest(ukai_data_io_pool(self._config),
+                                    self._get_datav, (node, pieces)))
+        rpc_call = self._binary_call(node)
+        start = self._node_latency_set.begin(node)
+        try:
+            request = rpc_call.readv_async(self._metadata.name,
+                                           self._metadata.block_size,
+                                           pieces)
+        except IOError:
+            self._node_latency_set.end(node, start, True)
+            # the error is handled when the pieces are read
+            # synchronously.
+            return (None)
+        request.add_done_callback(
+            lambda error: self._node_latency_set.end(node, start,
+                                                     error is not None))
+        return (request)
+
+    def _binary_call(self, node):
+        return (UKAIBinaryRPCCall(node, ukai_data_port(self._config),
+                                  self._config.get('data_compress') is True,
+                                  self._config.get('data_timeout')))
+
+    def _xmlrpc_call(self, node):
+        return (UKAIXMLRPCCall(node, self._config.get('core_port'),
+                               self._config.get('data_timeout')))
+
+    def _str_pieces(self, pieces):
+        # integers in XML-RPC are limited to 32 bits.
+        return ([[str(blk_idx), str(off_in_blk), str(size_in_blk)]
+                 for (blk_idx, off_in_blk, size_in_blk) in pieces])
 
     def _get_data_local(self, node, blk_idx, off_in_blk, size_in_blk):
         '''
@@ -285,7 +878,8 @@ class UKAIData(object):
         '''
         Returns a data read from a remote store.  The remote read
         command is sent to a remote proxy program using the XML RPC
-        mechanism.
+        mechanism, or the binary data transport if it is configured
+        for the node.
 
         node: the target node from which we read the data.
         num: the block index of the disk image.
@@ -293,8 +887,14 @@ class UKAIData(object):
             block.
         size: the length of the data to be read.
         '''
-        rpc_call = UKAIXMLRPCCall(node,
-                                  self._config.get('core_port'))
+        if (ukai_data_transport(node, self._config)
+            == UKAI_DATA_TRANSPORT_BINARY):
+            rpc_call = self._binary_call(node)
+            return rpc_call.read(self._metadata.name,
+                                 self._metadata.block_size,
+                                 blk_idx, off_in_blk, size_in_blk)
+
+        rpc_call = self._xmlrpc_call(node)
         encoded_data = rpc_call.call('proxy_read',
                                      self._metadata.name,
                                      str(self._metadata.block_size),
@@ -313,57 +913,107 @@ class UKAIData(object):
         assert offset >= 0
         assert (offset + len(data)) <= self._metadata.size
 
+        start = time.time()
         metadata_flush_required = False
+        size_changed = False
         pieces = self._gather_pieces(offset, len(data))
         # write operation statistics.
         UKAIStatistics[self._metadata.name].write_op(pieces)
         data_offset = 0
         try:
+            self._acquire_lock(pieces)
             for piece in pieces:
-                self._metadata._lock[piece[0]].acquire() # XXX
-                self._lock[piece[0]].acquire()
+                self._invalidate_cache(piece[0])
 
+            # Find the nodes to write each piece, and group the pieces
+            # by node, so that each node is accessed with one vectored
+            # write.
+            vectors = {}
             for piece in pieces:
                 blk_idx = piece[0]
                 off_in_blk = piece[1]
                 size_in_blk = piece[2]
-                block = self._metadata.blocks[blk_idx]
-                for node in block.keys():
+                for node in self._metadata.get_locations(blk_idx):
                     try:
                         if (self._node_error_state_set.is_in_failure(node)
                             is True):
-                            if (self._metadata.get_sync_status(blk_idx, node)
-                                == UKAI_IN_SYNC):
-                                self._metadata.set_sync_status(blk_idx, node,
-                                                               UKAI_OUT_OF_SYNC)
+                            # record the range to synchronize later.
+                            if self._metadata.mark_dirty(blk_idx, node,
+                                                         off_in_blk,
+                                                         size_in_blk):
                                 metadata_flush_required = True
                             continue
                         if (self._metadata.get_sync_status(blk_idx, node)
                             != UKAI_IN_SYNC):
+                            # the guest is waiting.  don't throttle.
                             self._synchronize_block(blk_idx, node)
                             metadata_flush_required = True
-                        self._put_data(node,
-                                       blk_idx,
-                                       off_in_blk,
-                                       data[data_offset:data_offset
-                                            + size_in_blk])
+                        if node not in vectors:
+                            vectors[node] = []
+                        vectors[node].append((piece, data_offset))
                     except (IOError, xmlrpclib.Error), e:
                         print e.__class__
-                        self._metadata.set_sync_status(blk_idx, node,
-                                                       UKAI_OUT_OF_SYNC)
+                        # the dirty extents are kept if the failure
+                        # happened while synchronizing them.
+                        self._metadata.mark_dirty(blk_idx, node,
+                                                  off_in_blk, size_in_blk)
                         metadata_flush_required = True
                         self._node_error_state_set.add(node, 0)
                 data_offset = data_offset + size_in_blk
+
+            # Send the data to all the nodes concurrently, so that
+            # the write completes in the time of the slowest node
+            # rather than the sum of them.  The local store is
+            # written by this thread.
+            io_pool = ukai_data_io_pool(self._config)
+            results = {}
+            for node in vectors:
+                node_pieces = [piece for (piece, data_offset)
+                               in vectors[node]]
+                node_data = ''.join([data[data_offset:data_offset
+                                          + piece[2]]
+                                     for (piece, data_offset)
+                                     in vectors[node]])
+                if UKAIIsLocalNode(node):
+                    results[node] = (node_pieces, node_data, None)
+                else:
+                    results[node] = (node_pieces, None,
+                                     io_pool.apply_async(
+                                         self._put_datav,
+                                         (node, node_pieces, node_data)))
+            for node in results:
+                (node_pieces, node_data, result) = results[node]
+                try:
+                    if result is None:
+                        self._put_datav(node, node_pieces, node_data)
+                    else:
+                        result.get()
+                except (IOError, xmlrpclib.Error), e:
+                    print e.__class__
+                    for piece in node_pieces:
+                        self._metadata.mark_dirty(piece[0], node,
+                                                  piece[1], piece[2])
+                    metadata_flush_required = True
+                    self._node_error_state_set.add(node, 0)
         finally:
+            # prefetches don't take the block locks.  data prefetched
+            # while the replicas were being written may be stale.
+            for piece in pieces:
+                self._invalidate_cache(piece[0])
             if offset + len(data) > self._metadata.used_size:
                 self._metadata.used_size = offset + len(data)
-                metadata_flush_required = True
-            for piece in pieces:
-                self._metadata._lock[piece[0]].release() # XXX
-                self._lock[piece[0]].release()
+                size_changed = True
+            self._release_lock(pieces)
 
         if metadata_flush_required is True:
+            # the write must not be acknowledged until the locations
+            # which missed it are recorded.
             self._metadata.flush()
+        elif size_changed is True:
+            self._metadata.flush(wait=False)
+
+        # synchronization is slowed down if writes get slow.
+        ukai_sync_throttle.foreground_op(time.time() - start)
 
         return (len(data))
 
@@ -410,7 +1060,8 @@ class UKAIData(object):
     def _put_data_remote(self, node, blk_idx, off_in_blk, data):
         '''
         Writes the data to a remote store.  The remote write command
-        is sent to a remote proxy program using the XML RPC mechanism.
+        is sent to a remote proxy program using the XML RPC mechanism,
+        or the binary data transport if it is configured for the node.
 
         node: the target node from which we read the data.
         num: the block index of the disk image.
@@ -418,7 +1069,14 @@ class UKAIData(object):
             block.
         data: the data to be written.
         '''
-        rpc_call = UKAIXMLRPCCall(node, self._config.get('core_port'))
+        if (ukai_data_transport(node, self._config)
+            == UKAI_DATA_TRANSPORT_BINARY):
+            rpc_call = self._binary_call(node)
+            return rpc_call.write(self._metadata.name,
+                                  self._metadata.block_size,
+                                  blk_idx, off_in_blk, data)
+
+        rpc_call = self._xmlrpc_call(node)
         return rpc_call.call('proxy_write',
                              self._metadata.name,
                              str(self._metadata.block_size),
@@ -426,10 +1084,38 @@ class UKAIData(object):
                              str(off_in_blk),
                              self._rpc_trans.encode(zlib.compress(data)))
 
-    def synchronize_block(self, blk_idx):
+    def _put_datav(self, node, pieces, data):
+        '''
+        Writes multiple pieces to a local store or a remote store
+        depending on the node location.
+
+        node: the target node to which we write the data.
+        pieces: a list of (block index, offset, size) tupples.
+        data: the concatenated data of all the pieces.
+        '''
+        if UKAIIsLocalNode(node):
+            return (ukai_local_writev(self._metadata.name,
+                                      self._metadata.block_size,
+                                      pieces, data, self._config))
+        if (ukai_data_transport(node, self._config)
+            == UKAI_DATA_TRANSPORT_BINARY):
+            rpc_call = self._binary_call(node)
+            return rpc_call.writev(self._metadata.name,
+                                   self._metadata.block_size,
+                                   pieces, data)
+
+        rpc_call = self._xmlrpc_call(node)
+        return rpc_call.call('proxy_writev',
+                             self._metadata.name,
+                             str(self._metadata.block_size),
+                             self._str_pieces(pieces),
+                             self._rpc_trans.encode(zlib.compress(data)))
+
+    def synchronize_block(self, blk_idx, node=None):
         '''
         Synchronizes the specified block specified by the blk_idx
-        argument.
+        argument.  If the node argument is specified, only the
+        location at the node is synchronized.
 
         Return value: True if metadata is modified, otherwise False.
 
@@ -437,19 +1123,28 @@ class UKAIData(object):
         process, and must not be called by any other processes.
         '''
         metadata_flush_required = False
+        copied = []
         try:
-            self._metadata._lock[blk_idx].acquire() # XXX
-            self._lock[blk_idx].acquire()
+            self._metadata.acquire_lock(blk_idx, blk_idx)
+            self._lock.acquire(blk_idx, blk_idx)
 
-            for node in self._metadata.blocks[blk_idx].keys():
+            nodes = self._metadata.get_locations(blk_idx)
+            if node is not None:
+                nodes = [node] if node in nodes else []
+            for node in nodes:
                 if (self._metadata.get_sync_status(blk_idx, node)
                     == UKAI_IN_SYNC):
                     continue
-                self._synchronize_block(blk_idx, node)
+                copied.extend(self._synchronize_block(blk_idx, node))
                 metadata_flush_required = True
         finally:
-            self._metadata._lock[blk_idx].release() # XXX
-            self._lock[blk_idx].release()
+            self._metadata.release_lock(blk_idx, blk_idx)
+            self._lock.release(blk_idx, blk_idx)
+
+        # the transfers are paid for after the locks are released,
+        # so that the throttle doesn't block I/O to the block, or to
+        # the other blocks sharing the lock objects.
+        ukai_data_throttle(self._metadata.name, copied)
 
         return (metadata_flush_required)
 
@@ -458,10 +1153,17 @@ class UKAIData(object):
         Synchronizes the specified block by the blk_idx argument.
         This function first search the already synchronized node block
         and copy the data to all the other not-synchronized nodes.
+        If the dirty extents of the node are known, only the extents
+        are copied.  Otherwise, if the sync_checksum configuration
+        value is true, only the chunks whose checksums differ are
+        copied, and then the checksums of the whole block are
+        compared.  The transfers are not throttled, since the block
+        is locked.
+
+        Return values: the list of the [start, end) ranges copied.
         '''
-        block = self._metadata.blocks[blk_idx]
         final_candidate = None
-        for candidate in block.keys():
+        for candidate in self._metadata.get_locations(blk_idx):
             if (self._metadata.get_sync_status(blk_idx, candidate)
                 != UKAI_IN_SYNC):
                 continue
@@ -474,16 +1176,112 @@ class UKAIData(object):
             # should raise an exception
             print 'Disk image of %s has unrecoverble error.' % self._metadata.name
 
-        self._allocate_dataspace(node, blk_idx)
-        data = self._get_data(final_candidate,
-                              blk_idx,
-                              0,
-                              self._metadata.block_size)
-        self._put_data(node,
-                       blk_idx,
-                       0,
-                       data)
+        verify = False
+        extents = self._metadata.get_dirty_extents(blk_idx, node)
+        if extents is None and self._config.get('sync_checksum') is True:
+            extents = self._find_different_extents(final_candidate, node,
+                                                   blk_idx)
+            verify = extents is not None
+        if extents is None:
+            self._allocate_dataspace(node, blk_idx)
+            extents = [[0, self._metadata.block_size]]
+        self._copy_extents(final_candidate, node, blk_idx, extents)
+        copied = list(extents)
+        if (verify
+            and (self._get_checksums(final_candidate, blk_idx,
+                                     self._metadata.block_size)
+                 != self._get_checksums(node, blk_idx,
+                                        self._metadata.block_size))):
+            print 'Block %d of %s at %s differs after synchronization.  Copying the whole block.' % (blk_idx, self._metadata.name, node)
+            self._copy_extents(final_candidate, node, blk_idx,
+                               [[0, self._metadata.block_size]])
+            copied.append([0, self._metadata.block_size])
         self._metadata.set_sync_status(blk_idx, node, UKAI_IN_SYNC)
+        return (copied)
+
+    def _copy_extents(self, source, node, blk_idx, extents):
+        '''
+        Copies the [start, end) ranges of the block from the source
+        node to the node.  The node reads the data from the source
+        node directly, so that the data is not relayed by this node.
+        The transfers are not throttled.  The caller pays for them
+        after releasing the lock of the block.
+        '''
+        if UKAIIsLocalNode(node):
+            ukai_data_pull(self._metadata.name, self._metadata.block_size,
+                           blk_idx, source, extents, self._config, False)
+            return
+        try:
+            rpc_call = UKAIXMLRPCCall(node, self._config.get('core_port'))
+            rpc_call.call('proxy_pull',
+                          self._metadata.name,
+                          str(self._metadata.block_size),
+                          str(blk_idx),
+                          source,
+                          [[str(start), str(end)]
+                           for (start, end) in extents],
+                          False)
+            return
+        except xmlrpclib.Fault, e:
+            if 'is not supported' not in e.faultString:
+                raise
+            # the node doesn't support the proxy_pull interface.
+            # relay the data.
+        for (start, end) in extents:
+            for offset in range(start, end, UKAI_SYNC_TRANSFER_SIZE):
+                size = min(UKAI_SYNC_TRANSFER_SIZE, end - offset)
+                data = self._get_data(source,
+                                      blk_idx,
+                                      offset,
+                                      size)
+                self._put_data(node,
+                               blk_idx,
+                               offset,
+                               data)
+
+    def _find_different_extents(self, source, node, blk_idx):
+        '''
+        Compares the checksums of each chunk of the block at the
+        source node and the node, and returns the [start, end) ranges
+        of the chunks which differ.  None is returned if the block is
+        not allocated at the node.
+        '''
+        chunk_size = UKAI_SYNC_CHUNK_SIZE_DEFAULT
+        if self._config.get('sync_chunk_size') is not None:
+            chunk_size = int(self._config.get('sync_chunk_size'))
+        target_checksums = self._get_checksums(node, blk_idx, chunk_size)
+        if not target_checksums:
+            return (None)
+        source_checksums = self._get_checksums(source, blk_idx, chunk_size)
+        extents = []
+        for chunk_idx in range(0, len(source_checksums)):
+            if source_checksums[chunk_idx] == target_checksums[chunk_idx]:
+                continue
+            start = chunk_idx * chunk_size
+            end = min(start + chunk_size, self._metadata.block_size)
+            if extents and extents[-1][1] == start:
+                extents[-1][1] = end
+            else:
+                extents.append([start, end])
+        return (extents)
+
+    def _get_checksums(self, node, blk_idx, chunk_size):
+        '''
+        Returns the list of the checksums of each chunk of the block
+        stored at the node.  The checksums are computed by the node,
+        so that the data is not transferred.
+        '''
+        if UKAIIsLocalNode(node):
+            return (ukai_local_checksums(self._metadata.name,
+                                         self._metadata.block_size,
+                                         blk_idx, chunk_size,
+                                         self._config))
+        rpc_call = UKAIXMLRPCCall(node, self._config.get('core_port'))
+        return (rpc_call.call('proxy_checksums',
+                              self._metadata.name,
+                              str(self._metadata.block_size),
+                              str(blk_idx),
+                              str(chunk_size)))
 
     def _allocate_dataspace(self, node, blk_idx):
         '''
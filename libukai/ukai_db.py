@@ -48,6 +48,9 @@ class UKAIDB(object):
     def get_metadata(self, image_name):
         assert False
 
+    def get_metadata_header(self, image_name):
+        assert False
+
     def delete_metadata(self, image_name):
         assert False
 
@@ -67,6 +70,8 @@ UKAI_ZK_DB_LOCKS_DIR    = '/ukai/metadata/locks'
 UKAI_ZK_DB_CONTENTS_DIR = '/ukai/metadata/contents'
 UKAI_ZK_DB_READERS_DIR  = '/ukai/metadata/readers'
 UKAI_ZK_DB_WRITERS_DIR  = '/ukai/metadata/writers'
+# The number of blocks whose locations are stored in one shard.
+UKAI_ZK_DB_SHARD_BLOCKS_DEFAULT = 1024
 class UKAIZooKeeperDB(UKAIDB):
     '''The UKAIZooKeeperDB class provides an interface class to the
     ZooKeeper cluster.
@@ -76,7 +81,20 @@ class UKAIZooKeeperDB(UKAIDB):
     /metadata/locks/IMAGE_NAMES
       IMAGE_NAMES are lock objects.
     /metadata/contents/IMAGE_NAMES
-      each IMAGE_NAME has a JSON style metadata string.
+      each IMAGE_NAME has a JSON style metadata header string, which
+      contains the metadata except the locations of the blocks, the
+      number of blocks per shard, and the generation of each shard.
+      Old images may have the whole metadata string instead.
+    /metadata/contents/IMAGE_NAMES/SHARD_INDEX-GENERATION
+      each shard znode, named with the index of the shard and its
+      generation as 8 digit decimal numbers (e.g. 00000003-00000007),
+      has a JSON style list of the block extents in the range of the
+      shard.  Only the shards modified
+      since the last write are written, as new znodes named with a
+      new generation.  The header is switched to them last, and the
+      znodes it doesn't refer to are deleted after that, so that a
+      write which fails in the middle leaves the previous metadata.
+      All the shards are read when the metadata of an image is read.
     /metadata/readers/IMAGE_NAMES
       each IMAGE_NAME contains a list of IP addresses who open the disk
       image with a read right.
@@ -87,8 +105,15 @@ class UKAIZooKeeperDB(UKAIDB):
     def __init__(self):
         super(UKAIZooKeeperDB, self).__init__()
         self._lock = threading.Lock()
+        self._shard_blocks = UKAI_ZK_DB_SHARD_BLOCKS_DEFAULT
+        # image_name -> (the version of the header znode, the list of
+        # the contents of the shards, the list of the generations of
+        # the shards) last written or read.
+        self._shards = {}
 
     def connect(self, config):
+        if config.get('metadata_shard_blocks') is not None:
+            self._shard_blocks = int(config.get('metadata_shard_blocks'))
         self._servers = config.get('metadata_servers')
         self._client = kazoo.client.KazooClient(hosts=self._servers)
         self._client.start()
@@ -105,12 +130,86 @@ class UKAIZooKeeperDB(UKAIDB):
             lock = self._client.Lock(UKAI_ZK_DB_LOCKS_DIR,
                                      image_name)
             with lock:
-                if self._client.exists(contents_file) is None:
+                header = dict(metadata)
+                extents = header.pop('block_extents', None)
+                blocks = header.pop('blocks', None)
+                if extents is None:
+                    extents = [[blk_idx, 1, blocks[blk_idx]]
+                               for blk_idx in range(0, len(blocks))]
+                shards = self._split_extents(extents,
+                                             self._shard_blocks)
+                header['shard_blocks'] = self._shard_blocks
+
+                stat = self._client.exists(contents_file)
+                if stat is None:
                     self._client.create(contents_file)
-                self._client.set(contents_file, json.dumps(metadata))
+                    stat = self._client.exists(contents_file)
+                cached = self._shards.pop(image_name, None)
+                if cached is not None and cached[0] == stat.version:
+                    # nobody has written the metadata since this
+                    # node wrote or read it.
+                    (old_shards, old_generations) = cached[1:]
+                else:
+                    (old_shards, old_generations) = ([], [])
+                # the version of the header after this write.
+                generation = stat.version + 1
+                generations = []
+                for shard_idx in range(0, len(shards)):
+                    if (shard_idx < len(old_shards)
+                        and old_shards[shard_idx] == shards[shard_idx]):
+                        generations.append(old_generations[shard_idx])
+                        continue
+                    generations.append(generation)
+                    shard_file = self._get_shard_file(image_name,
+                                                      shard_idx, generation)
+                    if self._client.exists(shard_file) is None:
+                        self._client.create(shard_file, shards[shard_idx])
+                    else:
+                        # left by a failed write.
+                        self._client.set(shard_file, shards[shard_idx])
+                header['shard_generations'] = generations
+                # the header is switched to the new shards last.
+                stat = self._client.set(contents_file, json.dumps(header))
+                self._shards[image_name] = (stat.version, shards,
+                                            generations)
+
+                # the shards the header doesn't refer to, including
+                # those left by a failed write, are deleted.
+                shard_names = self._client.get_children(contents_file)
+                used_names = set([
+                        self._get_shard_name(shard_idx,
+                                             generations[shard_idx])
+                        for shard_idx in range(0, len(generations))])
+                for shard_name in shard_names:
+                    if shard_name not in used_names:
+                        self._client.delete(contents_file + '/'
+                                            + shard_name)
         finally:
             self._lock.release()
 
+    def _get_shard_name(self, shard_idx, generation):
+        return ('%08d-%08d' % (shard_idx, generation))
+
+    def _get_shard_file(self, image_name, shard_idx, generation):
+        return (UKAI_ZK_DB_CONTENTS_DIR + '/' + image_name + '/'
+                + self._get_shard_name(shard_idx, generation))
+
+    def _split_extents(self, extents, shard_blocks):
+        # returns the list of the JSON strings of the extents of each
+        # shard.
+        shards = []
+        for (start_idx, count, block) in extents:
+            while count > 0:
+                shard_idx = start_idx / shard_blocks
+                while len(shards) <= shard_idx:
+                    shards.append([])
+                shard_count = min(count,
+                                  (shard_idx + 1) * shard_blocks - start_idx)
+                shards[shard_idx].append([start_idx, shard_count, block])
+                start_idx = start_idx + shard_count
+                count = count - shard_count
+        return ([json.dumps(shard) for shard in shards])
+
     def get_metadata(self, image_name):
         contents_file = UKAI_ZK_DB_CONTENTS_DIR + '/' + image_name
         ret = None
@@ -120,8 +219,41 @@ class UKAIZooKeeperDB(UKAIDB):
                                      image_name)
             with lock:
                 if self._client.exists(contents_file) is not None:
-                    ret_json = self._client.get(contents_file)[0]
+                    (ret_json, stat) = self._client.get(contents_file)
                     ret = json.loads(ret_json)
+                    if 'shard_generations' in ret:
+                        generations = ret.pop('shard_generations')
+                        shards = []
+                        extents = []
+                        for shard_idx in range(0, len(generations)):
+                            shard_file = self._get_shard_file(
+                                image_name, shard_idx, generations[shard_idx])
+                            shards.append(self._client.get(shard_file)[0])
+                            extents.extend(json.loads(shards[shard_idx]))
+                        del ret['shard_blocks']
+                        ret['block_extents'] = extents
+                        self._shards[image_name] = (stat.version, shards,
+                                                    generations)
+        finally:
+            self._lock.release()
+        return ret
+
+    def get_metadata_header(self, image_name):
+        '''
+        Returns the metadata of the specified image without the
+        locations of the blocks.  The shards are not read.
+        '''
+        contents_file = UKAI_ZK_DB_CONTENTS_DIR + '/' + image_name
+        ret = None
+        try:
+            self._lock.acquire()
+            # the header is read at once.  no need to take the lock
+            # in the cluster.
+            if self._client.exists(contents_file) is not None:
+                ret = json.loads(self._client.get(contents_file)[0])
+                for key in ('shard_generations', 'shard_blocks',
+                            'block_extents', 'blocks'):
+                    ret.pop(key, None)
         finally:
             self._lock.release()
         return ret
@@ -133,9 +265,10 @@ class UKAIZooKeeperDB(UKAIDB):
             lock = self._client.Lock(UKAI_ZK_DB_LOCKS_DIR,
                                      image_name)
             with lock:
+                self._shards.pop(image_name, None)
                 if self._client.exists(contents_file) is None:
                     return
-                self._client.delete(contents_file)
+                self._client.delete(contents_file, recursive=True)
         finally:
             self._lock.release()
 
@@ -204,7 +337,10 @@ if __name__ == '__main__':
     config = UKAIConfig()
     db = UKAIZooKeeperDB()
     db.connect(config)
-    db.put_metadata('test', 'hoge')
+    db.put_metadata('test', {'name': 'test',
+                             'size': 2,
+                             'block_size': 1,
+                             'block_extents': [[0, 2, {}]]})
     print db.get_metadata('test')
     print db.get_image_names()
     db.delete_metadata('test')
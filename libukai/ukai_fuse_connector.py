@@ -32,35 +32,85 @@ implementation.
 
 import errno
 import json
+import os
 import sys
+import threading
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 
 from ukai_config import UKAIConfig
+from ukai_rpc import UKAILocalRPCClient
 from ukai_rpc import UKAIXMLRPCClient, UKAIXMLRPCTranslation
+from ukai_rpc import ukai_rpc_pool
+from ukai_unix_rpc import UKAIUnixRPCClient, UKAIUnixRPCServer
+from ukai_unix_rpc import ukai_core_socket, ukai_fuse_socket
+from ukai_unix_rpc import ukai_unix_rpc_authkey
+from ukai_utils import UKAIIsLocalNode
+from ukai_write_back import UKAIWriteBack
 
 class UKAIFUSE(LoggingMixIn, Operations):
     ''' The UKAIFUSE class provides a FUSE operation implementation.
     '''
 
-    def __init__(self, config):
+    def __init__(self, config, embedded=False):
         ''' Initializes the UKAUFUSE class.
 
         param config: an UKAIConfig instance
+        param embedded: if True, a UKAICore instance is created in
+            this process and filesystem operations are processed
+            without RPC.
         '''
         self._config = config
-        self._rpc_client = UKAIXMLRPCClient(self._config)
+        self._embedded = embedded
+        self._core = None
+        self._write_back = None
+        ukai_rpc_pool.configure(self._config)
+        core_socket = ukai_core_socket(self._config)
+        if (UKAIIsLocalNode(self._config.get('core_server'))
+            and core_socket is not None and os.path.exists(core_socket)):
+            # the UKAI server is running on this node.  use the
+            # UNIX domain socket to avoid the TCP/IP and HTTP overhead.
+            self._rpc_client = UKAIUnixRPCClient(self._config)
+        else:
+            self._rpc_client = UKAIXMLRPCClient(self._config)
         self._rpc_trans = UKAIXMLRPCTranslation()
 
     def init(self, path):
-        ''' Initializes the FUSE operation.
+        ''' Initializes the FUSE operation.  In the embedded mode, the
+        UKAI core is created here since the FUSE process may have been
+        daemonized after the UKAIFUSE instance was created.
         '''
-        pass
+        if self._embedded is True:
+            # imported here, since the UKAI core requires the
+            # dependencies of the UKAI server, such as kazoo.
+            from ukai_core import UKAICore
+            # metadata updates are exchanged with the UKAI server
+            # running on this node.
+            self._config.set('local_peer_socket',
+                             ukai_core_socket(self._config))
+            self._core = UKAICore(self._config)
+            self._rpc_client = UKAILocalRPCClient(self._core)
+            if ukai_fuse_socket(self._config) is not None:
+                # the UKAI server relays metadata updates sent from
+                # other nodes through this socket.
+                server = UKAIUnixRPCServer(
+                    ukai_fuse_socket(self._config), self._core,
+                    ukai_unix_rpc_authkey(self._config))
+                thread = threading.Thread(target=server.serve_forever)
+                thread.daemon = True
+                thread.start()
+        if self._config.get('write_back') is True:
+            # written data is buffered and written to the UKAI core
+            # in the background.
+            self._write_back = UKAIWriteBack(self._config,
+                                             self._write_through)
 
     def destroy(self, path):
         ''' Cleanups the FUSE operation.
         '''
-        pass
+        if self._write_back is not None:
+            self._write_back.stop()
+        ukai_rpc_pool.clear()
 
     def chmod(self, path, mode):
         ''' This interface is provided for changing file modes,
@@ -88,10 +138,41 @@ class UKAIFUSE(LoggingMixIn, Operations):
         param path: the path name of a file
         param fh: the file handle of the file (not used)
         '''
+        buffered_size = 0
+        if self._write_back is not None:
+            buffered_size = self._write_back.size(path)
         (ret, json_st) = self._rpc_client.call('getattr', path)
         if ret != 0:
             raise FuseOSError(ret)
-        return json.loads(json_st)
+        st = json.loads(json_st)
+        if 'st_size' in st and st['st_size'] < buffered_size:
+            # buffered data extends the file.
+            st['st_size'] = buffered_size
+        return st
+
+    def flush(self, path, fh):
+        ''' Writes the buffered data of a file in the write-back
+        mode.  This is called when a file descriptor is closed.
+
+        param path: the path name of a file
+        param fh: the file handle of the file
+        '''
+        if self._write_back is not None:
+            try:
+                self._write_back.flush(path)
+            except IOError, e:
+                raise FuseOSError(e.errno)
+        return 0
+
+    def fsync(self, path, datasync, fh):
+        ''' Writes the buffered data of a file in the write-back
+        mode, and waits for the completion.
+
+        param path: the path name of a file
+        param datasync: if true, only the data is synchronized
+        param fh: the file handle of the file
+        '''
+        return self.flush(path, fh)
 
     def mkdir(self, path, mode):
         ''' This interface is provided for creating a directory,
@@ -112,12 +193,22 @@ class UKAIFUSE(LoggingMixIn, Operations):
         return fh
 
     def release(self, path, fh):
-        ''' Releases a file opened before.
+        ''' Releases a file opened before.  In the write-back mode,
+        an error of writing the buffered data is returned after the
+        file is released.
 
         param path: the path name of a file
         param fh: the file handle of the file
         '''
+        error = None
+        if self._write_back is not None:
+            try:
+                self._write_back.flush(path)
+            except IOError, e:
+                error = e.errno
         self._rpc_client.call('release', path, fh)
+        if error is not None:
+            raise FuseOSError(error)
         return 0
 
     def read(self, path, size, offset, fh):
@@ -128,6 +219,14 @@ class UKAIFUSE(LoggingMixIn, Operations):
         param offset: the offset from the beginning of the file
         param fh: the file handle of the file
         '''
+        if self._write_back is not None:
+            # apply the data not written yet.
+            return self._write_back.read(
+                path, offset, size,
+                lambda: self._read_through(path, size, offset))
+        return self._read_through(path, size, offset)
+
+    def _read_through(self, path, size, offset):
         # The data returned by the UKAICore.read() method is encoded
         # using a RPC encorder.
         ret, encoded_data = self._rpc_client.call('read', path,
@@ -183,6 +282,8 @@ class UKAIFUSE(LoggingMixIn, Operations):
         param length: the new size of the file
         param fh: the file handle of the file
         '''
+        if self._write_back is not None:
+            self.flush(path, fh)
         ret = self._rpc_client.call('truncate', path, str(length))
         if ret != 0:
             raise FuseOSError(ret)
@@ -211,6 +312,11 @@ class UKAIFUSE(LoggingMixIn, Operations):
         param offset: the offset from the beginning of the file
         param fh: the file handle of the file
         '''
+        if self._write_back is not None:
+            return self._write_back.write(path, data, offset)
+        return self._write_through(path, data, offset)
+
+    def _write_through(self, path, data, offset):
         # The data passed to the UKAICore.write interface must be
         # encoded using a proper RPC encoding mechanism.
         encoded_data = self._rpc_trans.encode(data)
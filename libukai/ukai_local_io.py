@@ -26,6 +26,7 @@
 # OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
 # OF SUCH DAMAGE.
 
+import hashlib
 import os
 import shutil
 
@@ -65,6 +66,43 @@ def ukai_local_write(image_name, block_size, block_index,
 
     return len(data)
 
+def ukai_local_readv(image_name, block_size, pieces, config):
+    # pieces: a list of (block index, offset, size) tupples.
+    data = []
+    for (block_index, offset, size) in pieces:
+        data.append(ukai_local_read(image_name, block_size, block_index,
+                                    offset, size, config))
+    return ''.join(data)
+
+def ukai_local_writev(image_name, block_size, pieces, data, config):
+    # pieces: a list of (block index, offset, size) tupples.  data
+    # is the concatenation of the data of all the pieces.
+    written = 0
+    for (block_index, offset, size) in pieces:
+        written += ukai_local_write(image_name, block_size, block_index,
+                                    offset, data[written:written + size],
+                                    config)
+    return written
+
+def ukai_local_checksums(image_name, block_size, block_index, chunk_size,
+                         config):
+    # returns a list of the SHA-1 digests (in hex) of each chunk of
+    # the block, or an empty list if the block is not allocated.
+    image_path = '%s/%s/' % (config.get('data_root'), image_name)
+    block_path = image_path + config.get('blockname_format') % block_index
+    if ((not os.path.exists(block_path))
+        or (os.path.getsize(block_path) != block_size)):
+        return []
+    checksums = []
+    fh = open(block_path, 'r')
+    try:
+        for offset in range(0, block_size, chunk_size):
+            data = fh.read(min(chunk_size, block_size - offset))
+            checksums.append(hashlib.sha1(data).hexdigest())
+    finally:
+        fh.close()
+    return checksums
+
 def ukai_local_allocate_dataspace(image_name, block_size, block_index, config):
     image_path = '%s/%s/' % (config.get('data_root'), image_name)
     if not os.path.exists(image_path):
@@ -30,9 +30,14 @@
 handle metadata information of a UKAI virtual disk image.
 '''
 
+import array
+import errno
 import json
+import os
 import sys
 import threading
+import time
+import xmlrpclib
 import zlib
 
 import netifaces
@@ -40,12 +45,34 @@ import netifaces
 from ukai_config import UKAIConfig
 from ukai_db import ukai_db_client
 from ukai_rpc import UKAIXMLRPCCall, UKAIXMLRPCTranslation
+from ukai_unix_rpc import UKAIUnixRPCClient
 from ukai_utils import UKAIIsLocalNode
 
 UKAI_IN_SYNC = 0
 UKAI_SYNCING = 1
 UKAI_OUT_OF_SYNC = 2
 
+# The ranges of a block written while a location is out of sync are
+# recorded in units of this size.
+UKAI_DIRTY_UNIT = 64 * 1024
+# If a location has more dirty extents than this, the extents are
+# not recorded and the whole block is synchronized.
+UKAI_DIRTY_EXTENTS_MAX = 64
+# Flush requests of the metadata of an image within this period (in
+# seconds) are written at once.
+UKAI_METADATA_FLUSH_DELAY_DEFAULT = 0.02
+# The timeout (in seconds) of a request to send the metadata to a
+# hypervisor.
+UKAI_METADATA_UPDATE_TIMEOUT_DEFAULT = 10.0
+
+# The maximum number of lock objects shared by the blocks of an
+# image.  An image with fewer blocks has a lock object per block.
+UKAI_LOCK_STRIPES_DEFAULT = 1024
+# The number of locations an image can have in the compact form.
+# Each location is represented by a bit of an array item.  Images
+# with more locations keep the bits in Python integers instead.
+UKAI_LOCATIONS_MAX = array.array('L').itemsize * 8
+
 UKAI_METADATA_BUCKET = 'metadata'
 
 def ukai_metadata_create(image_name, size, block_size, location, config):
@@ -65,16 +92,76 @@ def ukai_metadata_create(image_name, size, block_size, location, config):
     metadata_raw['size'] = size
     metadata_raw['used_size'] = size
     metadata_raw['block_size'] = block_size
-    metadata_raw['blocks'] = []
-    blocks = metadata_raw['blocks']
-    for block_num in range(0, size / block_size):
-        location_entry = {location: {'sync_status': UKAI_IN_SYNC}}
-        blocks.append(location_entry)
+    location_entry = {location: {'sync_status': UKAI_IN_SYNC}}
+    metadata_raw['block_extents'] = [[0, size / block_size, location_entry]]
 
     metadata = UKAIMetadata(image_name, config, metadata_raw)
     metadata.flush()
     del metadata
 
+def ukai_metadata_get_block_extents(metadata_raw):
+    ''' The ukai_metadata_get_block_extents function returns the
+    locations of the blocks of a metadata information as extents.
+    The metadata may be in the format which has the 'block_extents'
+    key, or in the old format which has the locations of each block
+    in the 'blocks' key.
+
+    param metadata_raw: a raw metadata
+
+    Return values: A list of [first block index, number of blocks,
+        locations] lists, where the locations is a dictionary in the
+        same format as an item of the old 'blocks' list.
+    '''
+    if 'block_extents' in metadata_raw:
+        return (metadata_raw['block_extents'])
+    extents = []
+    for (blk_idx, block) in enumerate(metadata_raw['blocks']):
+        if len(extents) > 0 and extents[-1][2] == block:
+            extents[-1][1] = extents[-1][1] + 1
+        else:
+            extents.append([blk_idx, 1, block])
+    return (extents)
+
+def ukai_metadata_update_local_peer(image_name, encoded_metadata, config,
+                                    method='proxy_update_metadata'):
+    ''' The ukai_metadata_update_local_peer function sends the
+    metadata to the other UKAI process running on this node, that is
+    the UKAI server or the FUSE connector with an embedded UKAI core.
+    The socket of the other process is specified by the
+    local_peer_socket configuration value.
+
+    param image_name: the name of a virtual disk image
+    param encoded_metadata: the metadata encoded in the same way as
+        the proxy_update_metadata interface, or the delta of the
+        metadata encoded in the same way as the
+        proxy_update_metadata_delta interface
+    param config: an UKAIConfig instance
+    param method: the interface to call
+    '''
+    peer_socket = config.get('local_peer_socket')
+    if peer_socket is None or not os.path.exists(peer_socket):
+        return
+    try:
+        rpc_client = UKAIUnixRPCClient(config, peer_socket,
+                                       ukai_metadata_update_timeout(config))
+        # the peer must not relay the update back.
+        rpc_client.call(method, image_name, encoded_metadata, False)
+    except (IOError, xmlrpclib.Error), e:
+        print e.__class__
+        print 'Failed to update metadata at %s' % peer_socket
+
+def ukai_metadata_update_timeout(config):
+    ''' The ukai_metadata_update_timeout function returns the
+    timeout (in seconds) of a request to send the metadata to a
+    hypervisor, specified by the metadata_update_timeout
+    configuration value.
+
+    param config: an UKAIConfig instance
+    '''
+    if config.get('metadata_update_timeout') is None:
+        return (UKAI_METADATA_UPDATE_TIMEOUT_DEFAULT)
+    return (float(config.get('metadata_update_timeout')))
+
 def ukai_metadata_destroy(image_name, config):
     ''' The ukai_metadata_destroy function deletes metadata
     information.
@@ -85,10 +172,197 @@ def ukai_metadata_destroy(image_name, config):
     ukai_db_client.delete_metadata(image_name)
     return 0
 
+class UKAIMetadataFlusher(object):
+    '''
+    The UKAIMetadataFlusher class writes the metadata of an image in
+    a background thread.  Flush requests are collected for a short
+    period after the first one, and written with one write to the
+    metadata storage and one update to each hypervisor.  Callers can
+    wait until the metadata including their changes is written.
+    Each image has its own flusher, so that a slow image doesn't
+    delay the others.
+    '''
+    def __init__(self):
+        '''
+        Initializes the flusher.  The thread is started when a
+        request is made, and exits when no request is pending.
+
+        Return values: This function does not return any values.
+        '''
+        self._cond = threading.Condition()
+        # UKAIMetadata -> the time to write it.
+        self._pending = {}
+        self._thread = None
+
+    def request(self, metadata, delay, wait):
+        '''
+        Requests to write the metadata.
+
+        metadata: an UKAIMetadata instance.
+        delay: the period (in seconds) to collect other requests.
+        wait: if True, waits until the metadata is written.  An
+            IOError is raised if the write failed.
+
+        Return values: This function does not return any values.
+        '''
+        self._cond.acquire()
+        try:
+            metadata._flush_requested += 1
+            sequence = metadata._flush_requested
+            if metadata not in self._pending:
+                self._pending[metadata] = time.time() + delay
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+            if not wait:
+                return
+            while metadata._flush_done < sequence:
+                self._cond.wait()
+            if metadata._flush_failed >= sequence:
+                raise IOError(errno.EIO,
+                              'Failed to write metadata of %s' % metadata.name)
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        while True:
+            self._cond.acquire()
+            try:
+                while True:
+                    if not self._pending:
+                        self._thread = None
+                        return
+                    now = time.time()
+                    due = [metadata for metadata in self._pending
+                           if self._pending[metadata] <= now]
+                    if due:
+                        break
+                    self._cond.wait(min(self._pending.values()) - now)
+                sequences = {}
+                for metadata in due:
+                    del self._pending[metadata]
+                    sequences[metadata] = metadata._flush_requested
+            finally:
+                self._cond.release()
+            for metadata in due:
+                failed = False
+                try:
+                    metadata._write()
+                except Exception, e:
+                    print e.__class__
+                    print 'Failed to write metadata of %s' % metadata.name
+                    failed = True
+                self._cond.acquire()
+                try:
+                    metadata._flush_done = sequences[metadata]
+                    if failed:
+                        metadata._flush_failed = sequences[metadata]
+                    self._cond.notify_all()
+                finally:
+                    self._cond.release()
+
+class UKAIStripedLock(object):
+    '''
+    The UKAIStripedLock class provides lock objects of the blocks of
+    a disk image.  Up to the number of lock objects specified by the
+    lock_stripes configuration value are shared by the blocks
+    instead of allocating one per block.
+    '''
+    def __init__(self, num_blocks, config):
+        '''
+        Initializes the lock objects.
+
+        num_blocks: the number of blocks of the disk image.
+        config: an UKAIConfig instance.
+
+        Return values: This function does not return any values.
+        '''
+        stripes = UKAI_LOCK_STRIPES_DEFAULT
+        if config.get('lock_stripes') is not None:
+            stripes = int(config.get('lock_stripes'))
+        stripes = max(min(stripes, num_blocks), 1)
+        self._locks = []
+        for stripe in range(0, stripes):
+            self._locks.append(threading.Lock())
+
+    def _get_stripes(self, start_idx, end_idx):
+        if end_idx - start_idx + 1 >= len(self._locks):
+            return (range(0, len(self._locks)))
+        # always acquire the lock objects in the same order.
+        stripes = set()
+        for blk_idx in range(start_idx, end_idx + 1):
+            stripes.add(blk_idx % len(self._locks))
+        return (sorted(stripes))
+
+    def acquire(self, start_idx, end_idx):
+        '''
+        Acquires the lock objects of the specified range of blocks.
+
+        start_idx: the first block index of the range.
+        end_idx: the last block index of the range.
+
+        Return values: This function does not return any values.
+        '''
+        for stripe in self._get_stripes(start_idx, end_idx):
+            self._locks[stripe].acquire()
+
+    def release(self, start_idx, end_idx):
+        '''
+        Releases the lock objects acquired by the acquire method.
+
+        start_idx: the first block index of the range.
+        end_idx: the last block index of the range.
+
+        Return values: This function does not return any values.
+        '''
+        for stripe in reversed(self._get_stripes(start_idx, end_idx)):
+            self._locks[stripe].release()
+
+class UKAIMetadataBlocks(object):
+    '''
+    The UKAIMetadataBlocks class is a list-like view of the location
+    information of the blocks of an UKAIMetadata instance.  Each item
+    is a dictionary in the same format as the stored metadata, that
+    is, {node: {'sync_status': status}}.  Modifying an item does not
+    modify the metadata.
+    '''
+    def __init__(self, metadata):
+        self._metadata = metadata
+
+    def __len__(self):
+        return (self._metadata.num_blocks)
+
+    def __getitem__(self, blk_idx):
+        if isinstance(blk_idx, slice):
+            return ([self[idx]
+                     for idx in range(*blk_idx.indices(len(self)))])
+        if blk_idx < 0:
+            blk_idx = blk_idx + len(self)
+        if blk_idx < 0 or blk_idx >= len(self):
+            raise IndexError('block index out of range')
+        return (self._metadata._get_block(blk_idx))
+
+    def __setitem__(self, blk_idx, block):
+        if blk_idx < 0 or blk_idx >= len(self):
+            raise IndexError('block index out of range')
+        self._metadata._set_block(blk_idx, block)
+
+    def __iter__(self):
+        for blk_idx in xrange(0, len(self)):
+            yield self._metadata._get_block(blk_idx)
+
 class UKAIMetadata(object):
     '''
     The UKAIMetadata class contains metadata information of a disk image
     of the UKAI system.
+
+    The locations of the blocks are kept in a compact form.  The
+    nodes are interned in a location table, and the locations of
+    each block and the locations out of sync are kept as bitmasks of
+    the indexes of the table in arrays.  The rare UKAI_SYNCING status
+    and the dirty extents are kept in dictionaries.
     '''
 
     def __init__(self, image_name, config, metadata_raw=None):
@@ -107,69 +381,399 @@ class UKAIMetadata(object):
         '''
         self._config = config
         self._rpc_trans = UKAIXMLRPCTranslation()
-        if (metadata_raw != None):
-            self._metadata = metadata_raw
-        else:
-            self._metadata = None
-            self._metadata = ukai_db_client.get_metadata(image_name)
+        if (metadata_raw == None):
+            metadata_raw = ukai_db_client.get_metadata(image_name)
+        self._load(metadata_raw)
+        self._lock = UKAIStripedLock(self.num_blocks, config)
+
+        # the sequence numbers of flush requests.  protected by the
+        # lock of the flusher.
+        self._flusher = UKAIMetadataFlusher()
+        self._flush_requested = 0
+        self._flush_done = 0
+        self._flush_failed = 0
 
-        self._lock = []
-        for idx in range(0, len(self.blocks)):
-            self._lock.append(threading.Lock())
+        # the indexes of blocks modified since the last write.
+        self._changed_blocks = set()
 
-    def flush(self):
+    def flush(self, wait=True):
         '''
         Writes out the latest metadata information stored in memory
-        to the metadata file.
+        to the metadata file.  Requests made within the
+        metadata_flush_delay period are written at once.
+
+        wait: if True, waits until the metadata is written, and
+            raises an IOError if the write failed.  If False, the
+            metadata is written in the background.
+        '''
+        delay = UKAI_METADATA_FLUSH_DELAY_DEFAULT
+        if self._config.get('metadata_flush_delay') is not None:
+            delay = float(self._config.get('metadata_flush_delay'))
+        self._flusher.request(self, delay, wait)
+
+    def _write(self):
+        '''
+        Writes the metadata to the metadata storage with a new
+        version number, and sends it to the hypervisors using the
+        disk image.  Only the blocks modified since the last write
+        are sent unless most of the blocks are modified.
+
+        The metadata is copied with all the blocks locked, and
+        written without the lock, so that the I/O of the disk image
+        is not blocked by the metadata storage or the hypervisors.
+        Only the flusher of the image calls this method, so the
+        writes are not reordered.
         '''
         try:
             self.acquire_lock()
 
-            # Write out to the metadata storage.
-            ukai_db_client.put_metadata(self.name, self._metadata)
+            changed_blocks = self._changed_blocks
+            self._changed_blocks = set()
+            base_version = self.version
+            self._metadata['version'] = base_version + 1
+            metadata_raw = self._get_raw()
+            delta = None
+            if len(changed_blocks) * 2 <= self.num_blocks:
+                delta = self._get_delta(base_version, changed_blocks)
+        finally:
+            self.release_lock()
 
-            # Send the latest metadata information to all the hypervisors
-            # using this virtual disk.
-            for hv in ukai_db_client.get_readers(self.name):
-                if UKAIIsLocalNode(hv):
-                    continue
-                try:
-                    rpc_call = UKAIXMLRPCCall(
-                        hv, self._config.get('core_port'))
-                    rpc_call.call('proxy_update_metadata',
-                                  self.name,
-                                  self._rpc_trans.encode(zlib.compress(json.dumps(self._metadata))))
-                except (IOError, xmlrpclib.Error), e:
-                    print e.__class__
-                    print 'Failed to update metadata at %s.  You cannot migrate a virtual machine to %s' % (hv, hv)
+        # Write out to the metadata storage.
+        try:
+            ukai_db_client.put_metadata(self.name, metadata_raw)
+        except Exception:
+            try:
+                self.acquire_lock()
+                self._metadata['version'] = base_version
+                self._changed_blocks.update(changed_blocks)
+            finally:
+                self.release_lock()
+            raise
+
+        # Send the latest metadata information to all the hypervisors
+        # using this virtual disk.
+        encoded_metadata = None
+        encoded_delta = None
+        if delta is not None:
+            encoded_delta = self._rpc_trans.encode(zlib.compress(
+                    json.dumps(delta)))
+        for hv in ukai_db_client.get_readers(self.name):
+            try:
+                if encoded_delta is not None:
+                    try:
+                        self._send_update(hv,
+                                          'proxy_update_metadata_delta',
+                                          encoded_delta)
+                        continue
+                    except xmlrpclib.Fault, e:
+                        if 'is not supported' not in e.faultString:
+                            raise
+                        # the hypervisor doesn't support the
+                        # proxy_update_metadata_delta interface.
+                if encoded_metadata is None:
+                    encoded_metadata = self._rpc_trans.encode(
+                        zlib.compress(json.dumps(metadata_raw)))
+                self._send_update(hv, 'proxy_update_metadata',
+                                  encoded_metadata)
+            except (IOError, xmlrpclib.Error), e:
+                print e.__class__
+                print 'Failed to update metadata at %s.  You cannot migrate a virtual machine to %s' % (hv, hv)
+
+    def _get_delta(self, base_version, changed_blocks):
+        '''
+        Returns the delta from the specified version to the current
+        version of the metadata.
+
+        base_version: the version the delta is applied to.
+        changed_blocks: the indexes of blocks modified since the
+            base_version.
+
+        Return values: A dictionary which contains the base_version,
+            the metadata except the blocks, and a list of [index,
+            block] pairs of the modified blocks.
+        '''
+        delta = {}
+        delta['base_version'] = base_version
+        delta['metadata'] = dict(self._metadata)
+        delta['blocks'] = []
+        for blk_idx in sorted(changed_blocks):
+            delta['blocks'].append([blk_idx, self._get_block(blk_idx)])
+        return (delta)
+
+    def _send_update(self, hv, method, encoded):
+        if UKAIIsLocalNode(hv):
+            ukai_metadata_update_local_peer(self.name, encoded,
+                                            self._config, method)
+            return
+        rpc_call = UKAIXMLRPCCall(hv, self._config.get('core_port'),
+                                  ukai_metadata_update_timeout(self._config))
+        rpc_call.call(method, self.name, encoded)
+
+    def apply_delta(self, delta):
+        '''
+        Applies the delta of the metadata generated by the writer of
+        the disk image.
+
+        delta: a delta dictionary sent by the
+            proxy_update_metadata_delta interface.
+
+        Return values: A list of the indexes of modified blocks, or
+            None if the delta is not for the current version, in
+            which case the whole metadata must be loaded.
+        '''
+        try:
+            self.acquire_lock()
+
+            if self.version != int(delta['base_version']):
+                return (None)
+            changed = []
+            for (blk_idx, block) in delta['blocks']:
+                if self._get_block(blk_idx) != block:
+                    self._set_block(blk_idx, block)
+                    changed.append(blk_idx)
+            for key in delta['metadata']:
+                self._metadata[key] = delta['metadata'][key]
+            return (changed)
 
         finally:
             self.release_lock()
 
+    def _load(self, metadata_raw):
+        # must be called with all the blocks locked, or before the
+        # instance is used.
+        extents = ukai_metadata_get_block_extents(metadata_raw)
+        self._metadata = dict(metadata_raw)
+        self._metadata.pop('blocks', None)
+        self._metadata.pop('block_extents', None)
+        num_blocks = 0
+        for (start_idx, count, block) in extents:
+            num_blocks = max(num_blocks, start_idx + count)
+        # the location table.  removed locations are None.
+        self._locations = []
+        self._location_index = {}
+        # bitmask -> the list of nodes.
+        self._mask_locations = {}
+        self._members = self._new_masks(0, num_blocks)
+        self._out_of_sync = self._new_masks(0, num_blocks)
+        # blk_idx -> bitmask of the locations being synchronized.
+        self._syncing = {}
+        # (blk_idx, location index) -> dirty extents.
+        self._dirty = {}
+        # same as calling _set_block() for each block, but faster.
+        for (start_idx, count, block) in extents:
+            members = 0
+            out_of_sync = 0
+            for (node, location) in block.iteritems():
+                loc_idx = self._location_index.get(node)
+                if loc_idx is None:
+                    # the masks are not set yet.  all the locations
+                    # are used.
+                    loc_idx = self._intern(node, False)
+                bit = 1 << loc_idx
+                members = members | bit
+                sync_status = location['sync_status']
+                if sync_status == UKAI_OUT_OF_SYNC:
+                    out_of_sync = out_of_sync | bit
+                if sync_status != UKAI_SYNCING and 'dirty' not in location:
+                    continue
+                for blk_idx in range(start_idx, start_idx + count):
+                    if sync_status == UKAI_SYNCING:
+                        self._set_status(blk_idx, loc_idx, sync_status)
+                    if 'dirty' in location:
+                        self._dirty[(blk_idx, loc_idx)] = [
+                            list(extent) for extent in location['dirty']]
+            self._members[start_idx:start_idx + count] = (
+                self._new_masks(members, count))
+            self._out_of_sync[start_idx:start_idx + count] = (
+                self._new_masks(out_of_sync, count))
+
+    def _new_masks(self, mask, count):
+        # returns a sequence of count masks in the same form as the
+        # masks of the blocks.
+        if len(self._locations) > UKAI_LOCATIONS_MAX:
+            return ([mask] * count)
+        return (array.array('L', [mask]) * count)
+
+    def _get_raw(self):
+        metadata_raw = dict(self._metadata)
+        metadata_raw['block_extents'] = self._get_block_extents()
+        return (metadata_raw)
+
+    def _get_block_extents(self):
+        # the blocks which have the UKAI_SYNCING status or dirty
+        # extents are stored one by one.  the other blocks are
+        # grouped by the locations and their sync status, and the
+        # extents with the same locations share one dictionary
+        # object.
+        special = set(self._syncing.keys())
+        for (blk_idx, loc_idx) in self._dirty:
+            special.add(blk_idx)
+        special = sorted(special)
+        special.append(len(self._members))
+        shared = {}
+        extents = []
+        blk_idx = 0
+        for limit in special:
+            while blk_idx < limit:
+                end_idx = self._find_run_end(blk_idx, limit)
+                key = (self._members[blk_idx], self._out_of_sync[blk_idx])
+                if key not in shared:
+                    shared[key] = self._get_block(blk_idx)
+                extents.append([blk_idx, end_idx - blk_idx, shared[key]])
+                blk_idx = end_idx
+            if limit < len(self._members):
+                extents.append([limit, 1, self._get_block(limit)])
+                blk_idx = limit + 1
+        return (extents)
+
+    def _find_run_end(self, start_idx, limit):
+        # returns the first index from start_idx to limit whose
+        # locations or sync status differ from the block at
+        # start_idx, or limit.  the arrays are compared by slices
+        # growing exponentially to avoid a loop per block.
+        members = self._new_masks(self._members[start_idx], 1)
+        out_of_sync = self._new_masks(self._out_of_sync[start_idx], 1)
+        def same(begin_idx, end_idx):
+            count = end_idx - begin_idx
+            return (self._members[begin_idx:end_idx] == members * count
+                    and (self._out_of_sync[begin_idx:end_idx]
+                         == out_of_sync * count))
+        end_idx = start_idx + 1
+        step = 1
+        while end_idx < limit:
+            next_idx = min(end_idx + step, limit)
+            if not same(end_idx, next_idx):
+                # the block changes in [end_idx, next_idx).
+                while next_idx - end_idx > 1:
+                    middle_idx = (end_idx + next_idx) / 2
+                    if same(end_idx, middle_idx):
+                        end_idx = middle_idx
+                    else:
+                        next_idx = middle_idx
+                return (end_idx)
+            end_idx = next_idx
+            step = step * 2
+        return (limit)
+
+    def get_changed_blocks(self, metadata_raw):
+        '''
+        Compares the locations of the blocks with the specified
+        metadata.
+
+        metadata_raw: a raw metadata.
+
+        Return values: A list of the indexes of the blocks whose
+            locations or sync status differ.
+        '''
+        old_extents = self._get_block_extents()
+        new_extents = ukai_metadata_get_block_extents(metadata_raw)
+        changed = []
+        blk_idx = 0
+        old_pos = 0
+        new_pos = 0
+        while (old_pos < len(old_extents)
+               and new_pos < len(new_extents)):
+            old_end = old_extents[old_pos][0] + old_extents[old_pos][1]
+            new_end = new_extents[new_pos][0] + new_extents[new_pos][1]
+            end_idx = min(old_end, new_end)
+            if old_extents[old_pos][2] != new_extents[new_pos][2]:
+                changed.extend(range(blk_idx, end_idx))
+            blk_idx = end_idx
+            if old_end == end_idx:
+                old_pos = old_pos + 1
+            if new_end == end_idx:
+                new_pos = new_pos + 1
+        changed.extend(range(blk_idx, len(self._members)))
+        return (changed)
+
+    def _intern(self, node, compact=True):
+        # returns the index of the node in the location table, adding
+        # it if necessary.  must be called with all the blocks locked
+        # unless the node is in the table already, since the table and
+        # the masks of all the blocks may change.
+        if node in self._location_index:
+            return (self._location_index[node])
+        if compact and None not in self._locations:
+            if len(self._locations) >= UKAI_LOCATIONS_MAX:
+                self._compact_locations()
+        if None in self._locations:
+            loc_idx = self._locations.index(None)
+            self._locations[loc_idx] = node
+        else:
+            loc_idx = len(self._locations)
+            self._locations.append(node)
+            if loc_idx == UKAI_LOCATIONS_MAX:
+                # the masks don't fit in the array items any more.
+                self._members = list(self._members)
+                self._out_of_sync = list(self._out_of_sync)
+        self._location_index[node] = loc_idx
+        self._mask_locations = {}
+        return (loc_idx)
+
+    def _compact_locations(self):
+        # frees the entries of the location table which no block
+        # uses.
+        used = 0
+        for mask in self._members:
+            used = used | mask
+        for loc_idx in range(0, len(self._locations)):
+            if used & (1 << loc_idx):
+                continue
+            if self._locations[loc_idx] is not None:
+                del self._location_index[self._locations[loc_idx]]
+                self._locations[loc_idx] = None
+        self._mask_locations = {}
+
+    def _get_location_index(self, blk_idx, node):
+        loc_idx = self._location_index.get(node)
+        if loc_idx is None or not self._members[blk_idx] & (1 << loc_idx):
+            raise KeyError(node)
+        return (loc_idx)
+
+    def _get_block(self, blk_idx):
+        block = {}
+        for node in self.get_locations(blk_idx):
+            location = {'sync_status': self.get_sync_status(blk_idx, node)}
+            extents = self.get_dirty_extents(blk_idx, node)
+            if extents is not None:
+                location['dirty'] = [list(extent) for extent in extents]
+            block[node] = location
+        return (block)
+
+    def _set_block(self, blk_idx, block):
+        for node in self.get_locations(blk_idx):
+            self._dirty.pop((blk_idx, self._location_index[node]), None)
+        self._members[blk_idx] = 0
+        self._out_of_sync[blk_idx] = 0
+        self._syncing.pop(blk_idx, None)
+        for node in block:
+            loc_idx = self._intern(node)
+            self._members[blk_idx] |= 1 << loc_idx
+            self._set_status(blk_idx, loc_idx, block[node]['sync_status'])
+            if 'dirty' in block[node]:
+                self._dirty[(blk_idx, loc_idx)] = [
+                    list(extent) for extent in block[node]['dirty']]
+
     @property
     def metadata(self):
         '''
-        The metadata dictionary object of this instance.
+        The metadata dictionary object of this instance.  The
+        dictionary is generated every time, and must not be modified
+        because the dictionaries of the blocks are shared.
         '''
-        return(self._metadata)
+        return(self._get_raw())
 
     @metadata.setter
     def metadata(self, metadata_raw):
-        if self._metadata is None:
-            # If this is the first time to load the metadata, just
-            # load it.
-            self._metadata = metadata_raw
-        else:
-            # If the instance has metadata already, need to lock
-            # the object to avoid thread confliction.
-            try:
-                self.acquire_lock()
+        # need to lock the object to avoid thread confliction.
+        try:
+            self.acquire_lock()
 
-                self._metadata = metadata_raw
+            self._load(metadata_raw)
+
+        finally:
+            self.release_lock()
 
-            finally:
-                self.release_lock()
-        
 
     @property
     def name(self):
@@ -195,6 +799,26 @@ class UKAIMetadata(object):
     def used_size(self, used_size):
         self._metadata['used_size'] = used_size
 
+    @property
+    def epoch(self):
+        '''
+        A random number changed every time the disk image is opened
+        for writing.  Data cached by a node is valid only in the same
+        epoch.
+        '''
+        return (int(self._metadata.get('epoch', 0)))
+    @epoch.setter
+    def epoch(self, epoch):
+        self._metadata['epoch'] = epoch
+
+    @property
+    def version(self):
+        '''
+        The version number of the metadata, which is incremented
+        every time the metadata is written.
+        '''
+        return (int(self._metadata.get('version', 0)))
+
     @property
     def block_size(self):
         '''
@@ -202,13 +826,40 @@ class UKAIMetadata(object):
         '''
         return (int(self._metadata['block_size']))
 
+    @property
+    def num_blocks(self):
+        '''
+        The number of blocks of the disk image.
+        '''
+        return (len(self._members))
+
     @property
     def blocks(self):
         '''
-        An array of all blocks.  Need to acquire lock when modifying
-        the contents.
+        A read-only view of the location information of all blocks.
+        Use the get_locations() method to find the locations of a
+        block without generating the dictionary.
         '''
-        return(self._metadata['blocks'])
+        return(UKAIMetadataBlocks(self))
+
+    def get_locations(self, blk_idx):
+        '''
+        Returns the locations of the specified block index.
+
+        blk_idx: The index of a block.
+
+        Return values: A list of nodes.  The list must not be
+            modified.
+        '''
+        mask = self._members[blk_idx]
+        locations = self._mask_locations.get(mask)
+        if locations is None:
+            locations = []
+            for loc_idx in range(0, len(self._locations)):
+                if mask & (1 << loc_idx):
+                    locations.append(self._locations[loc_idx])
+            self._mask_locations[mask] = locations
+        return (locations)
 
     def acquire_lock(self, start_idx=0, end_idx=-1):
         '''
@@ -229,8 +880,7 @@ class UKAIMetadata(object):
         assert end_idx >= start_idx
         assert end_idx < (self.size / self.block_size)
 
-        for blk_idx in range(0, end_idx + 1):
-            self._lock[blk_idx].acquire()
+        self._lock.acquire(start_idx, end_idx)
 
     def release_lock(self, start_idx=0, end_idx=-1):
         '''
@@ -252,8 +902,7 @@ class UKAIMetadata(object):
         assert end_idx >= start_idx
         assert end_idx < (self.size / self.block_size)
 
-        for blk_idx in range(0, end_idx + 1):
-            self._lock[blk_idx].release()
+        self._lock.release(start_idx, end_idx)
 
     def set_sync_status(self, blk_idx, node, sync_status):
         '''
@@ -268,13 +917,117 @@ class UKAIMetadata(object):
             UKAI_SYNCING: The block is being synchronized (NOT USED).
             UKAI_OUT_OF_SYNC: The block is not synchronized.
 
+        The dirty extents of the location are discarded, that is, the
+        whole block is synchronized if the location is out of sync.
+
         Return values: This function does not return any values.
         '''
+        loc_idx = self._get_location_index(blk_idx, node)
+        self._set_status(blk_idx, loc_idx, sync_status)
+        self._dirty.pop((blk_idx, loc_idx), None)
+        self._changed_blocks.add(blk_idx)
+
+    def _set_status(self, blk_idx, loc_idx, sync_status):
         assert (sync_status == UKAI_IN_SYNC
                 or sync_status == UKAI_SYNCING
                 or sync_status == UKAI_OUT_OF_SYNC)
 
-        self.blocks[blk_idx][node]['sync_status'] = sync_status
+        bit = 1 << loc_idx
+        if sync_status == UKAI_OUT_OF_SYNC:
+            self._out_of_sync[blk_idx] |= bit
+        else:
+            self._out_of_sync[blk_idx] &= ~bit
+        syncing = self._syncing.get(blk_idx, 0)
+        if sync_status == UKAI_SYNCING:
+            syncing = syncing | bit
+        else:
+            syncing = syncing & ~bit
+        if syncing:
+            self._syncing[blk_idx] = syncing
+        else:
+            self._syncing.pop(blk_idx, None)
+
+    def mark_dirty(self, blk_idx, node, off_in_blk=0, size_in_blk=0):
+        '''
+        Marks the specified location of the specified block index out
+        of sync because the range of the block was not written to the
+        location.  If the location was in sync, only the range is
+        synchronized later.  If the location was out of sync with
+        dirty extents, the range is added to the extents.  The range
+        is expanded to UKAI_DIRTY_UNIT boundaries.
+
+        blk_idx: The index of a block.
+        node: The location information specified by the IP address
+            of a storage node.
+        off_in_blk: The offset of the range in the block.
+        size_in_blk: The size of the range.  0 marks the location out
+            of sync without any dirty range, so that the whole block
+            is synchronized, e.g. when a read from the location
+            failed and the data stored there is unknown.
+
+        Return values: True if the metadata is modified, otherwise
+            False.
+        '''
+        loc_idx = self._get_location_index(blk_idx, node)
+        key = (blk_idx, loc_idx)
+        if size_in_blk == 0:
+            if (self.get_sync_status(blk_idx, node) != UKAI_IN_SYNC
+                and key not in self._dirty):
+                # the whole block will be synchronized.
+                return (False)
+            self._changed_blocks.add(blk_idx)
+            self._set_status(blk_idx, loc_idx, UKAI_OUT_OF_SYNC)
+            self._dirty.pop(key, None)
+            return (True)
+        self._changed_blocks.add(blk_idx)
+        if self.get_sync_status(blk_idx, node) == UKAI_IN_SYNC:
+            self._set_status(blk_idx, loc_idx, UKAI_OUT_OF_SYNC)
+            self._dirty[key] = []
+            modified = True
+        elif key not in self._dirty:
+            # the whole block will be synchronized.
+            return (False)
+        else:
+            modified = False
+        start = off_in_blk - off_in_blk % UKAI_DIRTY_UNIT
+        end = min(off_in_blk + size_in_blk + UKAI_DIRTY_UNIT - 1,
+                  self.block_size)
+        end = end - end % UKAI_DIRTY_UNIT
+        if end < off_in_blk + size_in_blk:
+            end = self.block_size
+        extents = []
+        for (extent_start, extent_end) in self._dirty[key]:
+            if extent_end < start or end < extent_start:
+                extents.append([extent_start, extent_end])
+                continue
+            if extent_start <= start and end <= extent_end:
+                # already dirty.
+                return (modified)
+            start = min(start, extent_start)
+            end = max(end, extent_end)
+        extents.append([start, end])
+        extents.sort()
+        if len(extents) > UKAI_DIRTY_EXTENTS_MAX:
+            del self._dirty[key]
+        else:
+            self._dirty[key] = extents
+        return (True)
+
+    def get_dirty_extents(self, blk_idx, node):
+        '''
+        Returns the dirty extents of the specified location of the
+        specified block index.
+
+        blk_idx: The index of a block.
+        node: The location information specified by the IP address
+            of a storage node.
+
+        Return values: A list of [start, end) offset pairs of the
+            ranges which must be synchronized, or None if the whole
+            block must be synchronized.
+        '''
+        loc_idx = self._get_location_index(blk_idx, node)
+        return (self._dirty.get((blk_idx, loc_idx)))
 
     def get_sync_status(self, blk_idx, node):
         '''
@@ -290,7 +1043,12 @@ class UKAIMetadata(object):
             UKAI_SYNCING: The block is being synchronized (NOT USED).
             UKAI_OUT_OF_SYNC: The block is not synchronized.
         '''
-        return (self.blocks[blk_idx][node]['sync_status'])
+        bit = 1 << self._get_location_index(blk_idx, node)
+        if self._out_of_sync[blk_idx] & bit:
+            return (UKAI_OUT_OF_SYNC)
+        if self._syncing.get(blk_idx, 0) & bit:
+            return (UKAI_SYNCING)
+        return (UKAI_IN_SYNC)
 
     def add_location(self, node, start_idx=0, end_idx=-1,
                      sync_status=UKAI_OUT_OF_SYNC):
@@ -313,17 +1071,30 @@ class UKAIMetadata(object):
         assert end_idx >= start_idx
         assert end_idx < (self.size / self.block_size)
 
+        # a new location changes the location table, and possibly the
+        # representation of the masks, which the other blocks use too.
+        all_blocks = (0, self.num_blocks - 1)
+        (lock_start, lock_end) = (start_idx, end_idx)
+        if node not in self._location_index:
+            (lock_start, lock_end) = all_blocks
+        self.acquire_lock(lock_start, lock_end)
         try:
-            self.acquire_lock(start_idx, end_idx)
+            if (node not in self._location_index
+                and (lock_start, lock_end) != all_blocks):
+                # removed by the compaction meanwhile.
+                self.release_lock(lock_start, lock_end)
+                (lock_start, lock_end) = all_blocks
+                self.acquire_lock(lock_start, lock_end)
 
+            loc_idx = self._intern(node)
             for blk_idx in range(start_idx, end_idx + 1):
-                if node not in self.blocks[blk_idx]:
+                if node not in self.get_locations(blk_idx):
                     # if there is no node entry, create it.
-                    self.blocks[blk_idx][node] = {}
+                    self._members[blk_idx] |= 1 << loc_idx
                     self.set_sync_status(blk_idx, node, sync_status)
 
         finally:
-            self.release_lock(start_idx, end_idx)
+            self.release_lock(lock_start, lock_end)
 
         self.flush()
 
@@ -350,9 +1121,9 @@ class UKAIMetadata(object):
             self.acquire_lock(start_idx, end_idx)
 
             for blk_idx in range(start_idx, end_idx + 1):
-                block = self.blocks[blk_idx]
+                locations = self.get_locations(blk_idx)
                 has_synced_node = False
-                for member_node in block.keys():
+                for member_node in locations:
                     if member_node == node:
                         continue
                     if (self.get_sync_status(blk_idx, member_node)
@@ -362,8 +1133,12 @@ class UKAIMetadata(object):
                 if has_synced_node is False:
                     print 'block %d does not have synced block' % blk_idx
                     continue
-                if node in block.keys():
-                    del block[node]
+                if node in locations:
+                    loc_idx = self._location_index[node]
+                    self._set_status(blk_idx, loc_idx, UKAI_IN_SYNC)
+                    self._dirty.pop((blk_idx, loc_idx), None)
+                    self._members[blk_idx] &= ~(1 << loc_idx)
+                    self._changed_blocks.add(blk_idx)
 
         finally:
             self.release_lock(start_idx, end_idx)
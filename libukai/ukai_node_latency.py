@@ -0,0 +1,210 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+'''
+The ukai_node_latency.py module provides a class to keep track of
+the response time and the number of outstanding requests of each
+node, and to select the node to read from.
+'''
+
+import collections
+import random
+import threading
+import time
+
+# The weight of a new sample in the moving average of latency.
+UKAI_NODE_LATENCY_WEIGHT_DEFAULT = 0.2
+# Nodes whose expected latency is within this ratio of the best one
+# are considered equal, and requests are spread among them.
+UKAI_NODE_LATENCY_TOLERANCE = 0.1
+# The number of recent samples kept per node to compute percentiles.
+UKAI_NODE_LATENCY_SAMPLES = 128
+# Percentiles are not computed until this number of samples is taken.
+UKAI_NODE_LATENCY_MIN_SAMPLES = 16
+
+class UKAINodeLatencySet(object):
+    '''
+    The UKAINodeLatencySet class keeps an exponentially weighted
+    moving average (EWMA) of the observed latency, recent latency
+    samples, and the number of outstanding requests per node.
+    '''
+    def __init__(self, config=None):
+        '''
+        Initializes an internal dictionary object and a lock object.
+        The weight of a new sample is taken from the latency_weight
+        configuration value if config is specified.
+
+        Return values: This function does not return any values.
+        '''
+        self._weight = UKAI_NODE_LATENCY_WEIGHT_DEFAULT
+        if (config is not None
+            and config.get('latency_weight') is not None):
+            self._weight = config.get('latency_weight')
+        self._set = {}
+        self._lock = threading.Lock()
+
+    def _get_state(self, address):
+        if address not in self._set:
+            self._set[address] = {
+                'latency': None,
+                'outstanding': 0,
+                'samples': 0,
+                'recent': collections.deque(
+                    maxlen=UKAI_NODE_LATENCY_SAMPLES)}
+        return (self._set[address])
+
+    def begin(self, address):
+        '''
+        Records the start of a request to the specified node.
+
+        address: The IP address of the node.
+
+        Return values: The start time to be passed to the end()
+            method.
+        '''
+        try:
+            self._lock.acquire()
+            self._get_state(address)['outstanding'] += 1
+        finally:
+            self._lock.release()
+        return (time.time())
+
+    def end(self, address, start, failed=False):
+        '''
+        Records the completion of a request to the specified node,
+        and updates the moving average of its latency.  The latency
+        of a failed request is not recorded.
+
+        address: The IP address of the node.
+        start: The value returned by the begin() method.
+        failed: True if the request failed.
+
+        Return values: This function does not return any values.
+        '''
+        latency = time.time() - start
+        try:
+            self._lock.acquire()
+            state = self._get_state(address)
+            state['outstanding'] -= 1
+            if failed:
+                return
+            if state['latency'] is None:
+                state['latency'] = latency
+            else:
+                state['latency'] = (self._weight * latency
+                                    + (1 - self._weight) * state['latency'])
+            state['samples'] += 1
+            state['recent'].append(latency)
+        finally:
+            self._lock.release()
+
+    def select(self, addresses):
+        '''
+        Returns the node which is expected to respond first among the
+        specified nodes.  The expected latency is the average latency
+        multiplied by the number of outstanding requests plus one.
+        Nodes which have never been measured are tried first.  If
+        more than one node is almost equally fast, one of them is
+        chosen randomly to spread the load.
+
+        addresses: A list of the IP addresses of candidate nodes.
+
+        Return values: The IP address of the selected node, or None
+            if addresses is empty.
+        '''
+        if len(addresses) == 0:
+            return (None)
+        try:
+            self._lock.acquire()
+            costs = []
+            for address in addresses:
+                state = self._get_state(address)
+                if state['latency'] is None:
+                    cost = 0
+                else:
+                    cost = state['latency'] * (state['outstanding'] + 1)
+                costs.append((cost, address))
+        finally:
+            self._lock.release()
+        best = min([cost for (cost, address) in costs])
+        equals = [address for (cost, address) in costs
+                  if cost <= best * (1 + UKAI_NODE_LATENCY_TOLERANCE)]
+        return (random.choice(equals))
+
+    def percentile(self, address, percent):
+        '''
+        Returns the specified percentile of the recent latency samples
+        of the specified node.
+
+        address: The IP address of the node.
+        percent: The percentile (0 to 100).
+
+        Return values: The latency in seconds, or None if not enough
+            samples have been taken.
+        '''
+        try:
+            self._lock.acquire()
+            recent = sorted(self._get_state(address)['recent'])
+        finally:
+            self._lock.release()
+        if len(recent) < UKAI_NODE_LATENCY_MIN_SAMPLES:
+            return (None)
+        index = int(round((len(recent) - 1) * percent / 100.0))
+        return (recent[index])
+
+    def get_list(self):
+        '''
+        Returns a list of nodes and their latency information.
+
+        Return values: A list object of a dictionary object of
+        following format.
+
+            {
+                'address': NODE_ADDRESS,
+                'latency': AVERAGE_LATENCY,
+                'outstanding': OUTSTANDING_REQUESTS,
+                'samples': NUMBER_OF_SAMPLES
+            }
+
+        AVERAGE_LATENCY is in seconds, or None if the node has not
+        been measured.
+        '''
+        try:
+            self._lock.acquire()
+            copied_set = []
+            for address in self._set:
+                state = self._set[address]
+                copied_set.append({'address': address,
+                                   'latency': state['latency'],
+                                   'outstanding': state['outstanding'],
+                                   'samples': state['samples']
+                                   })
+            return (copied_set)
+        finally:
+            self._lock.release()
@@ -26,8 +26,203 @@
 # OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
 # OF SUCH DAMAGE.
 
+'''
+The ukai_rpc.py module provides RPC client classes and data
+translation classes used to communicate with UKAI nodes.
+'''
+
+import threading
+import time
 import xmlrpclib
 
+# The maximum number of idle connections kept per remote node.
+UKAI_RPC_POOL_SIZE_DEFAULT = 8
+# Idle connections older than this value (in seconds) are closed.
+UKAI_RPC_POOL_IDLE_TIMEOUT_DEFAULT = 30
+
+class UKAIConnectionPool(object):
+    '''
+    The UKAIConnectionPool class keeps idle connections to remote
+    nodes so that successive RPC calls can reuse them instead of
+    establishing a new connection every time.  A connection object
+    stored in the pool must provide the close() method.
+
+    Only the idle connections are limited.  The get() method never
+    waits for a connection in use to be returned, since an RPC may be
+    relayed to the node which issued it, and waiting there could
+    deadlock.
+    '''
+    def __init__(self, size=UKAI_RPC_POOL_SIZE_DEFAULT,
+                 idle_timeout=UKAI_RPC_POOL_IDLE_TIMEOUT_DEFAULT):
+        '''
+        Initializes the pool.
+
+        size: The maximum number of idle connections kept per key.
+        idle_timeout: The time in seconds after which an idle
+            connection is evicted from the pool.
+
+        Return values: This function does not return any values.
+        '''
+        self._size = size
+        self._idle_timeout = idle_timeout
+        # key -> a list of (connection, last used time) pairs.
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0,
+                       'misses': 0,
+                       'evictions': 0,
+                       'errors': 0}
+
+    def configure(self, config):
+        '''
+        Updates pool parameters from the rpc_pool_size and the
+        rpc_pool_idle_timeout configuration values.
+
+        config: an UKAIConfig instance.
+
+        Return values: This function does not return any values.
+        '''
+        if config.get('rpc_pool_size') is not None:
+            self._size = int(config.get('rpc_pool_size'))
+        if config.get('rpc_pool_idle_timeout') is not None:
+            self._idle_timeout = float(config.get('rpc_pool_idle_timeout'))
+
+    def get(self, key, connect):
+        '''
+        Returns an idle connection associated with the key.  If there
+        is no usable idle connection, a new connection is created by
+        calling the connect function.
+
+        key: The identifier of the remote endpoint.
+        connect: A function which returns a new connection.
+
+        Return values: A connection object.
+        '''
+        conn = None
+        expired = []
+        try:
+            self._lock.acquire()
+            expired = self._collect_expired()
+            idle = self._idle.get(key)
+            if idle:
+                # reuse the most recently used connection.
+                conn = idle.pop()[0]
+                self._stats['hits'] += 1
+            else:
+                self._stats['misses'] += 1
+        finally:
+            self._lock.release()
+
+        for expired_conn in expired:
+            self._close(expired_conn)
+        if conn is None:
+            conn = connect()
+        return (conn)
+
+    def put(self, key, conn):
+        '''
+        Returns a connection acquired by the get() method to the pool.
+        If the pool already has enough idle connections for the key,
+        the connection is closed.
+
+        key: The identifier of the remote endpoint.
+        conn: The connection to be returned.
+
+        Return values: This function does not return any values.
+        '''
+        overflow = None
+        try:
+            self._lock.acquire()
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._size:
+                idle.append((conn, time.time()))
+            else:
+                overflow = conn
+                self._stats['evictions'] += 1
+        finally:
+            self._lock.release()
+
+        if overflow is not None:
+            self._close(overflow)
+
+    def discard(self, conn):
+        '''
+        Closes a connection which caused an error.  The connection is
+        not returned to the pool, and a new connection will be
+        established by the next get() call.
+
+        conn: The connection to be discarded.
+
+        Return values: This function does not return any values.
+        '''
+        try:
+            self._lock.acquire()
+            self._stats['errors'] += 1
+        finally:
+            self._lock.release()
+        self._close(conn)
+
+    def clear(self):
+        '''
+        Closes all the idle connections.
+
+        Return values: This function does not return any values.
+        '''
+        try:
+            self._lock.acquire()
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for key in idle:
+            for (conn, last_used) in idle[key]:
+                self._close(conn)
+
+    def get_stats(self):
+        '''
+        Returns the pool statistics.
+
+        Return values: A dictionary object of the following format.
+
+            {
+                'hits': NUMBER_OF_REUSED_CONNECTIONS,
+                'misses': NUMBER_OF_NEW_CONNECTIONS,
+                'evictions': NUMBER_OF_EVICTED_CONNECTIONS,
+                'errors': NUMBER_OF_DISCARDED_CONNECTIONS,
+                'idle': NUMBER_OF_IDLE_CONNECTIONS
+            }
+        '''
+        try:
+            self._lock.acquire()
+            stats = dict(self._stats)
+            stats['idle'] = sum([len(idle) for idle in self._idle.values()])
+            return (stats)
+        finally:
+            self._lock.release()
+
+    def _collect_expired(self):
+        # must be called with self._lock held.
+        expire_before = time.time() - self._idle_timeout
+        expired = []
+        for key in self._idle.keys():
+            idle = self._idle[key]
+            # idle lists are ordered from the oldest one.
+            while idle and idle[0][1] < expire_before:
+                expired.append(idle.pop(0)[0])
+                self._stats['evictions'] += 1
+            if not idle:
+                del self._idle[key]
+        return (expired)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+# The connection pool shared by all the RPC calls in a process.
+ukai_rpc_pool = UKAIConnectionPool()
+
 class UKAIRPCClient(object):
     def call(self, method, *params):
         # must subclass.
@@ -45,6 +240,17 @@ class UKAIRPCTranslation(object):
     def decode(self, source):
         return source
 
+class UKAILocalRPCClient(UKAIRPCClient):
+    '''
+    The UKAILocalRPCClient class calls methods of an instance in the
+    same process.  No serialization is involved.
+    '''
+    def __init__(self, instance):
+        self._instance = instance
+
+    def call(self, method, *params):
+        return getattr(self._instance, method)(*params)
+
 class UKAIXMLRPCClient(UKAIRPCClient):
     def __init__(self, config):
         self._config = config
@@ -54,20 +260,69 @@ class UKAIXMLRPCClient(UKAIRPCClient):
                                   self._config.get('core_port'))
         return rpc_call.call(method, *params)
 
+class UKAIXMLRPCTimeoutTransport(xmlrpclib.Transport):
+    '''
+    The UKAIXMLRPCTimeoutTransport class is an XML-RPC transport
+    whose socket operations time out after the specified seconds.
+    '''
+    def __init__(self, timeout):
+        xmlrpclib.Transport.__init__(self)
+        self._timeout = timeout
+
+    def make_connection(self, host):
+        conn = xmlrpclib.Transport.make_connection(self, host)
+        conn.timeout = self._timeout
+        return (conn)
+
+class UKAIXMLRPCConnection(object):
+    '''
+    The UKAIXMLRPCConnection class holds an XML-RPC proxy object.
+    The underlying HTTP/1.1 connection is kept open between calls
+    while the object is stored in the connection pool.
+    '''
+    def __init__(self, server, port, timeout=None):
+        transport = None
+        if timeout is not None:
+            transport = UKAIXMLRPCTimeoutTransport(timeout)
+        self.proxy = xmlrpclib.ServerProxy(
+            'http://%s:%d' % (server, port),
+            transport=transport,
+            allow_none=True)
+
+    def close(self):
+        self.proxy('close')()
+
 class UKAIXMLRPCCall(UKAIRPCCall):
-    def __init__(self, server, port):
+    def __init__(self, server, port, timeout=None):
+        '''
+        If timeout is specified, a call which doesn't complete within
+        timeout seconds raises a socket.timeout exception.
+        '''
         self._server = server
         self._port = port
+        self._timeout = timeout
 
     def call(self, method, *params):
-        client = xmlrpclib.ServerProxy(
-            'http://%s:%d' % (self._server, self._port),
-            allow_none=True)
+        key = ('xmlrpc', self._server, self._port, self._timeout)
+        conn = ukai_rpc_pool.get(
+            key, lambda: UKAIXMLRPCConnection(self._server, self._port,
+                                              self._timeout))
         try:
-            return getattr(client, method)(*params)
+            ret = getattr(conn.proxy, method)(*params)
+        except xmlrpclib.Fault:
+            # the remote method failed, but the connection itself
+            # is still usable.
+            ukai_rpc_pool.put(key, conn)
+            raise
         except xmlrpclib.Error, e:
+            ukai_rpc_pool.discard(conn)
             print e.__class__
             raise
+        except:
+            ukai_rpc_pool.discard(conn)
+            raise
+        ukai_rpc_pool.put(key, conn)
+        return ret
 
 class UKAIXMLRPCTranslation(UKAIRPCTranslation):
     def encode(self, source):
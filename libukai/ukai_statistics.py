@@ -61,6 +61,16 @@ class UKAIImageStatistics(object):
 
         # total I/O statistics.
         self._init_io_stats(self._stats)
+        # the number of reads sent to a second node because the
+        # first node was slow.
+        self._stats['hedged_reads'] = 0
+        # block cache statistics.
+        self._stats['cache_hits'] = 0
+        self._stats['cache_misses'] = 0
+        self._stats['cache_evictions'] = 0
+        self._stats['disk_cache_hits'] = 0
+        # the amount of data prefetched by readahead.
+        self._stats['readahead_bytes'] = 0
 
         # per block statistics.  enabled when
         # UKAIConfig['block_stats'] is True.
@@ -143,6 +153,44 @@ class UKAIImageStatistics(object):
         self._stats['write_ops'] += 1
         self._update_histogram(self._stats['histogram']['write'], total_size)
 
+    def hedge_op(self):
+        '''
+        Updates statistics for a hedged read request.
+        '''
+        self._stats['hedged_reads'] += 1
+
+    def cache_op(self, hit):
+        '''
+        Updates statistics for a lookup of the block cache.
+
+        hit: True if the data was found in the cache.
+        '''
+        if hit is True:
+            self._stats['cache_hits'] += 1
+        else:
+            self._stats['cache_misses'] += 1
+
+    def disk_cache_op(self):
+        '''
+        Updates statistics for a lookup of the block cache which
+        found the data on disk.
+        '''
+        self._stats['disk_cache_hits'] += 1
+
+    def cache_eviction_op(self):
+        '''
+        Updates statistics for an eviction from the block cache.
+        '''
+        self._stats['cache_evictions'] += 1
+
+    def readahead_op(self, size):
+        '''
+        Updates statistics for a prefetch request of readahead.
+
+        size: The size of the prefetched data.
+        '''
+        self._stats['readahead_bytes'] += size
+
     def _init_io_stats(self, stats):
         stats['read_bytes'] = 0
         stats['read_ops'] = 0
@@ -0,0 +1,424 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+'''
+The ukai_sync.py module provides a service which synchronizes
+out-of-sync blocks in the background.
+'''
+
+import json
+import os
+import threading
+import time
+
+from collections import OrderedDict, deque
+
+from ukai_metadata import UKAI_IN_SYNC
+
+# The number of threads synchronizing blocks.
+UKAI_SYNC_WORKERS_DEFAULT = 4
+# The number of blocks synchronized to one node at the same time.
+UKAI_SYNC_NODE_WORKERS_DEFAULT = 2
+# The metadata of an image is written after this number of blocks
+# are synchronized,
+UKAI_SYNC_FLUSH_BLOCKS_DEFAULT = 64
+# or after this period (in seconds) since the last write.
+UKAI_SYNC_FLUSH_INTERVAL_DEFAULT = 5.0
+# The number of finished jobs kept to report their status.
+UKAI_SYNC_FINISHED_JOBS = 16
+
+UKAI_SYNC_JOB_RUNNING = 'running'
+UKAI_SYNC_JOB_DONE = 'done'
+UKAI_SYNC_JOB_CANCELLED = 'cancelled'
+
+class UKAISyncService(object):
+    '''
+    The UKAISyncService class keeps a queue of (image, block index,
+    node) work items, each of which is an out-of-sync location, and
+    synchronizes them with multiple worker threads.  Items are
+    grouped into jobs, one per request.  The number of items
+    processed at the same time is limited per target node.  The
+    items are queued per node, and the nodes are served in turn.
+
+    The metadata of an image is written once per a batch of
+    synchronized blocks.  The list of the unfinished jobs is saved in
+    the checkpoint file at the same time, and the jobs are resumed
+    when the service is started again.  Since the work items are
+    taken from the sync status in the metadata, the blocks
+    synchronized before the last metadata write are not processed
+    again.
+    '''
+    def __init__(self, config, open_image):
+        '''
+        Initializes the service.  The worker threads are not started
+        until the start() method is called.
+
+        config: an UKAIConfig instance.  The sync_workers,
+            sync_node_workers, sync_flush_blocks, sync_flush_interval,
+            and sync_checkpoint configuration values are used.
+        open_image: a function which returns a (UKAIMetadata,
+            UKAIData) pair of the specified image, or None if the
+            image doesn't exist.
+
+        Return values: This function does not return any values.
+        '''
+        self._config = config
+        self._open_image = open_image
+        self._workers = UKAI_SYNC_WORKERS_DEFAULT
+        if config.get('sync_workers') is not None:
+            self._workers = int(config.get('sync_workers'))
+        self._node_workers = UKAI_SYNC_NODE_WORKERS_DEFAULT
+        if config.get('sync_node_workers') is not None:
+            self._node_workers = int(config.get('sync_node_workers'))
+        self._flush_blocks = UKAI_SYNC_FLUSH_BLOCKS_DEFAULT
+        if config.get('sync_flush_blocks') is not None:
+            self._flush_blocks = int(config.get('sync_flush_blocks'))
+        self._flush_interval = UKAI_SYNC_FLUSH_INTERVAL_DEFAULT
+        if config.get('sync_flush_interval') is not None:
+            self._flush_interval = float(config.get('sync_flush_interval'))
+        self._checkpoint = config.get('sync_checkpoint')
+        if self._checkpoint is None:
+            self._checkpoint = os.path.join(
+                os.path.dirname(config.get('data_root').rstrip('/')),
+                'sync.json')
+        self._cond = threading.Condition()
+        # job id -> job dictionary.
+        self._jobs = {}
+        self._next_job_id = 1
+        # node -> a deque of (job id, block index) tupples, ordered
+        # from the node served least recently.
+        self._queues = OrderedDict()
+        # node -> the number of items being processed.
+        self._active = {}
+        self._threads = []
+
+    def start(self):
+        '''
+        Resumes the jobs saved in the checkpoint file, and starts the
+        worker threads.
+        '''
+        for saved_job in self._load_checkpoint():
+            self.submit(saved_job['image'], saved_job['start'],
+                        saved_job['end'], saved_job)
+        for idx in range(0, self._workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, image_name, start_idx=0, end_idx=-1, saved_job=None):
+        '''
+        Adds a job which synchronizes the out-of-sync locations of
+        the specified range of blocks.
+
+        Return values: the job id, or None if the image doesn't
+            exist.
+        '''
+        image = self._open_image(image_name)
+        if image is None:
+            return (None)
+        (metadata, data) = image
+        if end_idx == -1:
+            end_idx = (metadata.size / metadata.block_size) - 1
+        items = []
+        for blk_idx in range(start_idx, end_idx + 1):
+            for node in metadata.get_locations(blk_idx):
+                if metadata.get_sync_status(blk_idx, node) != UKAI_IN_SYNC:
+                    items.append((blk_idx, node))
+        now = time.time()
+        job = {'image': image_name,
+               'start': start_idx,
+               'end': end_idx,
+               'state': UKAI_SYNC_JOB_RUNNING,
+               'total': len(items),
+               'done': 0,
+               'failed': 0,
+               'submitted': now,
+               # the time spent before the service was restarted.
+               'elapsed': 0.0,
+               'metadata': metadata,
+               'data': data,
+               'active': 0,
+               'unflushed': 0,
+               'flushed': now,
+               'flush_lock': threading.Lock()}
+        if saved_job is not None:
+            # the items finished before the restart are counted.
+            # failed items are tried again.
+            job['total'] += saved_job['done']
+            job['done'] = saved_job['done']
+            job['elapsed'] = saved_job['elapsed']
+        self._cond.acquire()
+        try:
+            job_id = self._next_job_id
+            self._next_job_id += 1
+            job['id'] = job_id
+            job['started'] = now
+            self._jobs[job_id] = job
+            for (blk_idx, node) in items:
+                if node not in self._queues:
+                    self._queues[node] = deque()
+                self._queues[node].append((job_id, blk_idx))
+            if not items:
+                job['state'] = UKAI_SYNC_JOB_DONE
+                job['finished'] = now
+            self._forget_finished_jobs()
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        self._save_checkpoint()
+        return (job_id)
+
+    def cancel(self, job_id):
+        '''
+        Cancels the job.  The items being processed are completed.
+
+        Return values: True if the job was running.
+        '''
+        self._cond.acquire()
+        try:
+            job = self._jobs.get(job_id)
+            if job is None or job['state'] != UKAI_SYNC_JOB_RUNNING:
+                return (False)
+            job['state'] = UKAI_SYNC_JOB_CANCELLED
+            job['finished'] = time.time()
+            for node in self._queues.keys():
+                items = deque([item for item in self._queues[node]
+                               if item[0] != job_id])
+                if items:
+                    self._queues[node] = items
+                else:
+                    del self._queues[node]
+        finally:
+            self._cond.release()
+        # the items being processed are written when the last one
+        # is completed.
+        self._flush(job, True)
+        return (True)
+
+    def has_running_jobs(self, image_name):
+        '''
+        Returns True if a job of the image is running, or the items
+        of a cancelled job are being processed.
+        '''
+        self._cond.acquire()
+        try:
+            for job in self._jobs.values():
+                if (job['image'] == image_name
+                    and (job['state'] == UKAI_SYNC_JOB_RUNNING
+                         or job['active'] > 0)):
+                    return (True)
+            return (False)
+        finally:
+            self._cond.release()
+
+    def get_status(self, job_id=None):
+        '''
+        Returns the list of the status of the jobs, or the job if the
+        job_id is specified.  Each status is a dictionary which has
+        the id, image, start, end, state, total, done, failed,
+        elapsed, and eta keys.  The eta value is the estimated time
+        (in seconds) to finish the job, or -1 if it is unknown.
+        '''
+        self._cond.acquire()
+        try:
+            now = time.time()
+            statuses = []
+            for job in sorted(self._jobs.values(),
+                              key=lambda job: job['id']):
+                if job_id is not None and job['id'] != job_id:
+                    continue
+                status = dict([(key, job[key]) for key
+                               in ('id', 'image', 'start', 'end', 'state',
+                                   'total', 'done', 'failed')])
+                status['elapsed'] = self._elapsed(job, now)
+                status['eta'] = -1
+                processed = job['done'] + job['failed']
+                if job['state'] != UKAI_SYNC_JOB_RUNNING:
+                    status['eta'] = 0
+                elif processed > 0:
+                    status['eta'] = (status['elapsed'] / processed
+                                     * (job['total'] - processed))
+                statuses.append(status)
+            return (statuses)
+        finally:
+            self._cond.release()
+
+    def _elapsed(self, job, now):
+        if 'finished' in job:
+            now = job['finished']
+        return (job['elapsed'] + now - job['started'])
+
+    def _next_item(self):
+        # must be called with self._cond held.  returns the first
+        # item of the node served least recently among the nodes
+        # which are not busy.
+        for node in self._queues:
+            if self._active.get(node, 0) >= self._node_workers:
+                continue
+            items = self._queues.pop(node)
+            (job_id, blk_idx) = items.popleft()
+            if items:
+                self._queues[node] = items
+            return ((job_id, blk_idx, node))
+        return (None)
+
+    def _work(self):
+        while True:
+            self._cond.acquire()
+            try:
+                item = self._next_item()
+                while item is None:
+                    self._cond.wait()
+                    item = self._next_item()
+                (job_id, blk_idx, node) = item
+                job = self._jobs[job_id]
+                self._active[node] = self._active.get(node, 0) + 1
+                job['active'] += 1
+            finally:
+                self._cond.release()
+
+            succeeded = True
+            try:
+                job['data'].synchronize_block(blk_idx, node)
+            except Exception, e:
+                print e.__class__
+                print 'Failed to synchronize block %d of %s at %s' % (blk_idx, job['image'], node)
+                succeeded = False
+
+            self._cond.acquire()
+            try:
+                self._active[node] -= 1
+                job['active'] -= 1
+                if succeeded:
+                    job['done'] += 1
+                    job['unflushed'] += 1
+                else:
+                    job['failed'] += 1
+                if (job['state'] == UKAI_SYNC_JOB_RUNNING
+                    and job['active'] == 0
+                    and job['done'] + job['failed'] == job['total']):
+                    job['state'] = UKAI_SYNC_JOB_DONE
+                    job['finished'] = time.time()
+                # the last item of a finished or cancelled job.
+                finished = (job['state'] != UKAI_SYNC_JOB_RUNNING
+                            and job['active'] == 0)
+                self._cond.notify_all()
+            finally:
+                self._cond.release()
+            self._flush(job, finished)
+
+    def _flush(self, job, force):
+        '''
+        Writes the metadata of the image of the job and the
+        checkpoint, if enough blocks have been synchronized since the
+        last write, or if force is True.  If the metadata cannot be
+        written, the error is printed and the blocks are written by
+        the next flush, so that the workers keep running.
+        '''
+        job['flush_lock'].acquire()
+        try:
+            self._cond.acquire()
+            try:
+                now = time.time()
+                if (job['unflushed'] == 0
+                    or (not force
+                        and job['unflushed'] < self._flush_blocks
+                        and now - job['flushed'] < self._flush_interval)):
+                    flush_required = False
+                else:
+                    flush_required = True
+                    unflushed = job['unflushed']
+                    job['unflushed'] = 0
+                    job['flushed'] = now
+            finally:
+                self._cond.release()
+            if flush_required:
+                try:
+                    job['metadata'].flush()
+                except IOError, e:
+                    print e.__class__
+                    print 'Failed to write the metadata of %s' % job['image']
+                    # the blocks are counted again, and written by the
+                    # next flush.
+                    self._cond.acquire()
+                    try:
+                        job['unflushed'] += unflushed
+                    finally:
+                        self._cond.release()
+                    return
+            if flush_required or force:
+                self._save_checkpoint()
+        finally:
+            job['flush_lock'].release()
+
+    def _forget_finished_jobs(self):
+        # must be called with self._cond held.
+        finished = sorted([job['id'] for job in self._jobs.values()
+                           if job['state'] != UKAI_SYNC_JOB_RUNNING])
+        for job_id in finished[:-UKAI_SYNC_FINISHED_JOBS]:
+            del self._jobs[job_id]
+
+    def _load_checkpoint(self):
+        try:
+            fh = open(self._checkpoint, 'r')
+            try:
+                return (json.load(fh))
+            finally:
+                fh.close()
+        except (IOError, ValueError):
+            return ([])
+
+    def _save_checkpoint(self):
+        # the running jobs are saved.  the blocks whose sync status
+        # is not written yet are not counted as done.
+        self._cond.acquire()
+        try:
+            now = time.time()
+            saved_jobs = []
+            for job in sorted(self._jobs.values(),
+                              key=lambda job: job['id']):
+                if job['state'] != UKAI_SYNC_JOB_RUNNING:
+                    continue
+                saved_jobs.append({'image': job['image'],
+                                   'start': job['start'],
+                                   'end': job['end'],
+                                   'done': job['done'] - job['unflushed'],
+                                   'elapsed': self._elapsed(job, now)})
+            try:
+                fh = open(self._checkpoint + '.tmp', 'w')
+                try:
+                    json.dump(saved_jobs, fh)
+                finally:
+                    fh.close()
+                os.rename(self._checkpoint + '.tmp', self._checkpoint)
+            except (IOError, OSError), e:
+                print e.__class__
+                print 'Failed to write the checkpoint at %s' % self._checkpoint
+        finally:
+            self._cond.release()
@@ -0,0 +1,280 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+'''
+The ukai_throttle.py module provides token bucket rate limiters used
+to limit the bandwidth and the number of operations of
+synchronization transfers.
+'''
+
+import threading
+import time
+
+# The period (in seconds) of transfers which a token bucket allows
+# at once after it has been idle.
+UKAI_THROTTLE_BURST_TIME = 1.0
+# The weight of a new sample in the moving average of foreground
+# latency.
+UKAI_THROTTLE_LATENCY_WEIGHT = 0.2
+# The rates are adjusted at most once in this period (in seconds).
+UKAI_THROTTLE_ADJUST_INTERVAL = 1.0
+# The rates are never reduced below this ratio.
+UKAI_THROTTLE_FACTOR_MIN = 1.0 / 64
+# The ratio of the rates restored per adjustment.
+UKAI_THROTTLE_FACTOR_STEP = 0.1
+
+class UKAITokenBucket(object):
+    '''
+    The UKAITokenBucket class limits the rate of consumption of some
+    amount, such as bytes or operations.  A consumer larger than the
+    available tokens is allowed to borrow tokens, and waits until
+    the debt is paid, so that large transfers are also limited.
+    '''
+    def __init__(self, rate=0):
+        '''
+        Initializes the bucket.
+
+        rate: the amount allowed per second.  0 means unlimited.
+
+        Return values: This function does not return any values.
+        '''
+        self._rate = rate
+        self._tokens = rate * UKAI_THROTTLE_BURST_TIME
+        self._time = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        '''
+        The amount allowed per second.  0 means unlimited.
+        '''
+        return (self._rate)
+
+    def set_rate(self, rate):
+        '''
+        Changes the rate.
+        '''
+        try:
+            self._lock.acquire()
+            self._refill(time.time())
+            self._rate = rate
+            self._tokens = min(self._tokens, rate * UKAI_THROTTLE_BURST_TIME)
+        finally:
+            self._lock.release()
+
+    def consume(self, amount, factor=1.0):
+        '''
+        Takes the specified amount of tokens.  If the bucket doesn't
+        have enough tokens, waits until they are refilled.
+
+        amount: the amount to consume.
+        factor: the ratio applied to the rate.
+
+        Return values: the time (in seconds) waited.
+        '''
+        try:
+            self._lock.acquire()
+            if self._rate <= 0:
+                return (0)
+            now = time.time()
+            self._refill(now, factor)
+            self._tokens -= amount
+            wait = 0
+            if self._tokens < 0:
+                wait = -self._tokens / (self._rate * factor)
+        finally:
+            self._lock.release()
+        if wait > 0:
+            time.sleep(wait)
+        return (wait)
+
+    def _refill(self, now, factor=1.0):
+        # must be called with self._lock held.
+        self._tokens = min(self._rate * UKAI_THROTTLE_BURST_TIME,
+                           self._tokens
+                           + (now - self._time) * self._rate * factor)
+        self._time = now
+
+class UKAISyncThrottle(object):
+    '''
+    The UKAISyncThrottle class limits the bandwidth and the number of
+    operations of synchronization transfers of this node, in total
+    and per disk image.  If a target latency is set, the rates are
+    reduced while the latency of the foreground I/O of this process
+    is above the target, and restored gradually when it goes below.
+    Since the rates are scaled, the target latency has no effect
+    unless a rate is limited.
+    '''
+    def __init__(self):
+        '''
+        Initializes the throttle with no limits.
+
+        Return values: This function does not return any values.
+        '''
+        self._bandwidth = UKAITokenBucket()
+        self._iops = UKAITokenBucket()
+        # image name -> (bandwidth bucket, iops bucket).
+        self._images = {}
+        self._latency_target = None
+        self._latency = None
+        self._factor = 1.0
+        self._adjusted = time.time()
+        self._sampled = 0
+        self._lock = threading.Lock()
+
+    def configure(self, config):
+        '''
+        Sets the limits from the sync_rate, sync_iops, sync_image_rates
+        and sync_latency_target configuration values.
+
+        config: an UKAIConfig instance.
+
+        Return values: This function does not return any values.
+        '''
+        self.set_limit(int(config.get('sync_rate') or 0),
+                       int(config.get('sync_iops') or 0))
+        image_rates = config.get('sync_image_rates') or {}
+        for image_name in image_rates:
+            self.set_limit(int(image_rates[image_name].get('rate', 0)),
+                           int(image_rates[image_name].get('iops', 0)),
+                           image_name)
+        if config.get('sync_latency_target') is not None:
+            self._latency_target = float(config.get('sync_latency_target'))
+
+    def set_limit(self, rate, iops, image_name=None):
+        '''
+        Changes the limits of this node, or the specified image.
+
+        rate: the bandwidth in bytes per second.  0 means unlimited.
+        iops: the number of transfers per second.  0 means unlimited.
+        image_name: the name of a disk image, or None to change the
+            limits of the total transfers.
+        '''
+        try:
+            self._lock.acquire()
+            if image_name is None:
+                (bandwidth, iops_bucket) = (self._bandwidth, self._iops)
+            else:
+                if rate == 0 and iops == 0:
+                    self._images.pop(image_name, None)
+                    return
+                if image_name not in self._images:
+                    self._images[image_name] = (UKAITokenBucket(),
+                                                UKAITokenBucket())
+                (bandwidth, iops_bucket) = self._images[image_name]
+        finally:
+            self._lock.release()
+        bandwidth.set_rate(rate)
+        iops_bucket.set_rate(iops)
+
+    def get_limits(self):
+        '''
+        Returns a dictionary of the current limits.  The rate and iops
+        keys are the limits of the total transfers, the images key is
+        a dictionary of the limits per image, and the factor key is
+        the ratio currently applied to the limits because of the
+        foreground latency.
+        '''
+        try:
+            self._lock.acquire()
+            images = {}
+            for image_name in self._images:
+                (bandwidth, iops_bucket) = self._images[image_name]
+                images[image_name] = {'rate': bandwidth.rate,
+                                      'iops': iops_bucket.rate}
+            return ({'rate': self._bandwidth.rate,
+                     'iops': self._iops.rate,
+                     'images': images,
+                     'factor': self._factor,
+                     'latency': self._latency,
+                     'latency_target': self._latency_target})
+        finally:
+            self._lock.release()
+
+    def consume(self, image_name, size):
+        '''
+        Waits until a transfer of the specified size of the image is
+        allowed.
+        '''
+        try:
+            self._lock.acquire()
+            now = time.time()
+            if (self._factor < 1.0
+                and now - self._sampled > UKAI_THROTTLE_ADJUST_INTERVAL
+                and now - self._adjusted > UKAI_THROTTLE_ADJUST_INTERVAL):
+                # no foreground I/O recently.
+                self._adjusted = now
+                self._factor = min(self._factor + UKAI_THROTTLE_FACTOR_STEP,
+                                   1.0)
+            factor = self._factor
+            # the limits of the image first, then the limits of the
+            # node.
+            buckets = []
+            if image_name in self._images:
+                buckets.append((self._images[image_name][0], size))
+                buckets.append((self._images[image_name][1], 1))
+            buckets.append((self._bandwidth, size))
+            buckets.append((self._iops, 1))
+        finally:
+            self._lock.release()
+        for (bucket, amount) in buckets:
+            bucket.consume(amount, factor)
+
+    def foreground_op(self, latency):
+        '''
+        Records the latency of a foreground read or write, and adjusts
+        the ratio applied to the limits.
+
+        latency: the time (in seconds) the operation took.
+        '''
+        if self._latency_target is None:
+            return
+        try:
+            self._lock.acquire()
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency = ((1 - UKAI_THROTTLE_LATENCY_WEIGHT)
+                                 * self._latency
+                                 + UKAI_THROTTLE_LATENCY_WEIGHT * latency)
+            now = time.time()
+            self._sampled = now
+            if now - self._adjusted < UKAI_THROTTLE_ADJUST_INTERVAL:
+                return
+            self._adjusted = now
+            if self._latency > self._latency_target:
+                self._factor = max(self._factor / 2,
+                                   UKAI_THROTTLE_FACTOR_MIN)
+            else:
+                self._factor = min(self._factor + UKAI_THROTTLE_FACTOR_STEP,
+                                   1.0)
+        finally:
+            self._lock.release()
+
+# The throttle of synchronization transfers of this process.
+ukai_sync_throttle = UKAISyncThrottle()
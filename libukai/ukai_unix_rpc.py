@@ -0,0 +1,213 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+'''
+The ukai_unix_rpc.py module provides an RPC transport over a UNIX
+domain socket.  It is used between the UKAI FUSE connector and the
+UKAI server running on the same node, and avoids the TCP/IP stack and
+the HTTP/XML encoding of the XML-RPC interface.  Each message is a
+length-prefixed pickled Python object.  Since a pickled object may
+execute arbitrary code when it is loaded, the socket is accessible
+only by its owner, both ends of a connection authenticate each other
+with the key specified by the unix_rpc_authkey configuration value
+before any request is received, and only the methods listed in
+UKAI_UNIX_RPC_METHODS are called.
+'''
+
+import errno
+import os
+import threading
+import xmlrpclib
+
+from multiprocessing.connection import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from multiprocessing.connection import answer_challenge, deliver_challenge
+
+from ukai_rpc import UKAIRPCClient, ukai_rpc_pool
+
+# the methods called by the FUSE connector and by the metadata
+# updates exchanged with the UKAI server.
+UKAI_UNIX_RPC_METHODS = ('getattr', 'open', 'release', 'read', 'readdir',
+                         'statfs', 'truncate', 'write',
+                         'proxy_update_metadata',
+                         'proxy_update_metadata_delta')
+
+def ukai_core_socket(config):
+    '''
+    Returns the path name of the UNIX domain socket of the UKAI
+    server, or None if the socket is not used.
+    '''
+    return (config.get('core_socket'))
+
+def ukai_fuse_socket(config):
+    '''
+    Returns the path name of the UNIX domain socket of the UKAI FUSE
+    connector running with an embedded UKAI core, or None if the
+    socket is not used.
+    '''
+    return (config.get('fuse_socket'))
+
+def ukai_unix_rpc_authkey(config):
+    '''
+    Returns the key to authenticate the connections of the UNIX
+    domain sockets, or None if the connections are not authenticated.
+    '''
+    if config.get('unix_rpc_authkey') is None:
+        return (None)
+    return (str(config.get('unix_rpc_authkey')))
+
+class UKAIUnixRPCConnection(object):
+    '''
+    The UKAIUnixRPCConnection class represents a connection to a
+    UKAIUnixRPCServer instance.
+    '''
+    def __init__(self, path, authkey=None):
+        '''
+        Raises multiprocessing.AuthenticationError if the server
+        doesn't have the same authkey.
+        '''
+        self._conn = Client(path, family='AF_UNIX', authkey=authkey)
+
+    def request(self, method, params, timeout=None):
+        '''
+        Sends a request and waits for its response.  A failure of the
+        remote method is reported as an xmlrpclib.Fault exception,
+        the same as the XML-RPC interface.  If timeout is specified
+        and the response is not received within timeout seconds,
+        IOError(ETIMEDOUT) is raised, and the connection must not be
+        used any more.
+        '''
+        self._conn.send((method, params))
+        if timeout is not None and not self._conn.poll(timeout):
+            raise IOError(errno.ETIMEDOUT, 'request timed out')
+        try:
+            (status, value) = self._conn.recv()
+        except EOFError:
+            raise IOError(errno.ECONNRESET, 'connection closed by peer')
+        if status != 0:
+            raise xmlrpclib.Fault(status, value)
+        return (value)
+
+    def close(self):
+        self._conn.close()
+
+class UKAIUnixRPCClient(UKAIRPCClient):
+    '''
+    The UKAIUnixRPCClient class calls methods of the UKAI server
+    through the UNIX domain socket specified by the core_socket
+    configuration value.
+    '''
+    def __init__(self, config, path=None, timeout=None):
+        '''
+        If timeout is specified, a call which doesn't complete within
+        timeout seconds raises IOError(ETIMEDOUT).
+        '''
+        self._config = config
+        self._path = path
+        if self._path is None:
+            self._path = ukai_core_socket(config)
+        self._timeout = timeout
+
+    def call(self, method, *params):
+        key = ('unix', self._path)
+        conn = ukai_rpc_pool.get(
+            key, lambda: UKAIUnixRPCConnection(
+                self._path, ukai_unix_rpc_authkey(self._config)))
+        try:
+            ret = conn.request(method, params, self._timeout)
+        except xmlrpclib.Fault:
+            ukai_rpc_pool.put(key, conn)
+            raise
+        except:
+            ukai_rpc_pool.discard(conn)
+            raise
+        ukai_rpc_pool.put(key, conn)
+        return ret
+
+class UKAIUnixRPCServer(object):
+    '''
+    The UKAIUnixRPCServer class dispatches requests received through a
+    UNIX domain socket to the methods of a registered instance listed
+    in UKAI_UNIX_RPC_METHODS.  Each connection is processed by its own
+    thread.
+    '''
+    def __init__(self, path, instance, authkey=None):
+        '''
+        Creates a listening socket at the specified path.  A stale
+        socket file left by a previous process is removed.  The socket
+        is accessible only by the owner of the process.
+
+        path: the path name of a UNIX domain socket.
+        instance: the object whose methods are called.
+        authkey: the key to authenticate connections, or None.
+        '''
+        self._instance = instance
+        self._authkey = authkey
+        sock_dir = os.path.dirname(path)
+        if sock_dir and not os.path.exists(sock_dir):
+            os.makedirs(sock_dir)
+        if os.path.exists(path):
+            os.unlink(path)
+        self._listener = Listener(path, family='AF_UNIX', backlog=16)
+        os.chmod(path, 0600)
+
+    def serve_forever(self):
+        while True:
+            conn = self._listener.accept()
+            thread = threading.Thread(target=self._handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, conn):
+        try:
+            if self._authkey is not None:
+                # authenticated here instead of in the accept() call so
+                # that a client which doesn't respond doesn't block
+                # the other clients.
+                try:
+                    deliver_challenge(conn, self._authkey)
+                    answer_challenge(conn, self._authkey)
+                except (AuthenticationError, EOFError, IOError), e:
+                    print 'Rejected a UNIX domain socket connection: %s' % e
+                    return
+            while True:
+                try:
+                    (method, params) = conn.recv()
+                except (EOFError, IOError):
+                    return
+                try:
+                    if method not in UKAI_UNIX_RPC_METHODS:
+                        raise AttributeError('method "%s" is not supported'
+                                             % method)
+                    ret = (0, getattr(self._instance, method)(*params))
+                except Exception, e:
+                    ret = (1, '%s:%s' % (e.__class__, e))
+                conn.send(ret)
+        finally:
+            conn.close()
@@ -0,0 +1,338 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+'''
+The ukai_write_back.py module provides a write-back buffer used by
+the FUSE connector.  Written data is kept in memory and written to
+the UKAI core asynchronously.
+'''
+
+import errno
+import threading
+import time
+
+# The buffered data is managed in units of this size.  Writes to the
+# same unit are merged, and each unit is written with one request.
+UKAI_WRITE_BACK_UNIT = 1024 * 1024
+# The maximum amount of buffered data in bytes.
+UKAI_WRITE_BACK_MAX_DIRTY_DEFAULT = 64 * 1024 * 1024
+# Buffered data older than this value (in seconds) is written.
+UKAI_WRITE_BACK_MAX_AGE_DEFAULT = 5.0
+
+class UKAIWriteBack(object):
+    '''
+    The UKAIWriteBack class buffers written data per file.  The data
+    is split at UKAI_WRITE_BACK_UNIT boundaries, and adjacent or
+    overlapping writes in a unit are merged into one extent.  A
+    background thread writes units older than the maximum age, or
+    the oldest units when the buffer is more than half full.  A
+    writer is blocked while the buffer is full.
+    '''
+    def __init__(self, config, writer):
+        '''
+        Initializes the buffer and starts the background thread.  The
+        write_back_max_dirty and write_back_max_age configuration
+        values are used.
+
+        config: an UKAIConfig instance.
+        writer: a function called as writer(path, data, offset) to
+            write data.  It must raise an exception on failure.
+        '''
+        self._writer = writer
+        self._max_dirty = UKAI_WRITE_BACK_MAX_DIRTY_DEFAULT
+        if config.get('write_back_max_dirty') is not None:
+            self._max_dirty = int(config.get('write_back_max_dirty'))
+        self._max_age = UKAI_WRITE_BACK_MAX_AGE_DEFAULT
+        if config.get('write_back_max_age') is not None:
+            self._max_age = float(config.get('write_back_max_age'))
+        self._cond = threading.Condition()
+        # path -> unit index -> {'time': first write time,
+        #                        'extents': [[offset, bytearray], ...]}
+        self._dirty = {}
+        # path -> a list of [offset, data] being written, in the
+        # order of the writes.
+        self._in_flight = {}
+        # path -> a lock serializing writes of the file, so that
+        # overlapping data is written in order, and reads of the file
+        # against the writes.
+        self._destage_locks = {}
+        # path -> the error number of a failed write.
+        self._errors = {}
+        self._dirty_bytes = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, path, data, offset):
+        '''
+        Buffers the data.  If the buffer is full, waits until enough
+        data is written.
+
+        Return values: the size of the data.
+        '''
+        self._cond.acquire()
+        try:
+            while (self._dirty_bytes + len(data) > self._max_dirty
+                   and self._dirty_bytes > 0):
+                self._cond.notify_all()
+                self._cond.wait()
+            units = self._dirty.setdefault(path, {})
+            pos = 0
+            while pos < len(data):
+                unit_idx = (offset + pos) / UKAI_WRITE_BACK_UNIT
+                unit_end = (unit_idx + 1) * UKAI_WRITE_BACK_UNIT
+                size = min(len(data) - pos, unit_end - (offset + pos))
+                if unit_idx not in units:
+                    units[unit_idx] = {'time': time.time(),
+                                       'extents': []}
+                self._merge(units[unit_idx], offset + pos,
+                            data[pos:pos + size])
+                pos += size
+            if self._dirty_bytes > self._max_dirty / 2:
+                self._cond.notify_all()
+        finally:
+            self._cond.release()
+        return (len(data))
+
+    def _merge(self, unit, offset, data):
+        # must be called with self._cond held.
+        start = offset
+        end = offset + len(data)
+        remaining = []
+        merged = []
+        for extent in unit['extents']:
+            extent_end = extent[0] + len(extent[1])
+            if extent_end < start or end < extent[0]:
+                remaining.append(extent)
+            else:
+                merged.append(extent)
+        if merged:
+            start = min(start, merged[0][0])
+            end = max(end, max([extent[0] + len(extent[1])
+                                for extent in merged]))
+        buf = bytearray(end - start)
+        for extent in merged:
+            buf[extent[0] - start:extent[0] - start + len(extent[1])] = \
+                extent[1]
+            self._dirty_bytes -= len(extent[1])
+        buf[offset - start:offset - start + len(data)] = data
+        self._dirty_bytes += len(buf)
+        remaining.append([start, buf])
+        remaining.sort()
+        unit['extents'] = remaining
+
+    def read(self, path, offset, size, reader):
+        '''
+        Returns the data read from the UKAI core with the buffered
+        data of the range applied.  The file is not written to the
+        UKAI core from taking the buffered data until it is applied,
+        so that neither data written in between is missed nor data
+        older than the UKAI core is applied.
+
+        offset: the offset of the read.
+        size: the requested size of the read.
+        reader: a function which reads the range from the UKAI core.
+        '''
+        lock = self._get_destage_lock(path)
+        lock.acquire()
+        try:
+            self._cond.acquire()
+            try:
+                extents = list(self._in_flight.get(path, []))
+                for unit_idx in range(offset / UKAI_WRITE_BACK_UNIT,
+                                      (offset + size - 1)
+                                      / UKAI_WRITE_BACK_UNIT + 1):
+                    unit = self._dirty.get(path, {}).get(unit_idx)
+                    if unit is not None:
+                        extents.extend(unit['extents'])
+            finally:
+                self._cond.release()
+            data = reader()
+            return (self._apply(data, offset, size, extents))
+        finally:
+            lock.release()
+
+    def _apply(self, data, offset, size, extents):
+        # buffered data may extend the read beyond the end of the
+        # file known to the UKAI core.
+        end = offset + len(data)
+        for (extent_offset, extent_data) in extents:
+            extent_end = extent_offset + len(extent_data)
+            if extent_offset < offset + size and offset < extent_end:
+                end = max(end, min(extent_end, offset + size))
+        if end == offset + len(data) and not extents:
+            return (data)
+        buf = bytearray(end - offset)
+        buf[0:len(data)] = data
+        for (extent_offset, extent_data) in extents:
+            start = max(offset, extent_offset)
+            stop = min(end, extent_offset + len(extent_data))
+            if start >= stop:
+                continue
+            buf[start - offset:stop - offset] = \
+                extent_data[start - extent_offset:stop - extent_offset]
+        return (str(buf))
+
+    def size(self, path):
+        '''
+        Returns the end offset of the buffered data of the file, or 0
+        if no data is buffered.
+        '''
+        end = 0
+        self._cond.acquire()
+        try:
+            for (extent_offset, extent_data) in self._in_flight.get(path,
+                                                                    []):
+                end = max(end, extent_offset + len(extent_data))
+            for unit in self._dirty.get(path, {}).values():
+                for (extent_offset, extent_data) in unit['extents']:
+                    end = max(end, extent_offset + len(extent_data))
+        finally:
+            self._cond.release()
+        return (end)
+
+    def flush(self, path):
+        '''
+        Writes all the buffered data of the file, and waits for the
+        completion.  If a write of the file has failed since the last
+        call, an IOError is raised.
+        '''
+        self._destage(path, None)
+        self._cond.acquire()
+        try:
+            error = self._errors.pop(path, None)
+        finally:
+            self._cond.release()
+        if error is not None:
+            raise IOError(error, 'write-back failed')
+
+    def stop(self):
+        '''
+        Writes all the buffered data and stops the background thread.
+        '''
+        self._cond.acquire()
+        try:
+            self._running = False
+            self._cond.notify_all()
+            paths = self._dirty.keys()
+        finally:
+            self._cond.release()
+        self._thread.join()
+        for path in paths:
+            self._destage(path, None)
+
+    def _run(self):
+        while True:
+            self._cond.acquire()
+            try:
+                if not self._running:
+                    return
+                self._cond.wait(self._max_age / 4)
+                now = time.time()
+                selected = []
+                for path in self._dirty:
+                    for unit_idx in self._dirty[path]:
+                        unit = self._dirty[path][unit_idx]
+                        selected.append((unit['time'], path, unit_idx))
+                selected.sort()
+                # write the old units, and the oldest ones until the
+                # buffer becomes half empty.
+                targets = []
+                dirty_bytes = self._dirty_bytes
+                for (first_write, path, unit_idx) in selected:
+                    if (now - first_write < self._max_age
+                        and dirty_bytes <= self._max_dirty / 2):
+                        break
+                    targets.append((path, unit_idx))
+                    dirty_bytes -= sum(
+                        [len(extent[1]) for extent
+                         in self._dirty[path][unit_idx]['extents']])
+            finally:
+                self._cond.release()
+            for (path, unit_idx) in targets:
+                self._destage(path, [unit_idx])
+
+    def _destage(self, path, unit_indexes):
+        '''
+        Writes the specified units of the file, or all the units if
+        unit_indexes is None.
+        '''
+        lock = self._get_destage_lock(path)
+        lock.acquire()
+        try:
+            self._cond.acquire()
+            try:
+                units = self._dirty.get(path, {})
+                if unit_indexes is None:
+                    unit_indexes = sorted(units.keys())
+                extents = []
+                for unit_idx in unit_indexes:
+                    unit = units.pop(unit_idx, None)
+                    if unit is not None:
+                        extents.extend(unit['extents'])
+                if not units:
+                    self._dirty.pop(path, None)
+                in_flight = self._in_flight.setdefault(path, [])
+                in_flight.extend(extents)
+            finally:
+                self._cond.release()
+            for extent in extents:
+                try:
+                    self._writer(path, str(extent[1]), extent[0])
+                except Exception, e:
+                    self._fail(path, extent, e)
+                self._cond.acquire()
+                try:
+                    in_flight.remove(extent)
+                    if not in_flight:
+                        self._in_flight.pop(path, None)
+                    self._dirty_bytes -= len(extent[1])
+                    self._cond.notify_all()
+                finally:
+                    self._cond.release()
+        finally:
+            lock.release()
+
+    def _get_destage_lock(self, path):
+        self._cond.acquire()
+        try:
+            return (self._destage_locks.setdefault(path, threading.Lock()))
+        finally:
+            self._cond.release()
+
+    def _fail(self, path, extent, e):
+        # records the error to be reported by flush().  the data is
+        # discarded, the same as the kernel page cache does on a
+        # writeback error.
+        self._cond.acquire()
+        try:
+            self._errors[path] = getattr(e, 'errno', None) or errno.EIO
+        finally:
+            self._cond.release()
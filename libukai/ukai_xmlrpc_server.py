@@ -0,0 +1,441 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+'''
+The ukai_xmlrpc_server.py module provides an event driven XML-RPC
+server.  A single thread waits for incoming requests on all the
+connections, and each request is processed by one of a fixed number
+of worker threads.  When all the workers are busy, or a client has
+too many requests in progress, the server stops reading from the
+connections and lets TCP flow control push back to the clients,
+instead of spawning more threads.
+
+A request may call other UKAI servers, which may call this server in
+turn, for example ctl_synchronize calls proxy_pull, and proxy_pull
+reads with proxy_readv.  To avoid a deadlock when the workers are all
+waiting for such nested requests, the requests are processed by
+separate pools of workers by their nesting level: the proxy_pull
+method, the other proxy_* methods which never call other servers, and
+the rest.  A request only waits for requests of a later pool.
+'''
+
+import collections
+import errno
+import fcntl
+import os
+import select
+import socket
+import threading
+import time
+import Queue
+
+from SimpleXMLRPCServer import SimpleXMLRPCServer
+from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
+
+UKAI_SERVER_MODE_THREADING = 'threading'
+UKAI_SERVER_MODE_EVENT = 'event'
+
+UKAI_SERVER_WORKERS_DEFAULT = 16
+UKAI_SERVER_QUEUE_SIZE_DEFAULT = 64
+UKAI_SERVER_CLIENT_INFLIGHT_DEFAULT = 8
+UKAI_SERVER_MAX_CONNECTIONS_DEFAULT = 256
+UKAI_SERVER_IDLE_TIMEOUT_DEFAULT = 300
+
+# the worker pools.  a request of a pool only calls methods of the
+# later pools.
+UKAI_SERVER_POOL_MAIN = 0
+UKAI_SERVER_POOL_PULL = 1
+UKAI_SERVER_POOL_PROXY = 2
+UKAI_SERVER_POOLS = 3
+# the number of bytes looked ahead to find the method name of a
+# request.
+UKAI_SERVER_PEEK_SIZE = 4096
+
+def ukai_server_pool(method):
+    '''
+    Returns the worker pool which processes the specified method.  An
+    unknown method is processed by the main pool.
+    '''
+    if method == 'proxy_pull':
+        return (UKAI_SERVER_POOL_PULL)
+    if method is not None and method.startswith('proxy_'):
+        return (UKAI_SERVER_POOL_PROXY)
+    return (UKAI_SERVER_POOL_MAIN)
+
+def ukai_server_mode(config):
+    '''
+    Returns the XML-RPC server mode specified by the server_mode
+    configuration value.
+    '''
+    if config.get('server_mode') is None:
+        return (UKAI_SERVER_MODE_THREADING)
+    return (config.get('server_mode'))
+
+def _persistent_handler_class(handler_class):
+    '''
+    Returns a subclass of the specified request handler class whose
+    constructor only sets up the handler.  The constructor of
+    BaseRequestHandler processes the whole connection.
+    '''
+    class UKAIPersistentRequestHandler(handler_class):
+        def __init__(self, request, client_address, server):
+            self.request = request
+            self.client_address = client_address
+            self.server = server
+            self.setup()
+    return (UKAIPersistentRequestHandler)
+
+class UKAIEventXMLRPCConnection(object):
+    '''
+    The UKAIEventXMLRPCConnection class keeps the state of a client
+    connection between requests.
+    '''
+    def __init__(self, sock, client_address, server):
+        self.sock = sock
+        self.client_address = client_address
+        self.last_active = time.time()
+        # the request handler is created when the first request
+        # arrives, and reused until the connection is closed.
+        self._handler = None
+        self._server = server
+        # the worker pool of the current request.
+        self.pool = UKAI_SERVER_POOL_MAIN
+
+    def fileno(self):
+        return (self.sock.fileno())
+
+    def peek_method(self):
+        '''
+        Returns the method name of the request received on the
+        socket without consuming it, or None if the name has not
+        been received yet.  XML-RPC clients send the HTTP headers and
+        the beginning of the body at once, so the name is usually
+        found in the first segment.
+        '''
+        try:
+            data = self.sock.recv(UKAI_SERVER_PEEK_SIZE, socket.MSG_PEEK)
+        except socket.error:
+            return (None)
+        start = data.find('<methodName>')
+        if start < 0:
+            return (None)
+        start += len('<methodName>')
+        end = data.find('</methodName>', start)
+        if end < 0:
+            return (None)
+        return (data[start:end].strip())
+
+    def handle_one_request(self):
+        '''
+        Processes one request.
+
+        Return values: True if the connection can be reused,
+        otherwise False.
+        '''
+        if self._handler is None:
+            self._handler = self._server.persistent_handler_class(
+                self.sock, self.client_address, self._server)
+        self._handler.close_connection = 1
+        self._handler.handle_one_request()
+        if self._handler.close_connection:
+            return (False)
+        # the socket is not readable if the next request has been
+        # read into the buffer of the handler already.  XML-RPC
+        # clients don't pipeline requests, so this rarely happens.
+        while self._buffered():
+            self._handler.close_connection = 1
+            self._handler.handle_one_request()
+            if self._handler.close_connection:
+                return (False)
+        return (True)
+
+    def _buffered(self):
+        rbuf = getattr(self._handler.rfile, '_rbuf', None)
+        if rbuf is None:
+            return (False)
+        rbuf.seek(0, 2)
+        return (rbuf.tell() > 0)
+
+    def close(self):
+        try:
+            if self._handler is not None:
+                self._handler.finish()
+        except socket.error:
+            pass
+        self._server.shutdown_request(self.sock)
+
+class UKAIEventXMLRPCServer(SimpleXMLRPCServer):
+    '''
+    The UKAIEventXMLRPCServer class is an XML-RPC server which
+    processes requests with a bounded pool of worker threads.  The
+    following configuration values are used.
+
+    server_workers: the number of worker threads of the main pool.
+    server_proxy_workers: the number of worker threads of each pool
+        of the proxy_* methods.
+    server_queue_size: the number of requests waiting for a worker.
+    server_client_inflight: the maximum number of requests processed
+        or queued at the same time for one client address.
+    server_max_connections: the maximum number of client connections.
+        New connections are not accepted beyond this number.
+    '''
+    def __init__(self, addr, config,
+                 requestHandler=SimpleXMLRPCRequestHandler,
+                 logRequests=True, allow_none=False):
+        SimpleXMLRPCServer.__init__(self, addr,
+                                    requestHandler=requestHandler,
+                                    logRequests=logRequests,
+                                    allow_none=allow_none)
+        self.persistent_handler_class = _persistent_handler_class(
+            requestHandler)
+        workers = UKAI_SERVER_WORKERS_DEFAULT
+        if config.get('server_workers') is not None:
+            workers = config.get('server_workers')
+        proxy_workers = workers
+        if config.get('server_proxy_workers') is not None:
+            proxy_workers = config.get('server_proxy_workers')
+        # the number of workers of each pool.
+        self._workers = [workers, proxy_workers, proxy_workers]
+        queue_size = UKAI_SERVER_QUEUE_SIZE_DEFAULT
+        if config.get('server_queue_size') is not None:
+            queue_size = config.get('server_queue_size')
+        self._client_inflight = UKAI_SERVER_CLIENT_INFLIGHT_DEFAULT
+        if config.get('server_client_inflight') is not None:
+            self._client_inflight = config.get('server_client_inflight')
+        self._max_connections = UKAI_SERVER_MAX_CONNECTIONS_DEFAULT
+        if config.get('server_max_connections') is not None:
+            self._max_connections = config.get('server_max_connections')
+        self._idle_timeout = getattr(requestHandler, 'timeout', None)
+        if self._idle_timeout is None:
+            self._idle_timeout = UKAI_SERVER_IDLE_TIMEOUT_DEFAULT
+
+        self._queues = [Queue.Queue(queue_size)
+                        for pool in range(0, UKAI_SERVER_POOLS)]
+        # connections whose request has been processed by a worker.
+        self._done = Queue.Queue()
+        # connections which have a request but are not dispatched
+        # because of the limits.
+        self._deferred = collections.deque()
+        # connections waiting for a request, keyed by descriptor.
+        self._idle = {}
+        self._connection_count = 0
+        # (pool, client address) -> the number of requests.
+        self._inflight = {}
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._poller = None
+        self._accepting = False
+        self._running = False
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+        self._stats = {'requests': 0,
+                       'deferred': 0,
+                       'closed_idle': 0}
+
+    def serve_forever(self, poll_interval=0.5):
+        '''
+        Waits for requests and dispatches them to the worker threads
+        until shutdown() is called.
+        '''
+        self._is_shut_down.clear()
+        self._running = True
+        for pool in range(0, UKAI_SERVER_POOLS):
+            for i in range(0, self._workers[pool]):
+                worker = threading.Thread(target=self._work,
+                                          args=(self._queues[pool],))
+                worker.daemon = True
+                worker.start()
+        self._poller = select.poll()
+        self._poller.register(self._wakeup_r, select.POLLIN)
+        self._start_accepting()
+        last_expire = time.time()
+        try:
+            while self._running:
+                try:
+                    events = self._poller.poll(poll_interval * 1000)
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for (fd, event) in events:
+                    if fd == self._wakeup_r:
+                        self._drain_wakeup()
+                    elif fd == self.fileno():
+                        self._accept()
+                    elif fd in self._idle:
+                        conn = self._idle.pop(fd)
+                        self._poller.unregister(fd)
+                        conn.pool = ukai_server_pool(conn.peek_method())
+                        if not self._dispatch_connection(conn):
+                            self._stats['deferred'] += 1
+                self._collect_done()
+                now = time.time()
+                if now - last_expire > poll_interval:
+                    self._expire_idle(now)
+                    last_expire = now
+        finally:
+            for pool in range(0, UKAI_SERVER_POOLS):
+                for i in range(0, self._workers[pool]):
+                    self._queues[pool].put(None)
+            for conn in self._idle.values():
+                conn.close()
+            self._idle.clear()
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        '''
+        Stops the serve_forever loop and waits until it exits.
+        '''
+        self._running = False
+        self._wakeup()
+        self._is_shut_down.wait()
+
+    def get_stats(self):
+        '''
+        Returns the statistics of the server as a dictionary object.
+        '''
+        stats = dict(self._stats)
+        stats['connections'] = self._connection_count
+        stats['queued'] = sum([queue.qsize() for queue in self._queues])
+        stats['waiting'] = len(self._deferred)
+        return (stats)
+
+    def _start_accepting(self):
+        if not self._accepting:
+            self._poller.register(self.fileno(), select.POLLIN)
+            self._accepting = True
+
+    def _stop_accepting(self):
+        if self._accepting:
+            self._poller.unregister(self.fileno())
+            self._accepting = False
+
+    def _accept(self):
+        try:
+            (sock, client_address) = self.get_request()
+        except socket.error:
+            return
+        self._connection_count += 1
+        if self._connection_count >= self._max_connections:
+            # leave new connections in the listen backlog.
+            self._stop_accepting()
+        self._wait_request(UKAIEventXMLRPCConnection(sock, client_address,
+                                                     self))
+
+    def _wait_request(self, conn):
+        conn.last_active = time.time()
+        self._idle[conn.fileno()] = conn
+        self._poller.register(conn.fileno(),
+                              select.POLLIN | select.POLLPRI)
+
+    def _close(self, conn):
+        conn.close()
+        self._connection_count -= 1
+        if self._connection_count < self._max_connections:
+            self._start_accepting()
+
+    def _dispatch_connection(self, conn):
+        '''
+        Passes a connection which has a request to the workers.  If
+        the request cannot be processed now, the connection is kept
+        in the deferred list, and the request stays in the socket
+        buffer until a worker becomes available.
+
+        Return values: True if dispatched, otherwise False.
+        '''
+        key = (conn.pool, conn.client_address[0])
+        if self._inflight.get(key, 0) >= self._client_inflight:
+            self._deferred.append(conn)
+            return (False)
+        try:
+            self._queues[conn.pool].put_nowait(conn)
+        except Queue.Full:
+            self._deferred.append(conn)
+            return (False)
+        self._inflight[key] = self._inflight.get(key, 0) + 1
+        return (True)
+
+    def _collect_done(self):
+        completed = False
+        while True:
+            try:
+                (conn, keep) = self._done.get_nowait()
+            except Queue.Empty:
+                break
+            completed = True
+            self._stats['requests'] += 1
+            key = (conn.pool, conn.client_address[0])
+            self._inflight[key] -= 1
+            if self._inflight[key] == 0:
+                del self._inflight[key]
+            if keep:
+                self._wait_request(conn)
+            else:
+                self._close(conn)
+        if completed:
+            for i in range(0, len(self._deferred)):
+                self._dispatch_connection(self._deferred.popleft())
+
+    def _expire_idle(self, now):
+        for (fd, conn) in self._idle.items():
+            if now - conn.last_active > self._idle_timeout:
+                del self._idle[fd]
+                self._poller.unregister(fd)
+                self._close(conn)
+                self._stats['closed_idle'] += 1
+
+    def _work(self, queue):
+        while True:
+            conn = queue.get()
+            if conn is None:
+                return
+            keep = False
+            try:
+                keep = conn.handle_one_request()
+            except Exception:
+                self.handle_error(conn.sock, conn.client_address)
+            self._done.put((conn, keep))
+            self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError, e:
+            # the pipe is full.  the loop will wake up anyway.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _drain_wakeup(self):
+        try:
+            os.read(self._wakeup_r, 4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
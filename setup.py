@@ -13,6 +13,7 @@ setup(name='ukai',
       scripts=['scripts/ukai_server',
                'scripts/ukai_fuse',
                'scripts/ukai_admin',
+               'scripts/ukai_bench',
                ],
       data_files=[('share/doc/ukai', ['ukai_logo.png'])],
       classifiers=[
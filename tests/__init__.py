@@ -0,0 +1,64 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+''' Tests of the UKAI modules.  The modules are tested with an empty
+configuration file instead of the one of the machine.
+'''
+
+import atexit
+import json
+import os
+import tempfile
+
+def _create_config_file(values):
+    (fd, path) = tempfile.mkstemp()
+    try:
+        os.write(fd, json.dumps(values))
+    finally:
+        os.close(fd)
+    return (path)
+
+# some modules read the configuration file when they are imported.
+os.environ['UKAI_CONFIG'] = _create_config_file({})
+atexit.register(os.unlink, os.environ['UKAI_CONFIG'])
+
+from libukai.ukai_config import UKAIConfig
+
+def ukai_test_config(values=None):
+    '''
+    Returns an UKAIConfig instance which has only the specified
+    configuration values.
+
+    values: a dictionary of configuration values, or None.
+    '''
+    path = _create_config_file(values or {})
+    try:
+        return (UKAIConfig(path))
+    finally:
+        os.unlink(path)
@@ -0,0 +1,235 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+''' Tests of the binary data transport.
+'''
+
+import errno
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from libukai import ukai_binary_rpc
+from libukai.ukai_binary_rpc import UKAIBinaryRPCCall, UKAIBinaryRPCError
+from libukai.ukai_binary_rpc import UKAIBinaryRPCServer
+from libukai.ukai_binary_rpc import _request_header, _response_header
+from libukai.ukai_binary_rpc import UKAI_BINARY_RPC_ECANCELED
+from libukai.ukai_binary_rpc import UKAI_BINARY_RPC_MAGIC
+from libukai.ukai_binary_rpc import UKAI_BINARY_RPC_VERSION
+from libukai.ukai_binary_rpc import UKAI_BINARY_RPC_OP_READ
+
+from tests import ukai_test_config
+
+BLOCK_SIZE = 4096
+
+class UKAIBinaryRPCTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.data_root = tempfile.mkdtemp()
+        config = ukai_test_config({'data_root': cls.data_root,
+                                   'blockname_format': '%016d'})
+        cls.server = UKAIBinaryRPCServer(('127.0.0.1', 0), config)
+        cls.port = cls.server.server_address[1]
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.data_root)
+
+    def tearDown(self):
+        for conn in ukai_binary_rpc._connections.values():
+            conn.close()
+        ukai_binary_rpc._connections.clear()
+
+    def _call(self, compress=False):
+        return (UKAIBinaryRPCCall('127.0.0.1', self.port, compress, 10.0))
+
+    def test_headers(self):
+        # the fixed size fields are packed in the network byte order.
+        header = _request_header.pack(UKAI_BINARY_RPC_MAGIC,
+                                      UKAI_BINARY_RPC_VERSION,
+                                      UKAI_BINARY_RPC_OP_READ, 0, 4, 7,
+                                      BLOCK_SIZE, 3, 100, 200, 0)
+        self.assertEqual(len(header), 48)
+        self.assertEqual(header[:2], 'UK')
+        self.assertEqual(_request_header.unpack(header),
+                         (UKAI_BINARY_RPC_MAGIC, UKAI_BINARY_RPC_VERSION,
+                          UKAI_BINARY_RPC_OP_READ, 0, 4, 7, BLOCK_SIZE, 3,
+                          100, 200, 0))
+        header = _response_header.pack(UKAI_BINARY_RPC_MAGIC,
+                                       UKAI_BINARY_RPC_VERSION,
+                                       UKAI_BINARY_RPC_OP_READ, 0, 7,
+                                       errno.EIO, 200, 0)
+        self.assertEqual(len(header), 26)
+        self.assertEqual(_response_header.unpack(header)[5], errno.EIO)
+
+    def test_read_write(self):
+        call = self._call()
+        # a block not written yet is read as zeros.
+        self.assertEqual(call.read('a', BLOCK_SIZE, 0, 0, 16), '\0' * 16)
+        self.assertEqual(call.write('a', BLOCK_SIZE, 0, 100, 'x' * 10), 10)
+        self.assertEqual(call.read('a', BLOCK_SIZE, 0, 98, 14),
+                         '\0\0' + 'x' * 10 + '\0\0')
+        # the image name taken from the metadata is unicode.
+        self.assertEqual(call.read(u'a', BLOCK_SIZE, 0, 100, 10), 'x' * 10)
+
+    def test_compress(self):
+        call = self._call(compress=True)
+        data = 'abc' * 1000
+        self.assertEqual(call.write('b', BLOCK_SIZE, 1, 0, data),
+                         len(data))
+        self.assertEqual(call.read('b', BLOCK_SIZE, 1, 0, len(data)), data)
+        self.assertEqual(self._call().read('b', BLOCK_SIZE, 1, 0, 3), 'abc')
+
+    def test_readv_writev(self):
+        for compress in (False, True):
+            call = self._call(compress)
+            image_name = 'd%d' % compress
+            pieces = [(0, BLOCK_SIZE - 4, 4), (1, 0, 6), (3, 10, 2)]
+            self.assertEqual(call.writev(image_name, BLOCK_SIZE, pieces,
+                                         'aaaabbbbbbcc'), 12)
+            self.assertEqual(call.read(image_name, BLOCK_SIZE, 1, 0, 6),
+                             'bbbbbb')
+            # the pieces are returned in the requested order, and the
+            # blocks not written yet are read as zeros.
+            pieces = [(3, 8, 4), (2, 0, 2), (0, BLOCK_SIZE - 4, 4)]
+            self.assertEqual(call.readv(image_name, BLOCK_SIZE, pieces),
+                             '\0\0cc' + '\0\0' + 'aaaa')
+            self.assertEqual(call.readv(image_name, BLOCK_SIZE, []), '')
+
+    def test_error(self):
+        conn = ukai_binary_rpc._get_connection('127.0.0.1', self.port)
+        request = conn.submit(99, 0, 'a', BLOCK_SIZE, 0, 0, 0)
+        try:
+            request.wait(10.0)
+            self.fail('an unknown operation must fail')
+        except UKAIBinaryRPCError, e:
+            self.assertEqual(e.errno, errno.EINVAL)
+        # the error doesn't break the connection.
+        self.assertFalse(conn.closed)
+        self.assertEqual(self._call().read('a', BLOCK_SIZE, 0, 0, 4),
+                         '\0' * 4)
+
+    def test_multiplex(self):
+        call = self._call()
+        writes = [call.write_async('c', BLOCK_SIZE, 0, i * 8,
+                                   '%08d' % i)
+                  for i in range(0, 64)]
+        self.assertEqual([request.wait(10.0) for request in writes],
+                         [8] * 64)
+        reads = [call.read_async('c', BLOCK_SIZE, 0, i * 8, 8)
+                 for i in range(0, 64)]
+        self.assertEqual([request.wait(10.0) for request in reads],
+                         ['%08d' % i for i in range(0, 64)])
+        # all the requests share one connection.
+        self.assertEqual(len(set([request.connection
+                                  for request in writes + reads])), 1)
+        self.assertEqual(len(ukai_binary_rpc._connections), 1)
+
+    def test_callback(self):
+        errors = []
+        done = threading.Event()
+        def callback(error):
+            errors.append(error)
+            done.set()
+
+        request = self._call().read_async('a', BLOCK_SIZE, 0, 0, 4)
+        request.add_done_callback(callback)
+        self.assertTrue(done.wait(10.0))
+        self.assertTrue(request.done())
+        # called immediately once the request has completed.
+        request.add_done_callback(callback)
+        self.assertEqual(errors, [None, None])
+
+    def _silent_port(self):
+        # a node which accepts connections but never responds.
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        return (listener.getsockname()[1])
+
+    def test_cancel(self):
+        conn = ukai_binary_rpc._get_connection('127.0.0.1',
+                                               self._silent_port())
+        request = conn.submit(UKAI_BINARY_RPC_OP_READ, 0, 'a', BLOCK_SIZE,
+                              0, 0, 4)
+        errors = []
+        request.add_done_callback(errors.append)
+        request.cancel()
+        self.assertTrue(request.done())
+        try:
+            request.wait(10.0)
+            self.fail('a cancelled request must fail')
+        except UKAIBinaryRPCError, e:
+            self.assertEqual(e.errno, UKAI_BINARY_RPC_ECANCELED)
+        self.assertEqual(errors[0].errno, UKAI_BINARY_RPC_ECANCELED)
+        self.assertFalse(conn.closed)
+
+    def test_timeout(self):
+        port = self._silent_port()
+        call = UKAIBinaryRPCCall('127.0.0.1', port, False, 0.1)
+        try:
+            call.read('a', BLOCK_SIZE, 0, 0, 4)
+            self.fail('the request must time out')
+        except UKAIBinaryRPCError, e:
+            self.assertEqual(e.errno, errno.ETIMEDOUT)
+        # the request timed out is forgotten.
+        conn = ukai_binary_rpc._get_connection('127.0.0.1', port)
+        self.assertEqual(conn._pending, {})
+
+    def test_closed_connection(self):
+        conn = ukai_binary_rpc._get_connection('127.0.0.1', self.port)
+        conn.close()
+        self.assertTrue(conn.closed)
+        self.assertRaises(UKAIBinaryRPCError, conn.submit,
+                          UKAI_BINARY_RPC_OP_READ, 0, 'a', BLOCK_SIZE, 0,
+                          0, 4)
+        # a new connection replaces the closed one.
+        self.assertEqual(self._call().read('a', BLOCK_SIZE, 0, 0, 4),
+                         '\0' * 4)
+        self.assertFalse(ukai_binary_rpc._connections.values()[0].closed)
+
+    def test_malformed_request(self):
+        sock = socket.create_connection(('127.0.0.1', self.port), 10.0)
+        try:
+            sock.sendall('\0' * _request_header.size)
+            # the server cannot resynchronize, and closes the stream.
+            self.assertEqual(sock.recv(1), '')
+        finally:
+            sock.close()
+
+if __name__ == '__main__':
+    unittest.main()
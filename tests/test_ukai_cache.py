@@ -0,0 +1,176 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+''' Tests of the in-memory and on-disk caches of block data.
+'''
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from libukai.ukai_cache import UKAIBlockCache, UKAIDiskCache
+
+from tests import ukai_test_config
+
+class UKAIBlockCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = UKAIBlockCache(size=10)
+
+    def test_get(self):
+        self.cache.put('image', 0, 2, 'abcd')
+        self.assertEqual(self.cache.get('image', 0, 2, 4), 'abcd')
+        # a part of a cached range.
+        self.assertEqual(self.cache.get('image', 0, 3, 2), 'bc')
+        self.assertEqual(self.cache.get('image', 0, 4, 4), None)
+        self.assertEqual(self.cache.get('image', 1, 2, 4), None)
+        self.assertEqual(self.cache.get('other', 0, 2, 4), None)
+
+    def test_evict(self):
+        self.cache.put('image', 0, 0, 'aaaa')
+        self.cache.put('image', 1, 0, 'bbbb')
+        # block 0 becomes the most recently used one.
+        self.assertEqual(self.cache.get('image', 0, 1, 2), 'aa')
+        self.cache.put('image', 2, 0, 'cccc')
+        self.assertEqual(self.cache.get('image', 1, 0, 4), None)
+        self.assertEqual(self.cache.get('image', 0, 0, 4), 'aaaa')
+        self.assertEqual(self.cache.get('image', 2, 0, 4), 'cccc')
+        self.assertEqual(self.cache._used, 8)
+
+    def test_replace(self):
+        self.cache.put('image', 0, 0, 'aaaa')
+        self.cache.put('image', 0, 0, 'bbbb')
+        self.assertEqual(self.cache.get('image', 0, 0, 4), 'bbbb')
+        self.assertEqual(self.cache._used, 4)
+        # data larger than the cache is not stored.
+        self.cache.put('image', 1, 0, 'c' * 11)
+        self.assertEqual(self.cache.get('image', 1, 0, 11), None)
+        self.assertEqual(self.cache.get('image', 0, 0, 4), 'bbbb')
+
+    def test_invalidate(self):
+        self.cache.put('image', 0, 0, 'aa')
+        self.cache.put('image', 0, 2, 'bb')
+        self.cache.put('image', 1, 0, 'cc')
+        self.cache.put('other', 0, 0, 'dd')
+        self.cache.invalidate('image', 0)
+        self.assertEqual(self.cache.get('image', 0, 0, 2), None)
+        self.assertEqual(self.cache.get('image', 0, 2, 2), None)
+        self.assertEqual(self.cache.get('image', 1, 0, 2), 'cc')
+        self.cache.invalidate('image')
+        self.assertEqual(self.cache.get('image', 1, 0, 2), None)
+        self.assertEqual(self.cache.get('other', 0, 0, 2), 'dd')
+        self.assertEqual(self.cache._used, 2)
+
+    def test_configure(self):
+        self.cache.put('image', 0, 0, 'aaaa')
+        self.cache.put('image', 1, 0, 'bbbb')
+        self.cache.configure(ukai_test_config({'cache_size': 4}))
+        self.assertEqual(self.cache.get('image', 0, 0, 4), None)
+        self.assertEqual(self.cache.get('image', 1, 0, 4), 'bbbb')
+        self.cache.configure(ukai_test_config({'cache_size': 0}))
+        self.assertFalse(self.cache.enabled)
+
+class UKAIDiskCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = self._create_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, True)
+
+    def _create_cache(self):
+        cache = UKAIDiskCache()
+        cache.configure(ukai_test_config({'cache_root': self.root,
+                                          'disk_cache_size': 10}))
+        return (cache)
+
+    def _wait_written(self, cache):
+        for idx in range(0, 100):
+            cache._lock.acquire()
+            try:
+                if not cache._pending:
+                    return
+            finally:
+                cache._lock.release()
+            time.sleep(0.01)
+        self.fail('the disk cache is not written')
+
+    def test_get(self):
+        self.cache.validate('image', 1)
+        self.cache.put('image', 0, 2, 'abcd')
+        self._wait_written(self.cache)
+        self.assertEqual(self.cache.get('image', 0, 3, 2), 'bc')
+        self.assertEqual(self.cache.get('image', 0, 4, 4), None)
+        self.assertEqual(self.cache.get('image', 1, 2, 4), None)
+
+    def test_evict(self):
+        self.cache.validate('image', 1)
+        for blk_idx in range(0, 3):
+            self.cache.put('image', blk_idx, 0, 'abcd')
+            self._wait_written(self.cache)
+        # the least recently used piece is evicted.
+        self.assertEqual(self.cache.get('image', 0, 0, 4), None)
+        self.assertEqual(self.cache.get('image', 2, 0, 4), 'abcd')
+
+    def test_removed_file(self):
+        self.cache.validate('image', 1)
+        self.cache.put('image', 0, 0, 'abcd')
+        self._wait_written(self.cache)
+        os.unlink(self.cache._piece_path(('image', 0, 0, 4)))
+        self.assertEqual(self.cache.get('image', 0, 0, 4), None)
+
+    def test_restart(self):
+        self.cache.validate('image', 1)
+        self.cache.put('image', 0, 0, 'abcd')
+        self._wait_written(self.cache)
+        self.cache._lock_fh.close()
+        # the data is kept while the epoch is not changed.
+        cache = self._create_cache()
+        cache.validate('image', 1)
+        self.assertEqual(cache.get('image', 0, 0, 4), 'abcd')
+        cache._lock_fh.close()
+        cache = self._create_cache()
+        cache.validate('image', 2)
+        self.assertEqual(cache.get('image', 0, 0, 4), None)
+
+    def test_contains(self):
+        self.cache.validate('image', 1)
+        self.cache.put('image', 0, 0, 'abcd')
+        self._wait_written(self.cache)
+        block_cache = UKAIBlockCache(disk_cache=self.cache)
+        self.assertTrue(block_cache.contains('image', 0, 1, 2))
+        self.assertFalse(block_cache.contains('image', 0, 2, 4))
+        # the data on disk is not copied to memory.
+        self.assertEqual(block_cache._get_memory('image', 0, 1, 2), None)
+        self.assertEqual(block_cache.get('image', 0, 1, 2), 'bc')
+        self.assertEqual(block_cache._get_memory('image', 0, 1, 2), 'bc')
+
+if __name__ == '__main__':
+    unittest.main()
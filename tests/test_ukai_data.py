@@ -0,0 +1,197 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+''' Tests of the data access of disk images.
+'''
+
+import errno
+import threading
+import time
+import unittest
+
+from libukai.ukai_binary_rpc import UKAIBinaryRPCError
+from libukai.ukai_binary_rpc import UKAIBinaryRPCRequest
+from libukai.ukai_cache import ukai_block_cache
+from libukai.ukai_data import UKAIData
+from libukai.ukai_metadata import UKAIMetadata, UKAI_IN_SYNC
+from libukai.ukai_node_error_state import UKAINodeErrorStateSet
+from libukai.ukai_node_latency import UKAI_NODE_LATENCY_MIN_SAMPLES
+from libukai.ukai_statistics import UKAIStatistics, UKAIImageStatistics
+
+from tests import ukai_test_config
+
+IMAGE_NAME = 'test_image'
+BLOCK_SIZE = 4096
+NUM_BLOCKS = 4
+REMOTE_NODES = ['10.0.0.1', '10.0.0.2']
+
+class FakeRequest(object):
+    def __init__(self, data):
+        self._data = data
+        self._callbacks = []
+
+    def add_done_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def complete(self):
+        for callback in self._callbacks:
+            callback(None)
+
+    def wait(self):
+        return (self._data)
+
+class FakeConnection(object):
+    def __init__(self):
+        self.cancelled = []
+
+    def cancel(self, request):
+        self.cancelled.append(request)
+
+class UKAIDataTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = ukai_test_config()
+        locations = dict([(node, {'sync_status': UKAI_IN_SYNC})
+                          for node in REMOTE_NODES])
+        metadata_raw = {'name': IMAGE_NAME,
+                        'size': BLOCK_SIZE * NUM_BLOCKS,
+                        'used_size': BLOCK_SIZE * NUM_BLOCKS,
+                        'block_size': BLOCK_SIZE,
+                        'block_extents': [[0, NUM_BLOCKS, locations]]}
+        self.metadata = UKAIMetadata(IMAGE_NAME, self.config, metadata_raw)
+        self.metadata.flush = lambda *args, **kwargs: None
+        self.data = UKAIData(self.metadata, UKAINodeErrorStateSet(),
+                             self.config)
+        self.requests = []
+        self.data._get_datav_async = self._get_datav_async
+        UKAIStatistics[IMAGE_NAME] = UKAIImageStatistics()
+
+    def tearDown(self):
+        ukai_block_cache.invalidate(IMAGE_NAME)
+        del UKAIStatistics[IMAGE_NAME]
+
+    def _get_datav_async(self, node, pieces):
+        request = FakeRequest(
+            ''.join([chr(ord('a') + piece[0]) * piece[2]
+                     for piece in pieces]))
+        self.requests.append(request)
+        return (request)
+
+    def _cached(self, blk_idx):
+        return (ukai_block_cache.get(IMAGE_NAME, blk_idx, 0, BLOCK_SIZE))
+
+    def test_prefetch(self):
+        self.data._prefetch(0, BLOCK_SIZE * 2)
+        for request in self.requests:
+            request.complete()
+        self.assertEqual(self._cached(0), 'a' * BLOCK_SIZE)
+        self.assertEqual(self._cached(1), 'b' * BLOCK_SIZE)
+        self.assertEqual(self._cached(2), None)
+        # the blocks cached already are not requested.
+        del self.requests[:]
+        self.data._prefetch(0, BLOCK_SIZE * 3)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_prefetch_during_write(self):
+        self.data._prefetch(0, BLOCK_SIZE * 2)
+        # block 1 is written before the prefetched data arrives.
+        self.data._invalidate_cache(1)
+        for request in self.requests:
+            request.complete()
+        self.assertEqual(self._cached(0), 'a' * BLOCK_SIZE)
+        self.assertEqual(self._cached(1), None)
+
+    def _hedge_setup(self, hedge_data=None, hedge_error=None):
+        # the first node has responded within 10ms so far.
+        for i in range(0, UKAI_NODE_LATENCY_MIN_SAMPLES):
+            start = self.data._node_latency_set.begin(REMOTE_NODES[0])
+            self.data._node_latency_set.end(REMOTE_NODES[0], start - 0.01)
+        self.config.set('hedge_reads', True)
+        self.hedged = []
+        def get_datav_async(node, pieces):
+            request = UKAIBinaryRPCRequest()
+            if hedge_error is not None:
+                request.complete(error=hedge_error)
+            elif hedge_data is not None:
+                request.complete(result=hedge_data)
+            self.hedged.append((node, request))
+            return (request)
+        self.data._get_datav_async = get_datav_async
+        request = UKAIBinaryRPCRequest()
+        request.connection = FakeConnection()
+        return (request)
+
+    def test_hedge(self):
+        request = self._hedge_setup(hedge_data='hedged')
+        self.assertEqual(self.data._wait_request(REMOTE_NODES[0], request,
+                                                 time.time(),
+                                                 [(0, 0, 6)]),
+                         'hedged')
+        self.assertEqual([node for (node, hedge) in self.hedged],
+                         [REMOTE_NODES[1]])
+        # the slow request is cancelled.
+        self.assertEqual(request.connection.cancelled, [request])
+        self.assertEqual(UKAIStatistics[IMAGE_NAME].stats['hedged_reads'],
+                         1)
+
+    def test_no_hedge(self):
+        request = self._hedge_setup(hedge_data='hedged')
+        request.complete(result='primary')
+        self.assertEqual(self.data._wait_request(REMOTE_NODES[0], request,
+                                                 time.time(),
+                                                 [(0, 0, 7)]),
+                         'primary')
+        self.assertEqual(self.hedged, [])
+
+    def test_hedge_failure(self):
+        request = self._hedge_setup(
+            hedge_error=UKAIBinaryRPCError(errno.EIO, 'hedge'))
+        # the first node responds after the hedged request fails.
+        timer = threading.Timer(0.1, request.complete,
+                                kwargs={'result': 'primary'})
+        timer.start()
+        self.assertEqual(self.data._wait_request(REMOTE_NODES[0], request,
+                                                 time.time(),
+                                                 [(0, 0, 7)]),
+                         'primary')
+        self.assertEqual(len(self.hedged), 1)
+
+    def test_deadline(self):
+        self.config.set('data_timeout', 0.1)
+        request = UKAIBinaryRPCRequest()
+        request.connection = FakeConnection()
+        try:
+            self.data._wait_request(REMOTE_NODES[0], request, time.time(),
+                                    [(0, 0, 1)])
+            self.fail('the request must time out')
+        except IOError, e:
+            self.assertEqual(e.errno, errno.ETIMEDOUT)
+        self.assertEqual(request.connection.cancelled, [request])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+''' Tests of the metadata stored in shards in ZooKeeper.
+'''
+
+import json
+import unittest
+
+from libukai.ukai_db import UKAIZooKeeperDB
+from libukai.ukai_db import UKAI_ZK_DB_CONTENTS_DIR
+
+class FakeStat(object):
+    def __init__(self, version):
+        self.version = version
+
+class FakeLock(object):
+    def __enter__(self):
+        return (self)
+
+    def __exit__(self, *args):
+        return (False)
+
+class FakeZooKeeperClient(object):
+    '''
+    An in-memory replacement of the kazoo client.  The operations
+    fail with IOError after fail_after more writes if it is set.
+    '''
+    def __init__(self):
+        # path -> [data, version]
+        self.nodes = {}
+        self.writes = []
+        self.fail_after = None
+
+    def _write(self, path):
+        if self.fail_after is not None:
+            if self.fail_after == 0:
+                raise IOError('write failure')
+            self.fail_after -= 1
+        self.writes.append(path)
+
+    def Lock(self, path, identifier):
+        return (FakeLock())
+
+    def exists(self, path):
+        if path not in self.nodes:
+            return (None)
+        return (FakeStat(self.nodes[path][1]))
+
+    def create(self, path, value=''):
+        assert path not in self.nodes
+        self._write(path)
+        self.nodes[path] = [value, 0]
+        return (path)
+
+    def set(self, path, value, version=-1):
+        assert version in (-1, self.nodes[path][1])
+        self._write(path)
+        self.nodes[path] = [value, self.nodes[path][1] + 1]
+        return (FakeStat(self.nodes[path][1]))
+
+    def get(self, path):
+        return (self.nodes[path][0], FakeStat(self.nodes[path][1]))
+
+    def delete(self, path, recursive=False):
+        for node_path in self.nodes.keys():
+            if (node_path == path
+                or (recursive and node_path.startswith(path + '/'))):
+                del self.nodes[node_path]
+
+    def get_children(self, path):
+        return ([node_path[len(path) + 1:] for node_path in self.nodes
+                 if node_path.startswith(path + '/')
+                 and '/' not in node_path[len(path) + 1:]])
+
+def blocks_of(metadata_raw):
+    blocks = []
+    for (start_idx, count, block) in metadata_raw['block_extents']:
+        blocks.extend([block] * count)
+    return (blocks)
+
+class UKAIZooKeeperDBTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = UKAIZooKeeperDB()
+        self.db._shard_blocks = 4
+        self.db._client = FakeZooKeeperClient()
+        self.contents_file = UKAI_ZK_DB_CONTENTS_DIR + '/image'
+        self.in_sync = {'10.0.0.1': {'sync_status': 0}}
+        self.out_of_sync = {'10.0.0.1': {'sync_status': 0},
+                            '10.0.0.2': {'sync_status': 2}}
+
+    def _metadata(self, blocks):
+        extents = []
+        for (blk_idx, block) in enumerate(blocks):
+            if extents and extents[-1][2] == block:
+                extents[-1][1] += 1
+            else:
+                extents.append([blk_idx, 1, block])
+        return ({'name': 'image', 'size': len(blocks), 'used_size': 0,
+                 'block_size': 1, 'block_extents': extents})
+
+    def _shard_names(self):
+        return (sorted(self.db._client.get_children(self.contents_file)))
+
+    def test_split_and_merge(self):
+        blocks = [self.in_sync] * 6 + [self.out_of_sync] * 4
+        self.db.put_metadata('image', self._metadata(blocks))
+        self.assertEqual(self._shard_names(), ['00000000-00000001',
+                                               '00000001-00000001',
+                                               '00000002-00000001'])
+        # another node reads the metadata.
+        reader = UKAIZooKeeperDB()
+        reader._client = self.db._client
+        metadata_raw = reader.get_metadata('image')
+        self.assertEqual(blocks_of(metadata_raw), blocks)
+        self.assertEqual(metadata_raw['block_extents'][:2],
+                         [[0, 4, self.in_sync], [4, 2, self.in_sync]])
+        self.assertEqual(reader.get_metadata_header('image'),
+                         {'name': 'image', 'size': 10, 'used_size': 0,
+                          'block_size': 1})
+
+    def test_changed_shard_only(self):
+        blocks = [self.in_sync] * 10
+        self.db.put_metadata('image', self._metadata(blocks))
+        del self.db._client.writes[:]
+        blocks[5] = self.out_of_sync
+        self.db.put_metadata('image', self._metadata(blocks))
+        self.assertEqual(self.db._client.writes,
+                         [self.contents_file + '/00000001-00000002',
+                          self.contents_file])
+        self.assertEqual(self._shard_names(), ['00000000-00000001',
+                                               '00000001-00000002',
+                                               '00000002-00000001'])
+        self.assertEqual(blocks_of(self.db.get_metadata('image')), blocks)
+
+    def test_failed_write(self):
+        old_blocks = [self.in_sync] * 10
+        self.db.put_metadata('image', self._metadata(old_blocks))
+        blocks = [self.out_of_sync] * 10
+        # the header is not written.
+        self.db._client.fail_after = 2
+        self.assertRaises(IOError, self.db.put_metadata, 'image',
+                          self._metadata(blocks))
+        self.db._client.fail_after = None
+        self.assertEqual(blocks_of(self.db.get_metadata('image')),
+                         old_blocks)
+
+        # the shards left by the failed write are removed.
+        self.db.put_metadata('image', self._metadata(old_blocks[:8]))
+        self.assertEqual(self._shard_names(), ['00000000-00000001',
+                                               '00000001-00000001'])
+        self.assertEqual(blocks_of(self.db.get_metadata('image')),
+                         old_blocks[:8])
+
+    def test_whole_metadata(self):
+        # the format before the metadata was sharded.
+        metadata_raw = {'name': 'image', 'size': 2, 'used_size': 2,
+                        'block_size': 1,
+                        'blocks': [self.in_sync, self.out_of_sync]}
+        self.db._client.create(self.contents_file, json.dumps(metadata_raw))
+        self.assertEqual(self.db.get_metadata('image'), metadata_raw)
+        self.db.delete_metadata('image')
+        self.assertEqual(self.db.get_metadata('image'), None)
+
+if __name__ == '__main__':
+    unittest.main()
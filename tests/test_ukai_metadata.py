@@ -0,0 +1,249 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+''' Tests of the compact representation of the locations of blocks.
+'''
+
+import json
+import threading
+import unittest
+import xmlrpclib
+import zlib
+
+from libukai import ukai_metadata
+from libukai.ukai_metadata import UKAIMetadata, UKAIStripedLock
+from libukai.ukai_metadata import UKAI_IN_SYNC, UKAI_OUT_OF_SYNC
+from libukai.ukai_metadata import UKAI_SYNCING
+from libukai.ukai_metadata import ukai_metadata_get_block_extents
+from libukai.ukai_metadata import UKAI_LOCATIONS_MAX
+from libukai.ukai_rpc import UKAIXMLRPCTranslation
+
+from tests import ukai_test_config
+
+IMAGE_NAME = 'test_image'
+BLOCK_SIZE = 65536
+
+class UKAIMetadataTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = ukai_test_config()
+
+    def _create(self, num_blocks, nodes):
+        locations = dict([(node, {'sync_status': UKAI_IN_SYNC})
+                          for node in nodes])
+        metadata_raw = {'name': IMAGE_NAME,
+                        'size': BLOCK_SIZE * num_blocks,
+                        'used_size': BLOCK_SIZE * num_blocks,
+                        'block_size': BLOCK_SIZE,
+                        'block_extents': [[0, num_blocks, locations]]}
+        metadata = UKAIMetadata(IMAGE_NAME, self.config, metadata_raw)
+        metadata.flush = lambda *args, **kwargs: None
+        return (metadata)
+
+    def test_many_locations(self):
+        nodes = ['10.0.%d.%d' % (i / 256, i % 256)
+                 for i in range(0, UKAI_LOCATIONS_MAX + 8)]
+        metadata = self._create(4, nodes[:UKAI_LOCATIONS_MAX])
+        for node in nodes[UKAI_LOCATIONS_MAX:]:
+            metadata.add_location(node, 1, 2)
+        self.assertEqual(sorted(metadata.get_locations(1)), sorted(nodes))
+        self.assertEqual(sorted(metadata.get_locations(3)),
+                         sorted(nodes[:UKAI_LOCATIONS_MAX]))
+        self.assertEqual(metadata.get_sync_status(2, nodes[-1]),
+                         UKAI_OUT_OF_SYNC)
+        metadata.set_sync_status(2, nodes[-1], UKAI_IN_SYNC)
+
+        # the stored form is loaded again.
+        loaded = UKAIMetadata(IMAGE_NAME, self.config, metadata.metadata)
+        self.assertEqual(list(loaded.blocks), list(metadata.blocks))
+        self.assertEqual(loaded.get_sync_status(2, nodes[-1]), UKAI_IN_SYNC)
+        self.assertEqual(loaded.get_sync_status(1, nodes[-1]),
+                         UKAI_OUT_OF_SYNC)
+
+    def test_old_format(self):
+        a = {'10.0.0.1': {'sync_status': UKAI_IN_SYNC}}
+        b = {'10.0.0.1': {'sync_status': UKAI_IN_SYNC},
+             '10.0.0.2': {'sync_status': UKAI_OUT_OF_SYNC}}
+        metadata_raw = {'name': IMAGE_NAME,
+                        'size': BLOCK_SIZE * 5,
+                        'used_size': BLOCK_SIZE * 5,
+                        'block_size': BLOCK_SIZE,
+                        'blocks': [a, a, b, b, a]}
+        self.assertEqual(ukai_metadata_get_block_extents(metadata_raw),
+                         [[0, 2, a], [2, 2, b], [4, 1, a]])
+        metadata = UKAIMetadata(IMAGE_NAME, self.config, metadata_raw)
+        self.assertEqual(list(metadata.blocks), metadata_raw['blocks'])
+        self.assertFalse('blocks' in metadata.metadata)
+        self.assertEqual(metadata.metadata['block_extents'],
+                         [[0, 2, a], [2, 2, b], [4, 1, a]])
+
+    def test_block_extents(self):
+        nodes = ['10.0.0.1', '10.0.0.2']
+        metadata = self._create(10, nodes)
+        metadata.set_sync_status(3, nodes[1], UKAI_OUT_OF_SYNC)
+        metadata.set_sync_status(4, nodes[1], UKAI_OUT_OF_SYNC)
+        metadata.set_sync_status(6, nodes[1], UKAI_SYNCING)
+        metadata.mark_dirty(8, nodes[0], 0, 100)
+        extents = metadata.metadata['block_extents']
+        # the blocks being synchronized or having dirty extents are
+        # stored one by one.
+        self.assertEqual([extent[:2] for extent in extents],
+                         [[0, 3], [3, 2], [5, 1], [6, 1], [7, 1], [8, 1],
+                          [9, 1]])
+        # the extents with the same locations share the dictionary.
+        self.assertTrue(extents[0][2] is extents[2][2])
+        self.assertTrue(extents[0][2] is extents[4][2])
+        self.assertEqual(extents[3][2][nodes[1]]['sync_status'],
+                         UKAI_SYNCING)
+        self.assertEqual(extents[5][2][nodes[0]]['dirty'],
+                         metadata.get_dirty_extents(8, nodes[0]))
+
+        # the stored form is loaded again.
+        loaded = UKAIMetadata(IMAGE_NAME, self.config,
+                              json.loads(json.dumps(metadata.metadata)))
+        self.assertEqual(list(loaded.blocks), list(metadata.blocks))
+        self.assertEqual(loaded.metadata, metadata.metadata)
+
+    def test_add_location_lock(self):
+        nodes = ['10.0.0.%d' % i for i in range(0, UKAI_LOCATIONS_MAX)]
+        metadata = self._create(4, nodes)
+        metadata.acquire_lock(3, 3)
+        try:
+            # a node in the table locks only the blocks.
+            metadata.add_location(nodes[1], 0, 0)
+            # a new node waits for all the blocks, since the masks are
+            # converted when the table grows beyond the array items.
+            thread = threading.Thread(target=metadata.add_location,
+                                      args=('10.0.1.0', 0, 0))
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+        finally:
+            metadata.release_lock(3, 3)
+        thread.join()
+        self.assertTrue('10.0.1.0' in metadata.get_locations(0))
+
+    def test_lock_stripes(self):
+        self.assertEqual(len(UKAIStripedLock(10, self.config)._locks), 10)
+        self.config.set('lock_stripes', 4)
+        lock = UKAIStripedLock(10, self.config)
+        self.assertEqual(lock._get_stripes(1, 2), [1, 2])
+        self.assertEqual(lock._get_stripes(3, 5), [0, 1, 3])
+        self.assertEqual(lock._get_stripes(0, 9), [0, 1, 2, 3])
+
+    def test_write_without_lock(self):
+        metadata = self._create(4, ['10.0.0.1', '10.0.0.2'])
+        test = self
+        class FakeDB(object):
+            def put_metadata(self, image_name, metadata_raw):
+                # the blocks must not be locked.
+                for lock in metadata._lock._locks:
+                    if not lock.acquire(False):
+                        raise IOError('locked')
+                    lock.release()
+                test.written = metadata_raw
+            def get_readers(self, image_name):
+                return ([])
+        saved_db_client = ukai_metadata.ukai_db_client
+        ukai_metadata.ukai_db_client = FakeDB()
+        try:
+            metadata.mark_dirty(2, '10.0.0.2')
+            del metadata.flush
+            metadata.flush()
+        finally:
+            ukai_metadata.ukai_db_client = saved_db_client
+        self.assertEqual(self.written['version'], 1)
+        self.assertEqual(self.written['block_extents'][1][2]['10.0.0.2'],
+                         {'sync_status': UKAI_OUT_OF_SYNC})
+
+    def _write(self, metadata, fault=None):
+        # returns the list of (method, decoded argument) pairs sent to
+        # a hypervisor.
+        sent = []
+        class FakeDB(object):
+            def put_metadata(self, image_name, metadata_raw):
+                pass
+            def get_readers(self, image_name):
+                return (['10.0.0.9'])
+        def send_update(hv, method, encoded):
+            sent.append((method, json.loads(zlib.decompress(
+                            UKAIXMLRPCTranslation().decode(encoded)))))
+            if method == fault:
+                raise xmlrpclib.Fault(1, '%s is not supported' % method)
+        metadata._send_update = send_update
+        saved_db_client = ukai_metadata.ukai_db_client
+        ukai_metadata.ukai_db_client = FakeDB()
+        try:
+            del metadata.flush
+            metadata.flush()
+        finally:
+            ukai_metadata.ukai_db_client = saved_db_client
+        return (sent)
+
+    def test_delta(self):
+        nodes = ['10.0.0.1', '10.0.0.2']
+        metadata = self._create(8, nodes)
+        replica = self._create(8, nodes)
+        metadata.mark_dirty(2, nodes[1], 0, 100)
+        metadata.set_sync_status(5, nodes[0], UKAI_OUT_OF_SYNC)
+        sent = self._write(metadata)
+        self.assertEqual([method for (method, arg) in sent],
+                         ['proxy_update_metadata_delta'])
+        delta = sent[0][1]
+        self.assertEqual(delta['base_version'], 0)
+        self.assertEqual([blk_idx for (blk_idx, block) in delta['blocks']],
+                         [2, 5])
+        self.assertEqual(replica.apply_delta(delta), [2, 5])
+        self.assertEqual(replica.metadata, metadata.metadata)
+        self.assertEqual(replica.version, 1)
+        # the delta is not for the current version any more.
+        self.assertEqual(replica.apply_delta(delta), None)
+
+    def test_delta_not_supported(self):
+        nodes = ['10.0.0.1', '10.0.0.2']
+        metadata = self._create(8, nodes)
+        metadata.set_sync_status(5, nodes[0], UKAI_OUT_OF_SYNC)
+        sent = self._write(metadata, 'proxy_update_metadata_delta')
+        self.assertEqual([method for (method, arg) in sent],
+                         ['proxy_update_metadata_delta',
+                          'proxy_update_metadata'])
+        self.assertEqual(sent[1][1], json.loads(json.dumps(
+                    metadata.metadata)))
+
+    def test_whole_metadata(self):
+        nodes = ['10.0.0.1', '10.0.0.2']
+        metadata = self._create(4, nodes)
+        # most of the blocks are modified.
+        for blk_idx in range(0, 3):
+            metadata.set_sync_status(blk_idx, nodes[0], UKAI_OUT_OF_SYNC)
+        sent = self._write(metadata)
+        self.assertEqual([method for (method, arg) in sent],
+                         ['proxy_update_metadata'])
+
+if __name__ == '__main__':
+    unittest.main()
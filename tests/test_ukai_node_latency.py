@@ -0,0 +1,103 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+''' Tests of the latency based selection of the node to read from.
+'''
+
+import time
+import unittest
+
+from libukai.ukai_node_latency import UKAINodeLatencySet
+from libukai.ukai_node_latency import UKAI_NODE_LATENCY_MIN_SAMPLES
+
+from tests import ukai_test_config
+
+class UKAINodeLatencySetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.latency_set = UKAINodeLatencySet(
+            ukai_test_config({'latency_weight': 0.5}))
+
+    def _measure(self, address, latency):
+        # pretends that the request was sent latency seconds ago.
+        self.latency_set.begin(address)
+        self.latency_set.end(address, time.time() - latency)
+
+    def _latency(self, address):
+        for state in self.latency_set.get_list():
+            if state['address'] == address:
+                return (state['latency'])
+
+    def test_average(self):
+        self._measure('a', 1.0)
+        self.assertAlmostEqual(self._latency('a'), 1.0, 2)
+        self._measure('a', 3.0)
+        self.assertAlmostEqual(self._latency('a'), 2.0, 2)
+        # failed requests are not counted.
+        self.latency_set.begin('a')
+        self.latency_set.end('a', time.time() - 100.0, failed=True)
+        self.assertAlmostEqual(self._latency('a'), 2.0, 2)
+        self.assertEqual(self.latency_set.get_list(),
+                         [{'address': 'a', 'latency': self._latency('a'),
+                           'outstanding': 0, 'samples': 2}])
+
+    def test_select(self):
+        self.assertEqual(self.latency_set.select([]), None)
+        self._measure('a', 0.1)
+        self._measure('b', 1.0)
+        # the node never measured is tried first.
+        self.assertEqual(self.latency_set.select(['a', 'b', 'c']), 'c')
+        for i in range(0, 10):
+            self.assertEqual(self.latency_set.select(['a', 'b']), 'a')
+
+    def test_outstanding(self):
+        self._measure('a', 0.1)
+        self._measure('b', 0.3)
+        # 0.1 * (3 + 1) is larger than 0.3.
+        for i in range(0, 3):
+            self.latency_set.begin('a')
+        self.assertEqual(self.latency_set.select(['a', 'b']), 'b')
+
+    def test_spread(self):
+        self._measure('a', 1.0)
+        self._measure('b', 1.0)
+        selected = set([self.latency_set.select(['a', 'b'])
+                        for i in range(0, 100)])
+        self.assertEqual(selected, set(['a', 'b']))
+
+    def test_percentile(self):
+        for i in range(1, UKAI_NODE_LATENCY_MIN_SAMPLES):
+            self._measure('a', i * 0.01)
+        self.assertEqual(self.latency_set.percentile('a', 50), None)
+        self._measure('a', UKAI_NODE_LATENCY_MIN_SAMPLES * 0.01)
+        self.assertAlmostEqual(self.latency_set.percentile('a', 100),
+                               UKAI_NODE_LATENCY_MIN_SAMPLES * 0.01, 2)
+        self.assertAlmostEqual(self.latency_set.percentile('a', 0), 0.01, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+''' Tests of the synchronization of block locations after read and
+write failures.
+'''
+
+import unittest
+
+from libukai import ukai_data
+from libukai.ukai_data import UKAIData
+from libukai.ukai_metadata import UKAIMetadata
+from libukai.ukai_metadata import UKAI_IN_SYNC, UKAI_OUT_OF_SYNC
+from libukai.ukai_metadata import UKAI_DIRTY_UNIT
+from libukai.ukai_node_error_state import UKAINodeErrorStateSet
+from libukai.ukai_statistics import UKAIStatistics, UKAIImageStatistics
+
+from tests import ukai_test_config
+
+IMAGE_NAME = 'test_image'
+BLOCK_SIZE = 4 * UKAI_DIRTY_UNIT
+NUM_BLOCKS = 4
+# the local node is tried first to read a block.
+LOCAL_NODE = '127.0.0.1'
+REMOTE_NODE = '127.0.0.2'
+
+class UKAISyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = ukai_test_config()
+        locations = {LOCAL_NODE: {'sync_status': UKAI_IN_SYNC},
+                     REMOTE_NODE: {'sync_status': UKAI_IN_SYNC}}
+        metadata_raw = {'name': IMAGE_NAME,
+                        'size': BLOCK_SIZE * NUM_BLOCKS,
+                        'used_size': BLOCK_SIZE * NUM_BLOCKS,
+                        'block_size': BLOCK_SIZE,
+                        'block_extents': [[0, NUM_BLOCKS, locations]]}
+        self.metadata = UKAIMetadata(IMAGE_NAME, self.config, metadata_raw)
+        self.metadata.flush = lambda *args, **kwargs: None
+        self.data = UKAIData(self.metadata, UKAINodeErrorStateSet(),
+                             self.config)
+        self.data._get_datav_async = lambda node, pieces: None
+        self.data._get_datav = self._get_datav
+        self.data._get_data = self._get_data
+        self.data._allocate_dataspace = lambda node, blk_idx: None
+        self.data._copy_extents = self._copy_extents
+        self.copied = []
+        UKAIStatistics[IMAGE_NAME] = UKAIImageStatistics()
+
+    def tearDown(self):
+        del UKAIStatistics[IMAGE_NAME]
+
+    def _get_datav(self, node, pieces):
+        if node == LOCAL_NODE:
+            raise IOError('read failure')
+        return ('x' * sum([piece[2] for piece in pieces]))
+
+    def _get_data(self, node, blk_idx, off_in_blk, size_in_blk):
+        return (self._get_datav(node, [(blk_idx, off_in_blk, size_in_blk)]))
+
+    def _copy_extents(self, source, node, blk_idx, extents):
+        self.copied.append((source, node, blk_idx, extents))
+
+    def test_mark_dirty_without_range(self):
+        self.assertTrue(self.metadata.mark_dirty(1, REMOTE_NODE,
+                                                 0, UKAI_DIRTY_UNIT))
+        self.assertEqual(self.metadata.get_dirty_extents(1, REMOTE_NODE),
+                         [[0, UKAI_DIRTY_UNIT]])
+        # the data of the location is unknown.
+        self.assertTrue(self.metadata.mark_dirty(1, REMOTE_NODE))
+        self.assertEqual(self.metadata.get_sync_status(1, REMOTE_NODE),
+                         UKAI_OUT_OF_SYNC)
+        self.assertEqual(self.metadata.get_dirty_extents(1, REMOTE_NODE),
+                         None)
+        self.assertFalse(self.metadata.mark_dirty(1, REMOTE_NODE))
+        self.assertFalse(self.metadata.mark_dirty(1, REMOTE_NODE,
+                                                  0, UKAI_DIRTY_UNIT))
+
+    def test_write_failure_then_sync(self):
+        self.metadata.mark_dirty(2, REMOTE_NODE, UKAI_DIRTY_UNIT, 1)
+        self.assertTrue(self.data.synchronize_block(2))
+        self.assertEqual(self.copied,
+                         [(LOCAL_NODE, REMOTE_NODE, 2,
+                           [[UKAI_DIRTY_UNIT, 2 * UKAI_DIRTY_UNIT]])])
+        self.assertEqual(self.metadata.get_sync_status(2, REMOTE_NODE),
+                         UKAI_IN_SYNC)
+
+    def test_read_failure_then_sync(self):
+        offset = BLOCK_SIZE + UKAI_DIRTY_UNIT
+        self.assertEqual(self.data.read(UKAI_DIRTY_UNIT, offset),
+                         'x' * UKAI_DIRTY_UNIT)
+        self.assertEqual(self.metadata.get_sync_status(1, LOCAL_NODE),
+                         UKAI_OUT_OF_SYNC)
+        self.assertEqual(self.metadata.get_dirty_extents(1, LOCAL_NODE),
+                         None)
+
+        # the whole block is copied from the location in sync.
+        self.assertTrue(self.data.synchronize_block(1))
+        self.assertEqual(self.copied,
+                         [(REMOTE_NODE, LOCAL_NODE, 1,
+                           [[0, BLOCK_SIZE]])])
+        self.assertEqual(self.metadata.get_sync_status(1, LOCAL_NODE),
+                         UKAI_IN_SYNC)
+
+    def test_throttle_outside_lock(self):
+        throttled = []
+        def throttle(image_name, extents):
+            # the lock of the block must be available.
+            lock = self.data._lock._locks[1 % len(self.data._lock._locks)]
+            self.assertTrue(lock.acquire(False))
+            lock.release()
+            throttled.extend(extents)
+        saved_throttle = ukai_data.ukai_data_throttle
+        ukai_data.ukai_data_throttle = throttle
+        try:
+            self.metadata.mark_dirty(1, REMOTE_NODE)
+            self.assertTrue(self.data.synchronize_block(1))
+        finally:
+            ukai_data.ukai_data_throttle = saved_throttle
+        self.assertEqual(throttled, [[0, BLOCK_SIZE]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+''' Tests of the background synchronization service.
+'''
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from libukai.ukai_metadata import UKAI_IN_SYNC, UKAI_OUT_OF_SYNC
+from libukai.ukai_sync import UKAISyncService
+from libukai.ukai_sync import UKAI_SYNC_JOB_CANCELLED
+
+from tests import ukai_test_config
+
+class FakeMetadata(object):
+    def __init__(self, num_blocks, nodes):
+        self.size = num_blocks
+        self.block_size = 1
+        self.nodes = nodes
+        self.flushed = 0
+        self.error = None
+
+    def get_locations(self, blk_idx):
+        return (self.nodes)
+
+    def get_sync_status(self, blk_idx, node):
+        return (UKAI_OUT_OF_SYNC)
+
+    def flush(self, wait=True):
+        if self.error is not None:
+            raise self.error
+        self.flushed += 1
+
+class FakeData(object):
+    def __init__(self):
+        self.started = threading.Semaphore(0)
+        self.proceed = threading.Event()
+        self.synchronized = []
+
+    def synchronize_block(self, blk_idx, node):
+        self.started.release()
+        self.proceed.wait()
+        self.synchronized.append((blk_idx, node))
+        return (True)
+
+class UKAISyncServiceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = ukai_test_config()
+        self.config.set('sync_checkpoint',
+                        os.path.join(self.tmpdir, 'sync.json'))
+        self.config.set('sync_workers', 2)
+        self.config.set('sync_node_workers', 1)
+        self.metadata = FakeMetadata(8, ['10.0.0.1', '10.0.0.2'])
+        self.data = FakeData()
+        self.service = UKAISyncService(
+            self.config, lambda image_name: (self.metadata, self.data))
+
+    def tearDown(self):
+        self.data.proceed.set()
+        shutil.rmtree(self.tmpdir, True)
+
+    def test_nodes_in_turn(self):
+        self.service.submit('image')
+        items = []
+        self.service._cond.acquire()
+        try:
+            for idx in range(0, 4):
+                item = self.service._next_item()
+                items.append(item[1:])
+                self.service._active[item[2]] = 0
+        finally:
+            self.service._cond.release()
+        self.assertEqual(items, [(0, '10.0.0.1'), (0, '10.0.0.2'),
+                                 (1, '10.0.0.1'), (1, '10.0.0.2')])
+
+    def test_cancel_flushes_items_in_flight(self):
+        self.service.start()
+        job_id = self.service.submit('image')
+        self.data.started.acquire()
+        self.data.started.acquire()
+        self.assertTrue(self.service.cancel(job_id))
+        self.assertTrue(self.service.has_running_jobs('image'))
+        flushed = self.metadata.flushed
+        self.data.proceed.set()
+        for idx in range(0, 100):
+            if not self.service.has_running_jobs('image'):
+                break
+            time.sleep(0.01)
+        time.sleep(0.05)
+        status = self.service.get_status(job_id)[0]
+        self.assertEqual(status['state'], UKAI_SYNC_JOB_CANCELLED)
+        self.assertEqual(status['done'], 2)
+        self.assertEqual(len(self.data.synchronized), 2)
+        self.assertEqual(self.metadata.flushed, flushed + 1)
+
+    def test_flush_failure(self):
+        job_id = self.service.submit('image')
+        job = self.service._jobs[job_id]
+        job['done'] = job['unflushed'] = 3
+        self.metadata.error = IOError('metadata storage is down')
+        self.service._flush(job, True)
+        self.assertEqual(job['unflushed'], 3)
+        # the error doesn't reach the caller of cancel().
+        self.assertTrue(self.service.cancel(job_id))
+        self.assertEqual(job['unflushed'], 3)
+        self.metadata.error = None
+        self.service._flush(job, True)
+        self.assertEqual(job['unflushed'], 0)
+        self.assertEqual(self.metadata.flushed, 1)
+
+if __name__ == '__main__':
+    unittest.main()
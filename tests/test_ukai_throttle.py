@@ -0,0 +1,127 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+''' Tests of the rate limiters of synchronization transfers.
+'''
+
+import time
+import unittest
+
+from libukai import ukai_throttle
+from libukai.ukai_throttle import UKAITokenBucket, UKAISyncThrottle
+from libukai.ukai_throttle import UKAI_THROTTLE_ADJUST_INTERVAL
+
+from tests import ukai_test_config
+
+class FakeClock(object):
+    # replaces the time module so that sleeping advances the clock
+    # immediately.
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0
+
+    def time(self):
+        return (self.now)
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.now += seconds
+
+class UKAIThrottleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        ukai_throttle.time = self.clock
+
+    def tearDown(self):
+        ukai_throttle.time = time
+
+    def test_unlimited(self):
+        bucket = UKAITokenBucket()
+        self.assertEqual(bucket.consume(1 << 30), 0)
+        self.assertEqual(self.clock.slept, 0)
+
+    def test_consume(self):
+        bucket = UKAITokenBucket(100)
+        # a burst of one second is allowed.
+        self.assertEqual(bucket.consume(100), 0)
+        self.assertAlmostEqual(bucket.consume(50), 0.5)
+        # the debt is paid by waiting.
+        self.assertAlmostEqual(bucket.consume(300), 3.0)
+        self.assertAlmostEqual(self.clock.slept, 3.5)
+        # tokens are refilled up to the burst size while idle.
+        self.clock.now += 10
+        self.assertEqual(bucket.consume(100), 0)
+        self.assertAlmostEqual(bucket.consume(100), 1.0)
+
+    def test_factor(self):
+        bucket = UKAITokenBucket(100)
+        bucket.consume(100)
+        self.assertAlmostEqual(bucket.consume(100, 0.5), 2.0)
+
+    def test_set_rate(self):
+        bucket = UKAITokenBucket(1000)
+        bucket.set_rate(10)
+        self.assertEqual(bucket.rate, 10)
+        # the tokens more than the new burst size are dropped.
+        self.assertEqual(bucket.consume(10), 0)
+        self.assertAlmostEqual(bucket.consume(10), 1.0)
+
+    def test_sync_throttle(self):
+        throttle = UKAISyncThrottle()
+        throttle.configure(ukai_test_config({
+                    'sync_rate': 1000,
+                    'sync_image_rates': {'slow': {'rate': 100}}}))
+        self.assertEqual(throttle.get_limits()['images'],
+                         {'slow': {'rate': 100, 'iops': 0}})
+        # the buckets start empty when the limits are set.
+        self.clock.now += 1
+        throttle.consume('fast', 1000)
+        self.assertEqual(self.clock.slept, 0)
+        throttle.consume('slow', 200)
+        self.assertAlmostEqual(self.clock.slept, 1.0)
+        throttle.set_limit(0, 0, 'slow')
+        self.assertEqual(throttle.get_limits()['images'], {})
+
+    def test_latency_target(self):
+        throttle = UKAISyncThrottle()
+        throttle.configure(ukai_test_config({'sync_rate': 1000,
+                                             'sync_latency_target': 0.01}))
+        self.clock.now += UKAI_THROTTLE_ADJUST_INTERVAL * 2
+        throttle.foreground_op(0.1)
+        self.assertEqual(throttle.get_limits()['factor'], 0.5)
+        # adjusted at most once per interval.
+        throttle.foreground_op(0.1)
+        self.assertEqual(throttle.get_limits()['factor'], 0.5)
+        # restored while no foreground I/O is done.
+        self.clock.now += UKAI_THROTTLE_ADJUST_INTERVAL * 2
+        throttle.consume('image', 1)
+        self.assertAlmostEqual(throttle.get_limits()['factor'], 0.6)
+
+if __name__ == '__main__':
+    unittest.main()
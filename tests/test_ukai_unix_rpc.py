@@ -0,0 +1,96 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+''' Tests of the RPC transport over a UNIX domain socket.
+'''
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import xmlrpclib
+
+from multiprocessing.connection import AuthenticationError
+
+from libukai.ukai_rpc import ukai_rpc_pool
+from libukai.ukai_unix_rpc import UKAIUnixRPCClient, UKAIUnixRPCServer
+
+from tests import ukai_test_config
+
+class FakeCore(object):
+    def getattr(self, path):
+        return (0, path)
+
+    def ctl_destroy_image(self, image_name):
+        raise AssertionError('must not be called')
+
+class UKAIUnixRPCTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.tmp_dir, 'core.sock')
+        cls.server = UKAIUnixRPCServer(cls.path, FakeCore(), 'secret')
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        # removes the socket file.
+        cls.server._listener.close()
+        shutil.rmtree(cls.tmp_dir)
+
+    def tearDown(self):
+        ukai_rpc_pool.clear()
+
+    def _client(self, authkey):
+        config = ukai_test_config()
+        config.set('unix_rpc_authkey', authkey)
+        return (UKAIUnixRPCClient(config, self.path))
+
+    def test_call(self):
+        self.assertEqual(self._client('secret').call('getattr', '/a'),
+                         (0, '/a'))
+
+    def test_method_not_listed(self):
+        self.assertRaises(xmlrpclib.Fault, self._client('secret').call,
+                          'ctl_destroy_image', 'a')
+        self.assertRaises(xmlrpclib.Fault, self._client('secret').call,
+                          '__init__')
+
+    def test_wrong_authkey(self):
+        self.assertRaises(AuthenticationError, self._client('wrong').call,
+                          'getattr', '/a')
+        # the server doesn't process requests before authentication.
+        self.assertRaises(Exception, self._client(None).call,
+                          'getattr', '/a')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+''' Tests of the write-back buffer of the FUSE connector.
+'''
+
+import threading
+import unittest
+
+from libukai.ukai_write_back import UKAIWriteBack
+
+from tests import ukai_test_config
+
+class UKAIWriteBackTestCase(unittest.TestCase):
+    def setUp(self):
+        # the data written to the UKAI core.
+        self.core = bytearray(16)
+        self.write_back = UKAIWriteBack(ukai_test_config(), self.writer)
+
+    def tearDown(self):
+        self.write_back.stop()
+
+    def writer(self, path, data, offset):
+        self.core[offset:offset + len(data)] = data
+
+    def test_read(self):
+        self.write_back.write('/a', 'xy', 4)
+        self.assertEqual(self.write_back.read(
+                '/a', 2, 6, lambda: str(self.core[2:8])),
+                         '\0\0xy\0\0')
+        self.write_back.flush('/a')
+        self.assertEqual(str(self.core[4:6]), 'xy')
+
+    def test_write_during_read(self):
+        self.write_back.write('/a', 'old', 0)
+        flusher = []
+
+        def reader():
+            # the buffered data is newer than the UKAI core, and is
+            # written while it is applied.
+            self.write_back.write('/a', 'new', 0)
+            flusher.append(threading.Thread(target=self.write_back.flush,
+                                            args=('/a',)))
+            flusher[0].start()
+            flusher[0].join(0.2)
+            self.assertTrue(flusher[0].is_alive())
+            return (str(self.core[0:3]))
+
+        # the read started before the second write ends, so either
+        # data is correct, but must not be older than the UKAI core.
+        self.assertEqual(self.write_back.read('/a', 0, 3, reader), 'old')
+        flusher[0].join()
+        self.assertEqual(str(self.core[0:3]), 'new')
+        self.assertEqual(self.write_back.read(
+                '/a', 0, 3, lambda: str(self.core[0:3])), 'new')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# Copyright 2014
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+''' Tests of the event driven XML-RPC server.
+'''
+
+import threading
+import unittest
+import xmlrpclib
+
+from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
+
+from libukai.ukai_xmlrpc_server import UKAIEventXMLRPCServer
+from libukai.ukai_xmlrpc_server import ukai_server_pool
+from libukai.ukai_xmlrpc_server import UKAI_SERVER_POOL_MAIN
+from libukai.ukai_xmlrpc_server import UKAI_SERVER_POOL_PULL
+from libukai.ukai_xmlrpc_server import UKAI_SERVER_POOL_PROXY
+
+from tests import ukai_test_config
+
+class FakeCore(object):
+    def __init__(self):
+        self.address = None
+
+    def _call(self, method, *params):
+        proxy = xmlrpclib.ServerProxy('http://%s:%d/' % self.address)
+        return (getattr(proxy, method)(*params))
+
+    def ctl_synchronize(self, image_name):
+        return (self._call('proxy_pull', image_name))
+
+    def proxy_pull(self, image_name):
+        return (self._call('proxy_readv', image_name))
+
+    def proxy_readv(self, image_name):
+        return ('data of %s' % image_name)
+
+class UKAIEventXMLRPCServerTestCase(unittest.TestCase):
+    def setUp(self):
+        config = ukai_test_config({'server_workers': 1,
+                                   'server_proxy_workers': 1})
+        self.server = UKAIEventXMLRPCServer(
+            ('127.0.0.1', 0), config,
+            requestHandler=SimpleXMLRPCRequestHandler,
+            logRequests=False)
+        self.core = FakeCore()
+        self.core.address = self.server.server_address
+        self.server.register_instance(self.core)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.1,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pools(self):
+        self.assertEqual(ukai_server_pool('ctl_synchronize'),
+                         UKAI_SERVER_POOL_MAIN)
+        self.assertEqual(ukai_server_pool('proxy_pull'),
+                         UKAI_SERVER_POOL_PULL)
+        self.assertEqual(ukai_server_pool('proxy_readv'),
+                         UKAI_SERVER_POOL_PROXY)
+        self.assertEqual(ukai_server_pool(None), UKAI_SERVER_POOL_MAIN)
+
+    def test_nested_requests(self):
+        # each pool has one worker, which waits for the request of the
+        # next pool.
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(
+                self.core._call('ctl_synchronize', 'image')))
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertEqual(result, ['data of image'])
+
+if __name__ == '__main__':
+    unittest.main()